@@ -5,6 +5,8 @@
 # ----------------------------------------------------------------------------
 from ._astropy_init import *   # noqa
 
+from .config import *
+
 from .target import *
 from .ceres import *
 from .stack import *
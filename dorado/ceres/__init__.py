@@ -6,4 +6,16 @@ is just an example sub-package, so it doesn't actually do anything.
 __all__ = []
 
 from .ceresClass import *
-__all__ += ceresClass.__all__
\ No newline at end of file
+__all__ += ceresClass.__all__
+
+from .calibratorClass import *
+__all__ += calibratorClass.__all__
+
+from .registrarClass import *
+__all__ += registrarClass.__all__
+
+from .ensembleClass import *
+__all__ += ensembleClass.__all__
+
+from .photometerClass import *
+__all__ += photometerClass.__all__
@@ -1,21 +1,24 @@
 import warnings
 warnings.filterwarnings('ignore')
+import os
+import csv
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 # import sys
 # import os
 
-# import numpy as np
-import ccdproc
+import numpy as np
 from astropy.time import Time
 from astropy.table import QTable, Table
-import astroalign as aa
 from astropy.wcs import WCS
 # from astropy.utils.console import ProgressBar, ProgressBarOrSpinner
 from tqdm import tqdm
-# from astropy.coordinates import SkyCoord as acoord
-# import astropy.units as un
+from astropy.coordinates import SkyCoord as acoord
+import astropy.units as un
 from astropy.io import fits
 
 from astropy.nddata.ccddata import CCDData
+from astropy.nddata import StdDevUncertainty
 
 # photometry imports
 from photutils.psf import IntegratedGaussianPRF, DAOGroup
@@ -29,6 +32,12 @@ from astropy.stats import mad_std
 # from astroquery.simbad import Simbad
 
 from ..timeseries import timeSeries
+from .calibratorClass import Calibrator
+from .registrarClass import Registrar, RegistrationError
+from .ensembleClass import Ensemble
+from .photometerClass import Photometer
+from ..config import working_dtype
+from ..stack.stackClass import imagehdu
 
 '''
 Ceres is the handler of image series in Dorado,
@@ -57,8 +66,13 @@ class Ceres:
 
         
     '''
-    def __init__(self, filters = {}, data = [], bias = None, time = None, datestr = None):
+    def __init__(self, filters = None, data = None, bias = None, time = None, datestr = None):
         # metadata
+        # fresh containers per instance, shared defaults would leak stacks between nights
+        if filters == None:
+            filters = {}
+        if data == None:
+            data = []
         self.filters = filters
         self.data = data
         self.bias = bias
@@ -106,22 +120,46 @@ class Ceres:
     def calibrate(self, filter):
         # for bla in series: add bias corrected = True to header
         stack = self.data[self.filters[filter]]
-        flat = stack.flat
-        bias = self.bias
+        # bias and normalized flat are prepared once, a lazy stack writes each frame out so
+        # every frame is calibrated into one reused buffer
+        calibrator = Calibrator(self.bias, stack.flat)
+        work = None
         c_series = []
         # with ProgressBar(len(stack.data)) as bar:
         print('Calibrating')
-        for im in tqdm(stack.data, colour = 'green'):
+        for i, im in enumerate(tqdm(stack.frames(), total = len(stack.data), colour = 'green')):
             # bar.update()
-            im.data = im.data.astype('uint16') 
-            flat.data = flat.data.astype('uint16') 
-            bias.data = bias.data.astype('uint16') 
-            im = ccdproc.ccd_process(im, master_bias = bias, master_flat = flat)
-            im.data = im.data.astype('uint16') 
-            c_series.append(im)
+            if stack.lazy and ((work is None) or (work.shape != im.data.shape)):
+                work = np.empty(im.data.shape, dtype = calibrator.dtype)
+            im = self.calibrate_frame(im, calibrator, out = work)
+            c_series.append(stack.stash(im, i, 'c'))
         self.data[self.filters[filter]].data = c_series
         self.data[self.filters[filter]].calibrated = True
 
+    def calibrate_frame(self, im, calibrator, out = None):
+        '''
+        calibrate_frame bias and flatfield corrects a single frame, the per-frame step of 'calibrate'.
+
+        Parameters
+        ----------
+        im: CCDdata
+            Frame to calibrate.
+
+        calibrator: Calibrator or CCDdata
+            Calibrator prepared from the nights bias and the frame's flat, or the flatfield itself.
+
+        out: array
+            Working buffer the frame is calibrated into, see 'Calibrator.apply'. Optional.
+
+        Returns
+        -------
+        im: CCDdata
+            The calibrated frame in the working data type, see 'dorado.conf'.
+        '''
+        if not isinstance(calibrator, Calibrator):
+            calibrator = Calibrator(self.bias, calibrator)
+        return calibrator.calibrate(im, out = out)
+
     def imarith(self, filter, operator, operand):
         # mod to check datatype using type()
         # mod to remove im_count and make possible to use single image
@@ -140,140 +178,667 @@ class Ceres:
         self.data[self.filters[filter]] = series
 
     def getWCS(self, filter, filer, alignto = None, cache = True):
-        series = self.data[self.filters[filter]]
-        if alignto == None:
-            alignto = series.alignTo
-        if cache:
-            hdulist = fits.open(filer.dordir / 'cache' / 'astrometryNet' / 'solved.fits') 
-            self.data[self.filters[filter]].wcs = WCS(hdulist[0].header, hdulist)
-            self.data[self.filters[filter]].solved = CCDData.read(filer.dordir / 'cache' / 'astrometryNet' / 'solved.fits')
-            hdulist.close()
+        # a list of filters is solved concurrently, see Filer.solveMany
+        if isinstance(filter, str):
+            filters = [filter]
         else:
-            toalign = series.data[alignto]
-            fname, cachedir = filer.mkcacheObj(toalign, 'astrometryNet')
-            path = [cachedir, fname]
-            writearray = [cachedir, 'solved.fits']
-            solved, wcs_header = filer.plate_solve(path, writearray = writearray)
-            filer.delcacheObj( fname, 'astrometryNet')
-            self.data[self.filters[filter]].wcs = WCS(wcs_header)
-            self.data[self.filters[filter]].solved = solved
-
-    def align(self, filter, filer, alignto = None, getWCS = True, cache = False):
+            filters = list(filter)
+        toalign = []
+        for fi in filters:
+            series = self.data[self.filters[fi]]
+            if alignto == None:
+                toalign.append(series.frame(series.alignTo))
+            else:
+                toalign.append(series.frame(alignto))
+        # cache = True reuses a cached solution of this exact frame
+        results = filer.solveMany(toalign, cache = cache)
+        for fi, result in zip(filters, results):
+            if result == None:
+                print('No WCS found for filter ', fi)
+                continue
+            solved, wcs_header = result
+            self.data[self.filters[fi]].wcs = WCS(wcs_header)
+            self.data[self.filters[fi]].solved = solved
+            if len(self.data[self.filters[fi]].transforms) != 0:
+                self.data[self.filters[fi]].propagate_wcs()
+
+    def align(self, filter, filer, alignto = None, getWCS = True, cache = False, workers = None, chunksize = 2, resample = True, translation = False):
+        '''
+        align registers every frame of a stack onto the reference frame, keeping each frame's transform.
+        With 'resample' set to 'False' only the transforms are found and stored, the frames keep their
+        native pixels and are not marked as aligned. 'dorphot' then maps the apertures into each frame 
+        through its transform, which skips the interpolation of every frame and measures pixels that
+        have not been smoothed by resampling.
+
+        Parameters
+        ----------
+        filter: str
+            Filter of the stack to align.
+
+        filer: Filer instance
+            Active instance of Filer, used for plate solving.
+
+        alignto: int
+            Index of the reference frame. Defaults to the stack 'alignTo'. Optional.
+
+        getWCS: Boolean
+            Whether to plate solve the reference frame first. Default is 'True'. Optional.
+
+        cache: Boolean
+            Whether to use the plate solution cache. Default is 'False'. Optional.
+
+        workers: int
+            Number of worker processes. Frames are passed to the workers through shared memory, or
+            read by the workers themselves for a lazy stack, rather than pickled. Default is 'None',
+            which aligns in this process. Optional.
+
+        chunksize: int
+            Number of frames sent to a worker at once. Default is 2. Optional.
+
+        resample: Boolean
+            Whether to resample the frames onto the reference frame's pixel grid. Default is 'True'. Optional.
+
+        translation: Boolean
+            Whether the frames drift by a translation only, for a well tracking mount, in which case each
+            frame is registered by FFT cross-correlation with the reference frame. Frames with a weak 
+            correlation peak fall back to the asterism search, see Registrar. Default is 'False'. Optional.
+        '''
         series = self.data[self.filters[filter]]
         if alignto == None:
             alignto = series.alignTo
-        toalign = series.data[alignto]
-        ## TODO :: make this use ceres.getWCS()
+        toalign = series.frame(alignto)
         if getWCS:
-            if cache:
-                toalign =  CCDData.read(filer.dordir / 'cache' / 'astrometryNet' / 'solved.fits', unit = filer.unit)
-                hdulist = fits.open(filer.dordir / 'cache' / 'astrometryNet' / 'solved.fits') 
-                self.data[self.filters[filter]].wcs = WCS(hdulist[0].header, hdulist)
-                hdulist.close()
-                self.data[self.filters[filter]].solved = toalign
-            else:
-                fname, cachedir = filer.mkcacheObj(toalign, 'astrometryNet')
-                path = [cachedir, fname]
-                writearray = [cachedir, 'solved.fits']
-                solved, wcs_header = filer.plate_solve(path, writearray = writearray)
-                toalign = solved
-                filer.delcacheObj( fname, 'astrometryNet')
-                self.data[self.filters[filter]].wcs = WCS(wcs_header)
-                self.data[self.filters[filter]].solved = solved
-                # delete cache object
-                # save solved to target
+            self.getWCS(filter, filer, alignto = alignto, cache = cache)
+            if series.solved != None:
+                toalign = series.solved
 
         aa_series = []
+        transforms = []
+        sources = []
         skipped = []
         ## TODO :: fix this progressbar so it prints on one line then updates that line.
         # with ProgressBar(len(series.data)) as bar:
         print('Aligning')
-        for image in tqdm(series.data, colour = 'green'):
+        if (workers != None) and (workers > 1):
+            results = self.align_pool(series, toalign, workers, chunksize, resample, translation)
+        else:
+            # reference sources and invariants are found once for the whole stack
+            results = self.align_serial(series, Registrar(toalign, max_control_points = 100, detection_sigma = 6, translation = translation), resample)
+        for i, aaim, matrix in results:
             # bar.update()
-            try:
-                img, _ = aa.register(image.data, toalign.data, max_control_points = 100, detection_sigma = 6)
-                aaim = image
-                aaim.data = img
-                aa_series.append(aaim)
-            except:
-                skipped.append(image)
+            if aaim is None:
+                skipped.append(series.data[i])
                 # print('Image skipped')
+                continue
+            if resample:
+                aa_series.append(series.stash(aaim, i, 'a'))
+            else:
+                # native frames are kept as they are, in memory or on disk
+                aa_series.append(series.data[i])
+            transforms.append(matrix)
+            if len(series.sources) != 0:
+                sources.append(series.sources[i])
         if len(skipped) != 0:
             print(len(skipped), ' images skipped.')
             ## TODO :: need to redo times and such for less ims
 
         self.data[self.filters[filter]].data = aa_series
-        self.data[self.filters[filter]].aligned = True
+        self.data[self.filters[filter]].transforms = transforms
+        self.data[self.filters[filter]].sources = sources
+        if resample:
+            self.data[self.filters[filter]].aligned = True
+        if series.wcs != None:
+            series.propagate_wcs()
+
+    def align_serial(self, series, toalign, resample = True):
+        '''
+        align_serial is a generator aligning the frames of a stack in order in this process, yielding 
+        (index, aligned frame, transform) with 'None' in place of the frame and transform of a 
+        frame which could not be aligned. 'toalign' is the reference frame or a Registrar of it.
+        '''
+        for i, image in enumerate(tqdm(series.frames(), total = len(series.data), colour = 'green')):
+            try:
+                aaim, matrix = self.align_frame(image, toalign, resample)
+            except RegistrationError:
+                aaim, matrix = None, None
+            yield i, aaim, matrix
+
+    def align_pool(self, series, toalign, workers, chunksize = 2, resample = True, translation = False):
+        '''
+        align_pool is the process pool counterpart of 'align_serial', yielding the same tuples in 
+        frame order. The reference frame is placed in shared memory once and attached by each worker. 
+        Frames are sent in waves of 'workers' * 'chunksize', each through a shared memory block (or 
+        as a file path for a lazy stack) with a second block receiving the aligned pixels, so only 
+        block names and transforms are pickled and at most one wave of frames is resident. Each
+        worker builds its Registrar of the reference frame once. Without 'resample' no output blocks
+        are made and only the transforms come back.
+        '''
+        # frames travel in their own data type so the workers compute exactly what align_frame does
+        dtype = working_dtype()
+        ref = np.ascontiguousarray(toalign.data)
+        refshm = shared_memory.SharedMemory(create = True, size = ref.nbytes)
+        np.ndarray(ref.shape, dtype = ref.dtype, buffer = refshm.buf)[:] = ref
+        size = int(np.prod(ref.shape)) * dtype.itemsize
+        wave = workers * chunksize
+        bar = tqdm(total = len(series.data), colour = 'green')
+        try:
+            with ProcessPoolExecutor(max_workers = workers, initializer = _align_init, 
+                                     initargs = (refshm.name, ref.shape, ref.dtype.str, dtype.str, resample, translation)) as pool:
+                for start in range(0, len(series.data), wave):
+                    stop = min(len(series.data), start + wave)
+                    blocks = []
+                    outs = []
+                    tasks = []
+                    headers = []
+                    try:
+                        for i in range(start, stop):
+                            out = None
+                            if resample:
+                                out = shared_memory.SharedMemory(create = True, size = size)
+                                blocks.append(out)
+                            outs.append(out)
+                            if series.lazy:
+                                source = ('path', os.fspath(series.data[i]))
+                                headers.append((series.header(i), series.unit))
+                            else:
+                                image = series.frame(i)
+                                data = np.ascontiguousarray(image.data)
+                                inp = shared_memory.SharedMemory(create = True, size = data.nbytes)
+                                blocks.append(inp)
+                                np.ndarray(data.shape, dtype = data.dtype, buffer = inp.buf)[:] = data
+                                source = ('shm', inp.name, data.shape, data.dtype.str)
+                                headers.append((image.header, image.unit))
+                            tasks.append((source, getattr(out, 'name', None)))
+                        for i, (matrix, out, (header, unit)) in enumerate(zip(pool.map(_align_task, tasks, chunksize = chunksize), outs, headers)):
+                            bar.update()
+                            if matrix is None:
+                                yield start + i, None, None
+                                continue
+                            if out is None:
+                                yield start + i, series.data[start + i], matrix
+                                continue
+                            data = np.ndarray(ref.shape, dtype = dtype, buffer = out.buf).copy()
+                            yield start + i, CCDData(data, unit = unit, header = header.copy()), matrix
+                    finally:
+                        for block in blocks:
+                            block.close()
+                            block.unlink()
+        finally:
+            bar.close()
+            refshm.close()
+            refshm.unlink()
+
+    def align_frame(self, image, toalign, resample = True):
+        '''
+        align_frame registers a single frame onto the reference frame, the per-frame step of 'align'. 
+        This is equivalent to 'astroalign.register' but also returns the transform.
+
+        Parameters
+        ----------
+        image: CCDdata
+            Frame to align.
+
+        toalign: CCDdata or Registrar
+            Reference frame, or a Registrar of it which reuses the reference sources across frames.
+
+        resample: Boolean
+            Whether to resample the frame onto the reference frame, otherwise only the transform is 
+            found and the frame is returned untouched. Default is 'True'. Optional.
+
+        Returns
+        -------
+        image: CCDdata
+            The aligned frame, a new frame so that the frames of an in-memory stack are left untouched 
+            as they are by 'align_pool'.
+
+        matrix: array
+            3x3 affine matrix mapping the frame's pixel coordinates onto the reference frame.
+        '''
+        if not isinstance(toalign, Registrar):
+            toalign = Registrar(toalign, max_control_points = 100, detection_sigma = 6)
+        if not resample:
+            transform, _ = toalign.find_transform(image.data)
+            return image, transform.params
+        img, transform = toalign.register(image.data)
+        return CCDData(img.astype(working_dtype(), copy = False), unit = image.unit, header = image.header.copy()), transform.params
+
+    def dorphot(self, filter, toi, control_toi = None, shape = 21, unc = 0.1, ensemble = None, sigma = 3, workers = None):
+        '''
+        dorphot performs background subtracted aperture photometry of one or many targets over a stack. 
+        Every aperture and annulus, including those of the control target or comparison stars, is 
+        measured in a single 'aperture_photometry' call per frame, so the stack is read once however 
+        many targets are measured. On a stack resampled onto the reference grid the positions are the
+        same in every frame, so the exact aperture weights are computed once by a Photometer and each 
+        frame is measured with one sparse matrix product.
+
+        Parameters
+        ----------
+        filter: str
+            Filter of the stack to measure.
+
+        toi: Target, list[Target] or coordinate table
+            Targets to measure. A coordinate table is a SkyCoord array or a table with 'ra' and 'dec'
+            columns in degrees.
+
+        control_toi: Target
+            Control target subtracted from every target for differential photometry. Optional.
+
+        shape: float
+            Aperture radius in pixels. Default is 21. Optional.
+
+        unc: float
+            Fractional pixel uncertainty. Default is 0.1. Optional.
 
-    def dorphot(self, filter, toi, control_toi = None, shape = 21, unc = 0.1):
+        ensemble: list[Target] or coordinate table
+            Comparison stars for ensemble differential photometry, in place of 'control_toi'. Each 
+            target is divided by the artificial comparison star built from them, see Ensemble. Optional.
+
+        sigma: float
+            Rejection threshold of the ensemble in robust standard deviations. Default is 3. Optional.
+
+        workers: int
+            Number of threads reading and measuring frames concurrently. Default is 'None', which
+            measures the frames in turn. Optional.
+
+        Returns
+        -------
+        ts: list[timeSeries]
+            Light curve of each target in order, which is also added to each Target.
+        '''
         # get seeing from PSF
         stack = self.data[self.filters[filter]]
         # if no wcs, complain alot
         w = stack.wcs
-
-        xy = w.wcs_world2pix(toi.coords.ra.deg, toi.coords.dec.deg, 1)
-        ra = toi.coords.ra.deg
-        dec = toi.coords.dec.deg
+        if (control_toi != None) and (ensemble is not None):
+            raise Exception('Use either a control target or a comparison ensemble, not both.')
+        targets, coords = self.targets(toi)
+        n = len(targets)
+        ra, dec = coords.ra.deg, coords.dec.deg
+        if control_toi != None:
+            # the control target is measured as the last position
+            control = getattr(control_toi, 'coords', control_toi)
+            ra, dec = np.append(ra, np.ravel(control.ra.deg)), np.append(dec, np.ravel(control.dec.deg))
+        if ensemble is not None:
+            # comparison stars follow the targets
+            comps = self.targets(ensemble)[1]
+            ra, dec = np.append(ra, comps.ra.deg), np.append(dec, comps.dec.deg)
+        positions = acoord(ra * un.deg, dec * un.deg)
+        apers = self.apertures(w, positions, shape)
+        # frames registered without resampling keep their native pixel grid
+        native = (stack.aligned != True) and (len(stack.transforms) != 0) and (len(stack.transforms) == len(stack.data))
+
+        nframes = len(stack.data)
+        photometer = None
+        if (not native) and (nframes != 0):
+            photometer = Photometer(apers, stack.frame(stack.alignTo).data.shape)
+
+        def phot(i):
+            image = stack.frame(i)
+            # masked pixels are left out by aperture_photometry only
+            if (photometer != None) and (image.data.shape == photometer.shape) and ((image.mask is None) or not image.mask.any()):
+                x, y = photometer.positions.T
+                return photometer.measure(image.data), x, y, image.unit, un.pix, image.header
+            frame_apers = apers
+            if native:
+                frame_apers = self.apertures(w, positions, shape, stack.transforms[i])
+            flux, x, y = self.measure(image, frame_apers, unc)
+            return flux.value, x.value, y.value, flux.unit, x.unit, image.header
+
+        fluxes = np.zeros((nframes, len(ra)))
+        xs = np.zeros((nframes, n))
+        ys = np.zeros((nframes, n))
+        times = []
+        exptimes = np.zeros(nframes)
+        funit, punit = un.dimensionless_unscaled, un.pix
+        print('Performing photometry')
+        if (workers != None) and (workers > 1):
+            pool = ThreadPoolExecutor(max_workers = workers)
+            results = pool.map(phot, range(nframes))
+        else:
+            pool = None
+            results = map(phot, range(nframes))
+        try:
+            for i, (flux, x, y, funit, punit, header) in enumerate(tqdm(results, total = nframes, colour = 'green')):
+                fluxes[i] = flux
+                xs[i] = x[:n]
+                ys[i] = y[:n]
+                times.append(Time(header['DATE-OBS']))
+                exptimes[i] = header['EXPTIME']
+        finally:
+            if pool != None:
+                pool.shutdown()
+
+        apsum = fluxes[:, :n]
+        if control_toi != None:
+            apsum = apsum - fluxes[:, n:]
+        if ensemble is not None:
+            comp = Ensemble(fluxes[:, n:], sigma = sigma)
+            print(np.count_nonzero(comp.weights == 0), ' of ', len(comp.weights), ' comparison stars rejected.')
+            apsum = comp.correct(apsum)
+        flux = apsum / exptimes[:, None]
+
+        series = []
+        for j, target in enumerate(targets):
+            rows = [{'time': times[i], 'exptime': exptimes[i], 'ra': ra[j], 'dec': dec[j], 'x': xs[i, j] * punit, 
+                     'y': ys[i, j] * punit, 'apsum': apsum[i, j] * funit, 'flux': flux[i, j] * funit,
+                     'flux_unc': 1, 'apsum_unc': 1} for i in range(nframes)]
+            ts = self.rows_to_ts(rows)
+            series.append(ts)
+            if target != None:
+                target.filters[filter] = len(target.ts)
+                target.ts.append(ts)
+        return series
+
+    def targets(self, toi):
+        '''
+        targets collects the Targets and sky coordinates to be measured by 'dorphot'.
+
+        Parameters
+        ----------
+        toi: Target, list[Target] or coordinate table
+            Targets to measure, see 'dorphot'.
+
+        Returns
+        -------
+        targets: list
+            Each Target, 'None' for the entries of a coordinate table.
+
+        coords: SkyCoord
+            Coordinates of each target.
+        '''
+        if isinstance(toi, acoord):
+            coords = toi.reshape(-1)
+            return [None] * len(coords), coords
+        if isinstance(toi, Table):
+            # columns without a unit are in degrees
+            ra, dec = [un.Quantity(toi[col], getattr(toi[col], 'unit', None) or un.deg) for col in ['ra', 'dec']]
+            coords = acoord(ra, dec)
+            return [None] * len(coords), coords
+        if not isinstance(toi, (list, tuple)):
+            toi = [toi]
+        ra = np.concatenate([np.ravel(t.coords.ra.deg) for t in toi])
+        dec = np.concatenate([np.ravel(t.coords.dec.deg) for t in toi])
+        return list(toi), acoord(ra * un.deg, dec * un.deg)
+
+    def apertures(self, w, toi, shape, matrix = None):
+        '''
+        apertures builds the photometric apertures and background annuli for one or many targets.
+
+        Parameters
+        ----------
+        w: 'astropy.wcs.WCS'
+            WCS of the frames to be measured.
+
+        toi: Target or SkyCoord
+            Target, or coordinates of the targets, to place the apertures on.
+
+        shape: float
+            Aperture radius in pixels, the annulus spans 'shape' + 2 to 'shape' + 5.
+
+        matrix: array
+            Registration transform of a frame which was not resampled, see 'Ceres.align'. The 
+            positions on the reference frame are mapped back onto the frame's native pixels. Optional.
+
+        Returns
+        -------
+        apers: list
+            The CircularAperture and CircularAnnulus, holding one position per target.
+        '''
+        coords = getattr(toi, 'coords', toi)
+        x, y = w.wcs_world2pix(np.ravel(coords.ra.deg), np.ravel(coords.dec.deg), 1)
+        if matrix is not None:
+            x, y, _ = np.linalg.solve(matrix, np.vstack([x, y, np.ones(len(x))]))
         # pos = Table(names=['x_0', 'y_0'], data = ([float(xy[0])], [float(xy[1])]))
-        pos = [(float(xy[0]), float(xy[1]))]
+        pos = np.transpose([x, y]).astype(np.float64)
         aperture = CircularAperture(pos, r = shape)
         annulus_aperture = CircularAnnulus(pos, r_in = shape + 2, r_out = shape + 5)
-        apers = [aperture, annulus_aperture]
+        return [aperture, annulus_aperture]
 
-        if control_toi != None:
-            xyc = w.wcs_world2pix(control_toi.coords.ra.deg, control_toi.coords.dec.deg, 1)
-            # posc = Table(names=['x_0', 'y_0'], data = ([float(xyc[0])], [float(xyc[1])]))
-            posc = [(float(xyc[0]), float(xyc[1]))]
-            aperturec = CircularAperture(posc, r = shape)
-            annulus_aperturec = CircularAnnulus(posc, r_in = shape + 2, r_out = shape + 5)
-            apersc = [aperturec, annulus_aperturec]
+    def measure(self, image, apers, unc = 0.1):
+        '''
+        measure finds the background subtracted aperture sum at every position of the apertures with 
+        a single 'aperture_photometry' call.
+
+        Parameters
+        ----------
+        image: CCDdata
+            Frame to measure.
+
+        apers: list
+            Apertures and annuli, see 'apertures'.
+
+        unc: float
+            Fractional pixel uncertainty. Default is 0.1. Optional.
+
+        Returns
+        -------
+        flux: Quantity
+            Background subtracted aperture sum of each position.
+
+        x, y: Quantity
+            Pixel position of each aperture.
+        '''
+        aperture, annulus_aperture = apers
+        # photutils takes the error of a CCDData from its uncertainty, frames calibrated by the
+        # Calibrator carry none so the fractional pixel uncertainty is attached to a view of the 
+        # frame, leaving the stack's own frame untouched
+        if image.uncertainty is None:
+            image = CCDData(image.data, unit = image.unit, mask = image.mask, wcs = image.wcs,
+                            uncertainty = StdDevUncertainty(unc * image.data))
+        results = aperture_photometry(image, apers)
+        bkg_mean = results['aperture_sum_1'] / annulus_aperture.area
+        bkg_sum = bkg_mean * aperture.area
+        return results['aperture_sum_0'] - bkg_sum, results['xcenter'], results['ycenter']
+
+    def phot_frame(self, image, toi, apers, apersc = None, unc = 0.1):
+        '''
+        phot_frame performs background subtracted aperture photometry on a single frame, the 
+        per-frame step of 'dorphot'.
+
+        Parameters
+        ----------
+        image: CCDdata
+            Frame to measure.
+
+        toi: Target
+            Target being measured.
+
+        apers: list
+            Aperture and annulus of the target, see 'apertures'.
+
+        apersc: list
+            Aperture and annulus of the control target for differential photometry. Optional.
+
+        unc: float
+            Fractional pixel uncertainty. Default is 0.1. Optional.
+
+        Returns
+        -------
+        row: dict
+            Light curve values of the frame.
+        '''
+        flux, x, y = self.measure(image, apers, unc)
+        row = {'time': Time(image.header['DATE-OBS']), 'exptime': image.header['EXPTIME'],
+               'ra': toi.coords.ra.deg, 'dec': toi.coords.dec.deg, 'x': x[0], 'y': y[0]}
+        # x.append(results['x_fit'][0])
+        # y.append(results['y_fit'][0])
+
+        row['apsum'] = flux[0]
+        if apersc != None:
+            row['apsum'] = flux[0] - self.measure(image, apersc, unc)[0][0]
+        row['flux'] = row['apsum'] / image.header['EXPTIME']
+
+        row['flux_unc'] = 1 ## TODO:: modify this to account for exposure time and control
+        row['apsum_unc'] = 1
+        return row
+
+    def rows_to_ts(self, rows):
+        '''
+        rows_to_ts collects per-frame photometry rows, see 'phot_frame', into a timeSeries.
+        '''
+        cols = {}
+        for key in ['time', 'flux', 'exptime', 'x', 'y', 'ra', 'dec', 'flux_unc', 'apsum', 'apsum_unc']:
+            cols[key] = [row[key] for row in rows]
+        return timeSeries(times = cols['time'], flux = cols['flux'], exptimes = cols['exptime'], x = cols['x'], y = cols['y'], 
+                          ra = cols['ra'], dec = cols['dec'], flux_unc = cols['flux_unc'], apsum = cols['apsum'], apsum_unc = cols['apsum_unc'])
+
+    def stream(self, filter, filer, toi, control_toi = None, shape = 21, unc = 0.1, calibrate = True, align = True, getWCS = True, cache = True, resample = True, translation = False):
+        '''
+        stream is a generator which pushes each frame of a stack through calibration, registration
+        and photometry before the next frame is loaded, yielding one light curve row per frame. Only
+        the reference frame and the frame being processed are held in memory, and no processed frames
+        are kept, so memory use does not grow with the length of the night. Each step is the same
+        per-frame step used by 'calibrate', 'align' and 'dorphot', so the rows match the batch path.
+
+        Parameters
+        ----------
+        filter: str
+            Filter of the stack to process.
 
+        filer: Filer instance
+            Active instance of Filer, used for plate solving.
 
-        times = []
-        exptimes = []
-        ray = []
-        decx = []
-        x = []
-        y = []
-        flux = []
-        fluxunc = []
-        apsum = []
-        apsum_unc = []
+        toi: Target
+            Target to measure.
 
+        control_toi: Target
+            Control target for differential photometry. Optional.
 
-        print('Performing photometry')
-        for image in tqdm(stack.data, colour = 'green'):
-            error = unc * image.data
-            results = aperture_photometry(image, apers, error = error)
-            bkg_mean = results['aperture_sum_1'] / annulus_aperture.area
-            bkg_sum = bkg_mean * aperture.area
-            results['flux_fit'] = results['aperture_sum_0'] - bkg_sum
-            
-            times.append(Time(image.header['DATE-OBS']))
-            exptimes.append(image.header['EXPTIME'])
-            ray.append(ra)
-            decx.append(dec)
-            x.append(results['xcenter'][0])
-            y.append(results['ycenter'][0])
-            # x.append(results['x_fit'][0])
-            # y.append(results['y_fit'][0])
-
-            if control_toi != None:
-                resultsc = aperture_photometry(image, apersc, error = error)
-                bkg_meanc = resultsc['aperture_sum_1'] / annulus_aperturec.area
-                bkg_sumc = bkg_meanc * aperturec.area
-                resultsc['flux_fit'] = resultsc['aperture_sum_0'] - bkg_sumc
-
-                apsum.append(results['flux_fit'][0] - resultsc['flux_fit'][0])
-                flux.append((results['flux_fit'][0] - resultsc['flux_fit'][0])/image.header['EXPTIME'])
-            else:
-                apsum.append(results['flux_fit'][0])
-                flux.append(results['flux_fit'][0]/image.header['EXPTIME'])
+        shape: float
+            Aperture radius in pixels. Default is 21. Optional.
+
+        unc: float
+            Fractional pixel uncertainty. Default is 0.1. Optional.
+
+        calibrate, align: Boolean
+            Whether to calibrate and align each frame. Default is 'True'. Optional.
+
+        getWCS: Boolean
+            Whether to plate solve the reference frame, otherwise the stack WCS is used. Default is 'True'. Optional.
+
+        cache: Boolean
+            Whether to use the plate solution cache. Default is 'True'. Optional.
 
-            fluxunc.append(1) ## TODO:: modify this to account for exposure time and control
-            apsum_unc.append(1)
+        resample: Boolean
+            Whether to resample each frame onto the reference frame, otherwise the apertures are 
+            mapped onto the frame's native pixels through its transform. Default is 'True'. Optional.
 
-        ts = timeSeries(times = times, flux = flux, exptimes = exptimes, x = x, y = y, ra = ray, dec = decx, flux_unc = fluxunc, apsum = apsum, apsum_unc = apsum_unc)
+        translation: Boolean
+            Whether to register frames as a pure translation by FFT cross-correlation, see 'align'. Default is 'False'. Optional.
+
+        Yields
+        ------
+        row: dict
+            Light curve values of each frame, skipped frames yield no row.
+        '''
+        stack = self.data[self.filters[filter]]
+        calibrator = Calibrator(self.bias, stack.flat)
+        toalign = stack.frame(stack.alignTo)
+        if calibrate:
+            toalign = self.calibrate_frame(toalign, calibrator)
+        if getWCS:
+            result = filer.solveWCS(toalign, cache = cache)
+            if result == None:
+                print('No WCS found for filter ', filter)
+            else:
+                solved, wcs_header = result
+                stack.wcs = WCS(wcs_header)
+                stack.solved = solved
+                if solved != None:
+                    toalign = solved
+        if stack.wcs == None:
+            raise Exception('Stack has no WCS, photometry requires a plate solution.')
+        if align:
+            toalign = Registrar(toalign, max_control_points = 100, detection_sigma = 6, translation = translation)
+        apers = self.apertures(stack.wcs, toi, shape)
+        apersc = None
+        if control_toi != None:
+            apersc = self.apertures(stack.wcs, control_toi, shape)
+
+        for image in tqdm(stack.frames(), total = len(stack.data), colour = 'green'):
+            if calibrate:
+                image = self.calibrate_frame(image, calibrator)
+            if align:
+                try:
+                    image, matrix = self.align_frame(image, toalign, resample)
+                except RegistrationError:
+                    continue
+                if not resample:
+                    apers = self.apertures(stack.wcs, toi, shape, matrix)
+                    if control_toi != None:
+                        apersc = self.apertures(stack.wcs, control_toi, shape, matrix)
+            yield self.phot_frame(image, toi, apers, apersc, unc)
+            del image
+
+    def pipeline(self, filter, filer, toi, control_toi = None, shape = 21, unc = 0.1, calibrate = True, align = True, getWCS = True, cache = True, resample = True, translation = False, fname = None):
+        '''
+        pipeline runs 'stream' over a stack, appending each light curve row to a CSV file in the 
+        working directory as soon as the frame is measured, and adds the resulting timeSeries to 
+        the target as 'dorphot' does. See 'stream' for the parameters.
+
+        Parameters
+        ----------
+        fname: str
+            Name of the CSV file written in the nights working directory. Default is 
+            '<target>_<filter>-<mjd>.csv'. Optional.
+
+        Returns
+        -------
+        path: path-like
+            Location of the CSV file.
+        '''
+        filer.mkwrk(self)
+        if fname == None:
+            fname = str(toi.name) + '_' + str(filter) + '-' + str(int(self.date.mjd)) + '.csv'
+        path = filer.dordir / 'data' / 'wrk' / self.datestr / fname
+        keys = ['time', 'flux', 'flux_unc', 'exptime', 'apsum', 'apsum_unc', 'x', 'y', 'ra', 'dec']
+        rows = []
+        print('Processing stream')
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(keys)
+            for row in self.stream(filter, filer, toi, control_toi, shape, unc, calibrate, align, getWCS, cache, resample, translation):
+                # quantities are written as plain values, units are those of the timeSeries
+                writer.writerow([row['time'].isot] + [getattr(row[key], 'value', row[key]) for key in keys[1:]])
+                f.flush()
+                rows.append(row)
+
+        ts = self.rows_to_ts(rows)
         toi.filters[filter] = len(toi.ts)
         toi.ts.append(ts)
-
+        return path
+
+
+# process pool alignment workers, see Ceres.align_pool
+_align_ref = {}
+
+def _align_init(name, shape, dtype, outdtype, resample = True, translation = False):
+    shm = shared_memory.SharedMemory(name = name)
+    _align_ref['shm'] = shm
+    _align_ref['data'] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = shm.buf)
+    _align_ref['dtype'] = np.dtype(outdtype)
+    _align_ref['resample'] = resample
+    _align_ref['registrar'] = Registrar(_align_ref['data'], max_control_points = 100, detection_sigma = 6, translation = translation)
+
+def _align_task(task):
+    source, outname = task
+    ref = _align_ref['data']
+    try:
+        if source[0] == 'path':
+            data = fits.getdata(source[1], imagehdu(source[1]))
+        else:
+            shm = shared_memory.SharedMemory(name = source[1])
+            data = np.ndarray(source[2], dtype = np.dtype(source[3]), buffer = shm.buf).copy()
+            shm.close()
+        # FITS files are big-endian, which the resampling rejects
+        data = data.astype(data.dtype.newbyteorder('='), copy = False)
+        if not _align_ref['resample']:
+            transform, _ = _align_ref['registrar'].find_transform(data)
+            return transform.params
+        img, transform = _align_ref['registrar'].register(data)
+    except RegistrationError:
+        return None
+    out = shared_memory.SharedMemory(name = outname)
+    np.ndarray(ref.shape, dtype = _align_ref['dtype'], buffer = out.buf)[:] = img
+    out.close()
+    return transform.params
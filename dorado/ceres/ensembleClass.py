@@ -0,0 +1,122 @@
+import numpy as np
+
+__all__ = ['Ensemble']
+
+'''
+'dorado.ceres.ensemble' holds the Ensemble class, the artificial comparison star engine used for
+differential photometry by Ceres.
+'''
+
+
+class Ensemble:
+    '''
+    The Ensemble class builds an artificial comparison star from the light curves of many comparison
+    stars. Each star is normalized by its median flux, and the artificial star is the weighted mean of
+    the normalized curves, following the transparency and airmass changes common to the field. Each
+    star is weighted by the inverse variance of its curve relative to the rest of the ensemble, points
+    beyond 'sigma' robust deviations are rejected, and stars which scatter more than the ensemble 
+    stars of their brightness, such as variables, are dropped. Every step is an array operation over all frames and
+    stars at once, so adding stars costs memory bandwidth rather than Python iterations.
+
+    Attributes
+    ----------
+
+    fluxes: array
+        Aperture sums of the comparison stars, one row per frame and one column per star.
+
+    sigma: float
+        Rejection threshold in robust standard deviations, for both points and stars. Default is 3. Optional.
+
+    maxiters: int
+        Maximum number of rejection iterations, at least 1. Default is 5. Optional.
+
+    comparison: array
+        Normalized flux of the artificial comparison star in each frame.
+
+    weights: array
+        Normalized weight of each star, zero for rejected stars.
+
+    scatter: array
+        Robust standard deviation of each star's normalized curve relative to the rest of the ensemble.
+
+    mask: array[bool]
+        Rejected points, of the same shape as 'fluxes'.
+
+    '''
+    def __init__(self, fluxes, sigma = 3, maxiters = 5):
+        if maxiters < 1:
+            raise Exception('Ensemble needs at least one iteration to weight the comparison stars, maxiters is ' + str(maxiters))
+        self.fluxes = np.atleast_2d(np.asarray(fluxes, dtype = np.float64))
+        self.sigma = sigma
+        self.maxiters = maxiters
+        self.fit()
+
+    def fit(self):
+        '''
+        fit iteratively weights the comparison stars and rejects outlying points and stars.
+        '''
+        fluxes = self.fluxes
+        valid = np.isfinite(fluxes) & (fluxes > 0)
+        if not valid.any():
+            raise Exception('Ensemble has no valid comparison star measurements.')
+        level = np.nanmedian(np.where(valid, fluxes, np.nan), axis = 0)
+        norm = np.where(valid, fluxes / np.where(np.isfinite(level), level, 1), 0)
+
+        keep = valid.copy()
+        stars = np.any(valid, axis = 0)
+        weights = stars.astype(np.float64)
+        for _ in range(self.maxiters):
+            w = keep * weights
+            num = np.sum(w * norm, axis = 1, keepdims = True)
+            den = np.sum(w, axis = 1, keepdims = True)
+            # each star is compared with the ensemble without itself
+            others = np.divide(num - w * norm, den - w, out = np.full(norm.shape, np.nan), where = (den - w) > 0)
+            dev = np.where(valid & np.isfinite(others), norm / np.where(np.isfinite(others), others, 1) - 1, np.nan)
+            scatter = 1.4826 * np.nanmedian(np.abs(np.where(keep, dev, np.nan)), axis = 0)
+
+            newkeep = valid & (np.abs(np.nan_to_num(dev, nan = np.inf)) <= self.sigma * scatter)
+            good = stars & np.isfinite(scatter) & (scatter > 0)
+            if np.count_nonzero(good) < 3:
+                # too few stars to judge against each other, they are averaged as they are
+                weights = stars.astype(np.float64)
+                break
+            # fainter stars scatter more, so each star is judged against the scatter of stars of its brightness
+            logs = np.log(np.where(good, scatter, 1))
+            fit = np.polyval(np.polyfit(np.log(level[good]), logs[good], 1), np.log(np.where(good, level, 1)))
+            resid = logs - fit
+            center = np.median(resid[good])
+            spread = 1.4826 * np.median(np.abs(resid[good] - center))
+            newstars = good & (resid <= center + self.sigma * max(spread, np.finfo(np.float64).eps))
+            weights = np.where(newstars, 1 / np.where(good, scatter, 1)**2, 0)
+            if np.array_equal(newkeep, keep) and np.array_equal(newstars, stars):
+                break
+            keep = newkeep
+            stars = newstars
+
+        w = keep * weights
+        den = np.sum(w, axis = 1)
+        self.comparison = np.divide(np.sum(w * norm, axis = 1), den, out = np.full(len(norm), np.nan), where = den > 0)
+        self.weights = weights / np.sum(weights)
+        self.scatter = scatter
+        self.mask = ~keep | ~stars
+        return self.comparison
+
+    def correct(self, fluxes):
+        '''
+        correct divides target fluxes by the artificial comparison star, removing the variations common
+        to the field while keeping the targets' own flux scale.
+
+        Parameters
+        ----------
+        fluxes: array
+            Target fluxes, one row per frame and optionally one column per target.
+
+        Returns
+        -------
+        corrected: array
+            The differential fluxes, 'nan' in frames where no comparison star survived.
+        '''
+        fluxes = np.asarray(fluxes)
+        if fluxes.ndim == 2:
+            return fluxes / self.comparison[:, None]
+        return fluxes / self.comparison
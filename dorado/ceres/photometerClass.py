@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+__all__ = ['Photometer']
+
+'''
+'dorado.ceres.photometer' holds the Photometer class, the precomputed aperture photometry engine
+used by Ceres.
+'''
+
+
+class Photometer:
+    '''
+    The Photometer class measures background subtracted aperture sums with precomputed aperture
+    weights. 'aperture_photometry' builds the exact overlap mask of every aperture and annulus anew for
+    each frame, although the positions on a stack resampled onto the reference grid never change. The
+    Photometer computes the exact masks once and holds them as the rows of a single sparse matrix, so
+    measuring a frame is one sparse matrix-vector product followed by a few array operations. The
+    background is the annulus mean scaled to the aperture area, as in 'Ceres.measure'.
+
+    Attributes
+    ----------
+
+    apers: list
+        Apertures and annuli, see 'Ceres.apertures'.
+
+    shape: tuple
+        Shape of the frames to be measured.
+
+    weights: 'scipy.sparse.csr_matrix'
+        Exact overlap weights of each aperture followed by each annulus, one row each, over the
+        flattened frame.
+
+    positions: array
+        (x, y) pixel position of each aperture.
+
+    '''
+    def __init__(self, apers, shape):
+        aperture, annulus_aperture = apers
+        self.apers = apers
+        self.shape = tuple(shape)
+        self.positions = np.atleast_2d(aperture.positions)
+        self.aperture_area = aperture.area
+        self.annulus_area = annulus_aperture.area
+        n = len(self.positions)
+        rows = []
+        cols = []
+        vals = []
+        for k, aper in enumerate(apers):
+            masks = aper.to_mask(method = 'exact')
+            if not isinstance(masks, list):
+                masks = [masks]
+            for i, mask in enumerate(masks):
+                large, small = mask.get_overlap_slices(self.shape)
+                if large is None:
+                    # no overlap with the frame
+                    continue
+                yy, xx = np.mgrid[large]
+                w = mask.data[small]
+                keep = w > 0
+                rows.append(np.full(np.count_nonzero(keep), k * n + i))
+                cols.append(np.ravel_multi_index((yy[keep], xx[keep]), self.shape))
+                vals.append(w[keep])
+        if len(rows) == 0:
+            rows, cols, vals = [np.zeros(0, dtype = int)], [np.zeros(0, dtype = int)], [np.zeros(0)]
+        self.weights = csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                  shape = (2 * n, int(np.prod(self.shape))))
+
+    def sums(self, data):
+        '''
+        sums returns the weighted sum of a frame in every aperture followed by every annulus.
+        '''
+        data = np.asarray(data)
+        if data.shape != self.shape:
+            raise Exception('Frame shape ' + str(data.shape) + ' does not match the apertures ' + str(self.shape))
+        return self.weights @ np.ravel(data)
+
+    def measure(self, data):
+        '''
+        measure finds the background subtracted aperture sum at every position.
+
+        Parameters
+        ----------
+        data: array
+            Pixel data of the frame.
+
+        Returns
+        -------
+        flux: array
+            Background subtracted aperture sum of each position.
+        '''
+        sums = self.sums(data)
+        n = len(self.positions)
+        return sums[:n] - sums[n:] / self.annulus_area * self.aperture_area
@@ -0,0 +1,260 @@
+import numpy as np
+import astroalign as aa
+from scipy.spatial import KDTree
+from skimage.transform import matrix_transform, SimilarityTransform
+
+__all__ = ['Registrar', 'RegistrationError']
+
+'''
+'dorado.ceres.registrar' holds the Registrar class, which registers frames onto a fixed
+reference frame for Ceres.
+'''
+
+
+class RegistrationError(Exception):
+    '''
+    RegistrationError is raised when no transform onto the reference frame can be found for a 
+    frame, for example when too few sources are detected or no asterisms match. Ceres skips such
+    frames, any other error is a genuine failure.
+    '''
+
+
+class Registrar:
+    '''
+    The Registrar class finds the transform from frames onto a single reference frame.
+    'astroalign.find_transform' detects the reference sources and builds their triangle
+    invariants and KD-tree on every call, although they never change during the alignment of a
+    stack. The Registrar does that work once and reuses it for every frame, so each search only
+    pays for the moving frame. The search itself is that of 'astroalign.find_transform'. Should
+    the astroalign internals it relies on be unavailable, or fail as their signatures change, it
+    falls back to the public 'astroalign.find_transform' against the reference frame, searching
+    anew for every frame.
+
+    Stacks from a well tracking mount drift by little more than a translation, for which the 
+    Registrar offers FFT cross-correlation in place of the asterism search ('translation = True').
+    The windowed Fourier transform of the reference is kept, so each frame costs one forward and two
+    inverse FFTs, after which the correlation peak is refined to a fraction of a pixel with a
+    matrix multiply upsampled DFT about the peak. Frames whose phase correlation peak is weaker than
+    'min_peak', such as frames which rotated or lost the field, fall back to the asterism search.
+
+    Attributes
+    ----------
+
+    reference: array
+        Pixel data of the reference frame.
+
+    max_control_points: int
+        Maximum number of sources used in each frame. Default is 100. Optional.
+
+    detection_sigma: float
+        Source detection threshold in standard deviations of the background. Default is 6. Optional.
+
+    min_area: int
+        Minimum number of pixels of a source. Default is 5. Optional.
+
+    translation: Boolean
+        Whether to register frames by phase correlation as a pure translation. Default is 'False'. Optional.
+
+    min_peak: float
+        Minimum height of the phase correlation peak, between 0 and 1, below which a frame falls back to 
+        the asterism search. Default is 0.1. Optional.
+
+    upsample: int
+        Subpixel refinement factor of the phase correlation peak, shifts are found to 1 / 'upsample' 
+        pixels. Default is 20. Optional.
+
+    controlp: array
+        (x, y) positions of the reference sources, 'None' when falling back to 'astroalign.find_transform'.
+
+    '''
+    def __init__(self, reference, max_control_points = 100, detection_sigma = 6, min_area = 5, translation = False, 
+                 min_peak = 0.1, upsample = 20):
+        self.reference = np.asarray(getattr(reference, 'data', reference))
+        self.max_control_points = max_control_points
+        self.detection_sigma = detection_sigma
+        self.min_area = min_area
+        self.translation = translation
+        self.min_peak = min_peak
+        self.upsample = upsample
+        if translation:
+            self.window = np.outer(np.hanning(self.reference.shape[0]), np.hanning(self.reference.shape[1]))
+            self.reference_fft = np.conj(np.fft.fft2(self.taper(self.reference)))
+        self.cached = True
+        try:
+            self.controlp = aa._find_sources(aa._bw(self.reference), detection_sigma = detection_sigma,
+                                             min_area = min_area)[:max_control_points]
+            self.invariants, self.asterisms = aa._generate_invariants(self.controlp)
+            self.tree = KDTree(self.invariants)
+            self.pixel_tol = aa.PIXEL_TOL
+            self.min_fraction = aa.MIN_MATCHES_FRACTION
+        except (AttributeError, TypeError, ValueError):
+            # private astroalign interface changed, only the public search is left
+            self.cached = False
+            self.controlp = None
+
+    def sources(self, image):
+        '''
+        sources detects the control points of a frame as 'astroalign.find_transform' does.
+        '''
+        return aa._find_sources(aa._bw(np.asarray(image)), detection_sigma = self.detection_sigma,
+                                min_area = self.min_area)[:self.max_control_points]
+
+    def taper(self, image):
+        '''
+        taper removes the background level of a frame and applies the window, so the frame edges 
+        do not correlate.
+        '''
+        image = np.asarray(image, dtype = np.float64)
+        return (image - np.median(image)) * self.window
+
+    def phase_correlate(self, image):
+        '''
+        phase_correlate finds the translation of a frame from the reference frame.
+
+        Parameters
+        ----------
+        image: array
+            Pixel data of the frame.
+
+        Returns
+        -------
+        shift: array
+            (x, y) shift of the frame's content from the reference frame in pixels.
+
+        peak: float
+            Height of the phase correlation peak, near 0 for no match and higher the more of the 
+            frame agrees with the translated reference.
+        '''
+        cross = np.fft.fft2(self.taper(image)) * self.reference_fft
+        corr = np.fft.ifft2(cross).real
+        peak = np.unravel_index(np.argmax(corr), corr.shape)
+        # the whitened (phase only) correlation at the peak measures how much of the spectrum agrees
+        height = np.fft.ifft2(cross / np.maximum(np.abs(cross), np.finfo(np.float64).tiny)).real[peak]
+        shape = np.array(corr.shape)
+        shift = np.array(peak, dtype = np.float64)
+        shift[shift > shape // 2] -= shape[shift > shape // 2]
+
+        # upsampled DFT of the correlation over +-0.75 pixels about the peak
+        size = int(np.ceil(1.5 * self.upsample))
+        offsets = (np.arange(size) - size // 2) / self.upsample
+        freqs = [np.fft.fftfreq(n, 1 / n) for n in corr.shape]
+        rows = np.exp(2j * np.pi * np.outer(shift[0] + offsets, freqs[0]) / corr.shape[0])
+        cols = np.exp(2j * np.pi * np.outer(freqs[1], shift[1] + offsets) / corr.shape[1])
+        fine = (rows @ cross @ cols).real
+        sub = np.unravel_index(np.argmax(fine), fine.shape)
+        shift = shift + offsets[list(sub)]
+        return shift[::-1], height
+
+    def find_transform(self, image):
+        '''
+        find_transform finds the similarity transform mapping a frame onto the reference frame.
+
+        Parameters
+        ----------
+        image: array
+            Pixel data of the frame.
+
+        Returns
+        -------
+        transform: 'skimage.transform.SimilarityTransform'
+            Transform from the frame's pixel coordinates to the reference frame's.
+
+        matches: tuple
+            Matched (x, y) control points in the frame and in the reference frame, 'None' for a
+            frame registered by phase correlation.
+
+        Raises
+        ------
+        RegistrationError
+            If no transform can be found.
+        '''
+        if self.translation:
+            shift, peak = self.phase_correlate(image)
+            if peak >= self.min_peak:
+                return SimilarityTransform(translation = -shift), None
+        if self.cached:
+            try:
+                return self.search(image)
+            except (AttributeError, TypeError, ValueError, IndexError):
+                # private astroalign interface changed, only the public search is left
+                self.cached = False
+        return self.public_search(image)
+
+    def public_search(self, image):
+        '''
+        public_search finds the transform with the public 'astroalign.find_transform', see 'find_transform'.
+        '''
+        try:
+            return aa.find_transform(image, self.reference, max_control_points = self.max_control_points,
+                                     detection_sigma = self.detection_sigma, min_area = self.min_area)
+        except (aa.MaxIterError, ValueError) as e:
+            raise RegistrationError(str(e)) from e
+
+    def search(self, image):
+        '''
+        search finds the transform from the cached reference sources with the astroalign internals,
+        see 'find_transform'.
+        '''
+        source_controlp = self.sources(image)
+        target_controlp = self.controlp
+        if len(source_controlp) < 3:
+            raise RegistrationError('Reference stars in source image are less than the minimum value (3).')
+        if len(target_controlp) < 3:
+            raise RegistrationError('Reference stars in target image are less than the minimum value (3).')
+
+        source_invariants, source_asterisms = aa._generate_invariants(source_controlp)
+        source_tree = KDTree(source_invariants)
+        matches_list = source_tree.query_ball_tree(self.tree, r = 0.1)
+        matches = []
+        for t1, t2_list in zip(source_asterisms, matches_list):
+            for t2 in self.asterisms[t2_list]:
+                matches.append(list(zip(t1, t2)))
+        matches = np.array(matches)
+
+        inv_model = aa._MatchTransform(source_controlp, target_controlp)
+        n_invariants = len(matches)
+        min_matches = max(1, min(10, int(n_invariants * self.min_fraction)))
+        if (len(source_controlp) == 3 or len(target_controlp) == 3) and len(matches) == 1:
+            best_t = inv_model.fit(matches)
+            inlier_ind = np.arange(len(matches))
+        else:
+            if len(matches) == 0:
+                raise RegistrationError('No asterism of the frame matches the reference frame.')
+            try:
+                best_t, inlier_ind = aa._ransac(matches, inv_model, self.pixel_tol, min_matches)
+            except aa.MaxIterError as e:
+                raise RegistrationError(str(e)) from e
+
+        # keep the lowest error target of each source point, as astroalign does
+        triangle_inliers = matches[inlier_ind]
+        d1, d2, d3 = triangle_inliers.shape
+        inl_unique = set(tuple(pair) for pair in triangle_inliers.reshape(d1 * d2, d3))
+        inl_dict = {}
+        for s_i, t_i in inl_unique:
+            t_vertex_pred = matrix_transform(source_controlp[s_i], best_t.params)
+            error = np.linalg.norm(t_vertex_pred - target_controlp[t_i])
+            if s_i not in inl_dict or (error < inl_dict[s_i][1]):
+                inl_dict[s_i] = (t_i, error)
+        s, d = np.array([[s_i, t_i] for s_i, (t_i, e) in inl_dict.items()]).T
+        return best_t, (source_controlp[s], target_controlp[d])
+
+    def register(self, image):
+        '''
+        register resamples a frame onto the reference frame's pixel grid.
+
+        Parameters
+        ----------
+        image: array
+            Pixel data of the frame.
+
+        Returns
+        -------
+        aligned: array
+            The resampled frame.
+
+        transform: 'skimage.transform.SimilarityTransform'
+            Transform from the frame's pixel coordinates to the reference frame's.
+        '''
+        transform, _ = self.find_transform(image)
+        aligned, _ = aa.apply_transform(transform, image, self.reference)
+        return aligned, transform
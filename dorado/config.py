@@ -0,0 +1,31 @@
+import numpy as np
+from astropy import config as _config
+
+__all__ = ['conf', 'working_dtype']
+
+'''
+'dorado.config' holds the Dorado configuration. Items can be changed for a session, for example
+'dorado.conf.dtype = "float64"', or set permanently in the dorado configuration file.
+'''
+
+
+class Conf(_config.ConfigNamespace):
+    '''
+    Configuration parameters for Dorado.
+    '''
+    dtype = _config.ConfigItem(
+        'float32',
+        'Working data type of pixel data during calibration, alignment and combining. '
+        'float32 holds 16 bit camera data exactly in half the memory of float64.')
+
+conf = Conf()
+
+
+def working_dtype():
+    '''
+    working_dtype returns the configured working data type of pixel data as a 'numpy.dtype'.
+    '''
+    dtype = np.dtype(conf.dtype)
+    if dtype.kind != 'f':
+        raise Exception('The working data type must be a floating point type, not ' + str(dtype))
+    return dtype
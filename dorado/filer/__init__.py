@@ -6,4 +6,16 @@ is just an example sub-package, so it doesn't actually do anything.
 __all__ = []
 
 from .filerClass import *
-__all__ += filerClass.__all__
\ No newline at end of file
+__all__ += filerClass.__all__
+
+from .archiveClass import *
+__all__ += archiveClass.__all__
+
+from .cacheClass import *
+__all__ += cacheClass.__all__
+
+from .solverClass import *
+__all__ += solverClass.__all__
+
+from .combinerClass import *
+__all__ += combinerClass.__all__
@@ -0,0 +1,496 @@
+import os
+import sqlite3
+import math
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+from astropy.time import Time
+
+from ..stack.stackClass import imagehdu
+
+__all__ = ['Archive']
+
+'''
+'dorado.filer.archive' holds the Archive class, a header-only catalog of the frames in the
+Dorado data directory. Only FITS headers are read while indexing, pixel data is never touched.
+'''
+
+# substrings used to classify frames which lack an IMAGETYP keyword, shared with Filer.dirscan
+biasstr = ['Bias', 'bias', 'BIAS', 'Zero', 'zero', 'ZERO']
+flatsstr = ['FLAT', 'FlatField', 'flat', 'Flat', 'Flats', 'flats', 'FLATS', 'FlatFields']
+darkstr = ['Dark', 'dark', 'DARK']
+
+fitsext = ('.fits', '.fit', '.fts', '.fits.fz', '.fits.gz')
+
+
+class Archive:
+    '''
+    The Archive class keeps a SQLite index of frame metadata so frames can be selected by
+    query instead of rescanning directories and reopening every file for every reduction.
+    Each row records the frame type, filter, exposure time, observation date, binning,
+    image size, and the file size and modification time used to detect changed files.
+
+    Attributes
+    ----------
+
+    path: str or path-like
+        Location of the SQLite database file.
+
+    con: 'sqlite3.Connection'
+        Open connection to the database.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(os.fspath(path))
+        self.con.row_factory = sqlite3.Row
+        self.con.execute('''CREATE TABLE IF NOT EXISTS frames (
+                                path TEXT PRIMARY KEY,
+                                night TEXT,
+                                imagetyp TEXT,
+                                filter TEXT,
+                                exptime REAL,
+                                dateobs TEXT,
+                                mjd REAL,
+                                xbin INTEGER,
+                                ybin INTEGER,
+                                naxis1 INTEGER,
+                                naxis2 INTEGER,
+                                size INTEGER,
+                                mtime REAL)''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS frames_night ON frames (night, imagetyp, filter)')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS masters (
+                                path TEXT PRIMARY KEY,
+                                kind TEXT,
+                                mjd REAL,
+                                filter TEXT,
+                                xbin INTEGER,
+                                ybin INTEGER,
+                                exptime REAL,
+                                numsubs INTEGER,
+                                inputs TEXT)''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS masters_kind ON masters (kind, filter, mjd)')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS solutions (
+                                key TEXT PRIMARY KEY,
+                                ra REAL,
+                                dec REAL,
+                                scale REAL,
+                                header TEXT)''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS solutions_pointing ON solutions (dec, ra)')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS processed (
+                                path TEXT,
+                                stage TEXT,
+                                size INTEGER,
+                                mtime REAL,
+                                hash TEXT,
+                                PRIMARY KEY (path, stage))''')
+        self.con.commit()
+
+    def classify(self, header, path):
+        '''
+        classify determines whether a frame is a bias, dark, flat, or light frame. The
+        IMAGETYP header keyword is used when present, otherwise the file and directory
+        names are matched against the same substrings used by 'Filer.dirscan'.
+
+        Parameters
+        ----------
+        header: 'astropy.io.fits.Header'
+            Header of the frame.
+
+        path: str or path-like
+            Location of the frame.
+
+        Returns
+        -------
+        imagetyp: str
+            One of 'bias', 'dark', 'flat', or 'light'.
+        '''
+        typ = str(header.get('IMAGETYP', '')).lower()
+        if ('bias' in typ) or ('zero' in typ):
+            return 'bias'
+        if 'dark' in typ:
+            return 'dark'
+        if 'flat' in typ:
+            return 'flat'
+        if typ != '':
+            return 'light'
+        name = os.fspath(path)
+        for s in biasstr:
+            if s in name:
+                return 'bias'
+        for s in darkstr:
+            if s in name:
+                return 'dark'
+        for s in flatsstr:
+            if s in name:
+                return 'flat'
+        return 'light'
+
+    def describe(self, path, root):
+        '''
+        describe reads the header of a single frame and builds its index row.
+
+        Parameters
+        ----------
+        path: str or path-like
+            Location of the frame.
+
+        root: str or path-like
+            Directory holding the nights, the first directory below it names the night.
+
+        Returns
+        -------
+        row: tuple
+            Values for each column of the frames table.
+        '''
+        stat = os.stat(path)
+        header = fits.getheader(path, imagehdu(path))
+        night = Path(path).relative_to(root).parts[0]
+        try:
+            mjd = Time(header['DATE-OBS'], format = 'fits').mjd
+        except:
+            mjd = None
+        return (os.fspath(path), night, self.classify(header, Path(path).relative_to(root)),
+                header.get('FILTER'), header.get('EXPTIME'), header.get('DATE-OBS'), mjd,
+                header.get('XBINNING', 1), header.get('YBINNING', 1), header.get('NAXIS1'),
+                header.get('NAXIS2'), stat.st_size, stat.st_mtime)
+
+    def index(self, root, path = None, workers = None):
+        '''
+        index walks a directory and records the header metadata of every FITS file within it.
+        Files whose size and modification time are unchanged since they were last indexed are
+        not reopened, and rows for files that no longer exist are removed.
+
+        Parameters
+        ----------
+        root: str or path-like
+            Directory holding the nights, usually 'data/raw'.
+
+        path: str or path-like
+            Subdirectory of 'root' to index, such as a single night. Default is all of 'root'. Optional.
+
+        workers: int
+            Number of threads reading headers. Optional.
+
+        Returns
+        -------
+        count: int
+            Number of frames (re)indexed.
+        '''
+        root = Path(root)
+        if path == None:
+            path = root
+        prefix = os.path.join(os.fspath(path), '')
+        known = {}
+        for row in self.con.execute('SELECT path, size, mtime FROM frames WHERE substr(path, 1, ?) = ?', (len(prefix), prefix)):
+            known[row['path']] = (row['size'], row['mtime'])
+
+        seen = set()
+        stale = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for name in sorted(filenames):
+                if name.startswith('.') or not name.lower().endswith(fitsext):
+                    continue
+                fpath = os.path.join(dirpath, name)
+                seen.add(fpath)
+                stat = os.stat(fpath)
+                if known.get(fpath) != (stat.st_size, stat.st_mtime):
+                    stale.append(fpath)
+
+        rows = []
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            for fpath, row in zip(stale, pool.map(lambda p: self._attempt(p, root), stale)):
+                if row == None:
+                    print('Failed to index ', fpath)
+                else:
+                    rows.append(row)
+
+        self.con.executemany('INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        gone = [(p,) for p in known if p not in seen]
+        self.con.executemany('DELETE FROM frames WHERE path = ?', gone)
+        self.con.commit()
+        return len(rows)
+
+    def _attempt(self, path, root):
+        try:
+            return self.describe(path, root)
+        except Exception:
+            return None
+
+    def select(self, night = None, imagetyp = None, filter = None, exptime = None, binning = None):
+        '''
+        select queries the index for frames matching the given constraints. Constraints
+        left as None are not applied.
+
+        Parameters
+        ----------
+        night: str
+            Night directory name, such as '2021-01-02+03'. Optional.
+
+        imagetyp: str
+            One of 'bias', 'dark', 'flat', or 'light'. Optional.
+
+        filter: str
+            Filter name as recorded in the FILTER header keyword. Optional.
+
+        exptime: float
+            Exposure time in seconds. Optional.
+
+        binning: int or tuple
+            Binning factor, or (xbin, ybin). Optional.
+
+        Returns
+        -------
+        rows: list['sqlite3.Row']
+            Matching rows ordered by path, columns are accessible by name.
+        '''
+        clauses = []
+        values = []
+        for column, value in (('night', night), ('imagetyp', imagetyp), ('filter', filter), ('exptime', exptime)):
+            if value != None:
+                clauses.append(column + ' = ?')
+                values.append(value)
+        if binning != None:
+            if not isinstance(binning, tuple):
+                binning = (binning, binning)
+            clauses.append('xbin = ? AND ybin = ?')
+            values.extend(binning)
+        query = 'SELECT * FROM frames'
+        if len(clauses) != 0:
+            query = query + ' WHERE ' + ' AND '.join(clauses)
+        return self.con.execute(query + ' ORDER BY path', values).fetchall()
+
+    def add_master(self, path, kind, mjd, filter = None, binning = (1, 1), exptime = None, numsubs = None, inputs = None):
+        '''
+        add_master records a combined calibration frame in the calibration library.
+
+        Parameters
+        ----------
+        path: str or path-like
+            Location of the master frame.
+
+        kind: str
+            Type of master frame, such as 'bias' or 'flat'.
+
+        mjd: float
+            Modified julian date of the master frame.
+
+        filter: str
+            Filter of the master frame. Optional.
+
+        binning: tuple
+            (xbin, ybin) of the master frame. Default is (1, 1). Optional.
+
+        exptime: float
+            Exposure time of the input frames. Optional.
+
+        numsubs: int
+            Number of frames combined into the master. Optional.
+
+        inputs: str
+            Fingerprint of the input frames, see 'Filer.fingerprint'. Optional.
+
+        Returns
+        -------
+        None
+        '''
+        self.con.execute('INSERT OR REPLACE INTO masters VALUES (?,?,?,?,?,?,?,?,?)',
+                         (os.fspath(path), kind, mjd, filter, binning[0], binning[1], exptime, numsubs, inputs))
+        self.con.commit()
+
+    def index_masters(self, directory, kind):
+        '''
+        index_masters registers master frames already on disk, such as those written before
+        the calibration library existed. Only the headers of unregistered files are read.
+
+        Parameters
+        ----------
+        directory: str or path-like
+            Directory holding master frames, such as 'data/bias'.
+
+        kind: str
+            Type of master frame stored in the directory.
+
+        Returns
+        -------
+        None
+        '''
+        known = set(row['path'] for row in self.con.execute('SELECT path FROM masters WHERE kind = ?', (kind,)))
+        for entry in sorted(os.scandir(directory), key = lambda entry: entry.name):
+            if (not entry.is_file()) or entry.name.startswith('.') or (entry.path in known):
+                continue
+            try:
+                header = fits.getheader(entry.path, imagehdu(entry.path))
+                mjd = Time(header['DATE-OBS'], format = 'fits').mjd
+            except Exception:
+                continue
+            self.add_master(entry.path, kind, mjd, header.get('FILTER'), (header.get('XBINNING', 1), header.get('YBINNING', 1)),
+                            header.get('EXPTIME'), header.get('NUMSUBS'))
+        gone = [(p,) for p in known if not os.path.exists(p)]
+        self.con.executemany('DELETE FROM masters WHERE path = ?', gone)
+        self.con.commit()
+
+    def find_master(self, kind, mjd = None, filter = None, binning = None, exptime = None, inputs = None):
+        '''
+        find_master returns the master frame nearest in date which matches the given constraints.
+
+        Parameters
+        ----------
+        kind: str
+            Type of master frame, such as 'bias' or 'flat'.
+
+        mjd: float
+            Modified julian date to search around. Optional.
+
+        filter: str
+            Filter of the master frame. Optional.
+
+        binning: int or tuple
+            Binning factor, or (xbin, ybin). Optional.
+
+        exptime: float
+            Exposure time of the input frames. Optional.
+
+        inputs: str
+            Fingerprint of the input frames, matching a master combined from the same frames. Optional.
+
+        Returns
+        -------
+        row: 'sqlite3.Row' or None
+            The nearest matching master, or None if there is no match.
+        '''
+        clauses = ['kind = ?']
+        values = [kind]
+        for column, value in (('filter', filter), ('exptime', exptime), ('inputs', inputs)):
+            if value != None:
+                clauses.append(column + ' = ?')
+                values.append(value)
+        if binning != None:
+            if not isinstance(binning, tuple):
+                binning = (binning, binning)
+            clauses.append('xbin = ? AND ybin = ?')
+            values.extend(binning)
+        query = 'SELECT * FROM masters WHERE ' + ' AND '.join(clauses)
+        if mjd != None:
+            query = query + ' ORDER BY ABS(mjd - ?)'
+            values.append(mjd)
+        return self.con.execute(query + ' LIMIT 1', values).fetchone()
+
+    def add_solution(self, key, ra, dec, scale, header):
+        '''
+        add_solution records a plate solution for a frame.
+
+        Parameters
+        ----------
+        key: str
+            Content hash of the solved frame, see 'Cache.key'.
+
+        ra, dec: float
+            Field center of the solution in degrees.
+
+        scale: float
+            Pixel scale of the solution in arcseconds per pixel.
+
+        header: 'astropy.io.fits.Header'
+            WCS header returned by the solver.
+
+        Returns
+        -------
+        None
+        '''
+        self.con.execute('INSERT OR REPLACE INTO solutions VALUES (?,?,?,?,?)', (key, ra, dec, scale, header.tostring()))
+        self.con.commit()
+
+    def find_solution(self, key):
+        '''
+        find_solution returns the plate solution recorded for a frame.
+
+        Parameters
+        ----------
+        key: str
+            Content hash of the frame, see 'Cache.key'.
+
+        Returns
+        -------
+        row: 'sqlite3.Row' or None
+            The solution with its header stored as a string, or None if the frame has not been solved.
+        '''
+        return self.con.execute('SELECT * FROM solutions WHERE key = ?', (key,)).fetchone()
+
+    def near_solution(self, ra, dec, radius):
+        '''
+        near_solution returns the recorded plate solution whose field center is closest to a
+        pointing, used to hint the solver with the expected center and pixel scale.
+
+        Parameters
+        ----------
+        ra, dec: float
+            Pointing in degrees.
+
+        radius: float
+            Search radius in degrees.
+
+        Returns
+        -------
+        row: 'sqlite3.Row' or None
+            The nearest solution within 'radius', or None.
+        '''
+        rows = self.con.execute('SELECT * FROM solutions WHERE dec BETWEEN ? AND ?', (dec - radius, dec + radius)).fetchall()
+        best = None
+        bestsep = radius
+        for row in rows:
+            sep = separation(ra, dec, row['ra'], row['dec'])
+            if sep <= bestsep:
+                best = row
+                bestsep = sep
+        return best
+
+    def add_processed(self, path, stage, size, mtime, hash):
+        '''
+        add_processed records the fingerprint of a frame which has been through a processing stage.
+
+        Parameters
+        ----------
+        path: str or path-like
+            Location of the raw frame.
+
+        stage: str
+            Processing stage, such as 'calibrated', 'aligned', or 'photometry'.
+
+        size, mtime: int, float
+            File size and modification time of the frame when it was processed.
+
+        hash: str
+            Digest of the file contents when it was processed.
+
+        Returns
+        -------
+        None
+        '''
+        self.con.execute('INSERT OR REPLACE INTO processed VALUES (?,?,?,?,?)', (os.fspath(path), stage, size, mtime, hash))
+        self.con.commit()
+
+    def find_processed(self, path, stage):
+        '''
+        find_processed returns the fingerprint recorded when a frame went through a processing stage.
+
+        Returns
+        -------
+        row: 'sqlite3.Row' or None
+            The recorded fingerprint, or None if the frame has not been through the stage.
+        '''
+        return self.con.execute('SELECT * FROM processed WHERE path = ? AND stage = ?', (os.fspath(path), stage)).fetchone()
+
+    def close(self):
+        self.con.close()
+
+
+def separation(ra1, dec1, ra2, dec2):
+    '''
+    separation returns the angular distance in degrees between two positions given in degrees.
+    '''
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    h = math.sin((dec2 - dec1) / 2)**2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2)**2
+    return math.degrees(2 * math.asin(min(1, math.sqrt(h))))
@@ -0,0 +1,206 @@
+import os
+import re
+import hashlib
+import threading
+
+import numpy as np
+
+__all__ = ['Cache']
+
+'''
+'dorado.filer.cache' holds the Cache class, a content-addressed store for temporary objects
+under the Dorado cache directory.
+'''
+
+# cache files are named by the sha1 digest of their content
+cachename = re.compile(r'^[0-9a-f]{40}\.fits$')
+
+
+def pathset(paths):
+    '''
+    pathset normalises a single path, a collection of paths or None to a set of path strings.
+    '''
+    if paths == None:
+        return set()
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        paths = [paths]
+    return {os.fspath(path) for path in paths}
+
+
+class Cache:
+    '''
+    The Cache class stores objects under a name derived from their content, so identical
+    objects are only written once and concurrent jobs can never collide on a name. Writes go
+    to a temporary file which is renamed into place, and the cache is kept under a byte budget
+    by removing the least recently used objects. Only files written by the cache are ever
+    evicted, other contents of the cache directory are left alone.
+
+    Attributes
+    ----------
+
+    root: path-like
+        Cache directory.
+
+    limit: int
+        Byte budget of the cache. Default is 2 GiB.
+
+    hits: int
+        Number of stores which found the object already cached.
+
+    misses: int
+        Number of stores which had to write the object.
+
+    '''
+    def __init__(self, root, limit = 2 * 1024**3):
+        self.root = root
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, object):
+        '''
+        key computes the content hash of an object from its pixel data, data type, shape and header.
+
+        Parameters
+        ----------
+        object: CCDdata
+            Object to hash.
+
+        Returns
+        -------
+        key: str
+            Hexadecimal sha1 digest of the object.
+        '''
+        data = np.ascontiguousarray(object.data)
+        h = hashlib.sha1()
+        h.update(str(data.dtype).encode())
+        h.update(str(data.shape).encode())
+        h.update(data)
+        h.update(str(object.header).encode())
+        return h.hexdigest()
+
+    def put(self, object, subcache = False, keep = None):
+        '''
+        put stores an object in the cache, or refreshes its last use if it is already cached.
+        The object just stored is never evicted to make room for itself, other objects staged by
+        the caller are only protected if they are passed in 'keep'.
+
+        Parameters
+        ----------
+        object: CCDdata
+            Object to cache, it must provide a 'write' method.
+
+        subcache: str
+            Subdirectory of the cache to store the object in. Optional.
+
+        keep: path-like or set[path-like]
+            Cached objects which must not be evicted while storing this one. Optional.
+
+        Returns
+        -------
+        fname: str
+            File name of the cached object.
+
+        cachedir: path-like
+            Directory the object is cached in.
+        '''
+        if subcache:
+            cachedir = self.root / subcache
+        else:
+            cachedir = self.root
+        os.makedirs(cachedir, exist_ok = True)
+        fname = self.key(object) + '.fits'
+        path = cachedir / fname
+        if os.path.exists(path):
+            try:
+                # modification time doubles as the last use time for eviction
+                os.utime(path)
+                with self._lock:
+                    self.hits = self.hits + 1
+                return fname, cachedir
+            except FileNotFoundError:
+                # evicted by another job in the meantime, it is written again
+                pass
+
+        tmp = cachedir / ('.' + fname + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+        try:
+            object.write(tmp, format = 'fits', overwrite = True)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with self._lock:
+            self.misses = self.misses + 1
+        self.evict(keep = pathset(keep) | {os.fspath(path)})
+        return fname, cachedir
+
+    def entries(self):
+        '''
+        entries lists the objects written by the cache.
+
+        Returns
+        -------
+        entries: list[tuple]
+            (last use, size, path) for each cached object.
+        '''
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if cachename.match(name):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        '''
+        size returns the number of bytes used by cached objects.
+        '''
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, keep = None):
+        '''
+        evict removes the least recently used objects until the cache is within its byte budget.
+
+        Parameters
+        ----------
+        keep: path-like or set[path-like]
+            Objects which must not be removed, such as the ones just stored. Optional.
+
+        Returns
+        -------
+        removed: int
+            Number of objects removed.
+        '''
+        keep = pathset(keep)
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total = total - size
+            removed = removed + 1
+        return removed
+
+    def clear(self):
+        '''
+        clear removes every object written by the cache and resets the hit and miss counters.
+        '''
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,328 @@
+import os
+
+import numpy as np
+import ccdproc
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
+
+from ..stack.stackClass import imagehdu, firstimage
+from ..config import working_dtype
+
+__all__ = ['TileCombiner', 'StreamCombiner']
+
+'''
+'dorado.filer.combiner' holds the TileCombiner and StreamCombiner classes, out-of-core engines 
+for combining calibration frames into masters.
+'''
+
+
+def openframes(inputs):
+    '''
+    openframes opens each frame file once, reading only its header. The data is left on disk, 
+    rows are read from the open file through the HDU's 'section' and whole frames through its 'data'.
+    Frames given as CCDData are passed through.
+
+    Parameters
+    ----------
+    inputs: list[CCDData or path-like]
+        Frames, in memory or as FITS files.
+
+    Returns
+    -------
+    images: list[CCDData or 'astropy.io.fits.ImageHDU']
+        The frames, as an open image HDU for each file.
+
+    headers: list['astropy.io.fits.Header']
+        Header of each frame.
+
+    hdulists: list['astropy.io.fits.HDUList']
+        Files opened, to be closed once the frames are combined.
+    '''
+    images = []
+    headers = []
+    hdulists = []
+    for im in inputs:
+        if isinstance(im, CCDData):
+            images.append(im)
+            headers.append(im.header)
+        else:
+            # not memory-mapped, scaled integer files (BZERO/BSCALE) cannot be
+            hdus = fits.open(os.fspath(im), memmap = False)
+            hdulists.append(hdus)
+            images.append(hdus[firstimage(hdus)])
+            headers.append(images[-1].header)
+    return images, headers, hdulists
+
+
+class TileCombiner:
+    '''
+    The TileCombiner class combines a list of frames one strip of rows at a time so that only a
+    strip of every frame is resident at once, rather than the whole three dimensional stack. File
+    inputs are opened once, see 'openframes', and only the rows of each strip are read from them. Each strip is combined by a 'ccdproc.Combiner', and
+    every combine and clipping operation works along the frame axis only, so the master is bit
+    identical to combining the full stack at once in the same data type.
+
+    Attributes
+    ----------
+
+    inputs: list[CCDData or path-like]
+        Frames to combine, either in memory or as FITS file paths.
+
+    unit: str or 'astropy.units.Unit'
+        Unit of the frames. Default is 'adu'. Optional.
+
+    mem_limit: int
+        Byte budget of a strip. Default is 512 MiB. Optional.
+
+    dtype: 'numpy.dtype'
+        Data type the frames are combined in. Defaults to the configured working data type, see 
+        'dorado.conf'. Optional.
+
+    headers: list['astropy.io.fits.Header']
+        Header of each frame.
+
+    shape: tuple
+        Shape of the frames.
+
+    '''
+    def __init__(self, inputs, unit = 'adu', mem_limit = 512 * 1024**2, dtype = None):
+        if dtype == None:
+            dtype = working_dtype()
+        self.inputs = inputs
+        self.unit = unit
+        self.mem_limit = mem_limit
+        self.dtype = dtype
+        self._images, self.headers, self._hdus = openframes(inputs)
+        if len(self._images) == 0:
+            raise Exception('No frames to combine')
+        self.shape = self._images[0].shape
+
+    def strip(self, index, start, stop):
+        '''
+        strip returns rows 'start' to 'stop' of an input frame as a CCDData object.
+        '''
+        im = self._images[index]
+        if isinstance(im, CCDData):
+            mask = None
+            if im.mask is not None:
+                mask = im.mask[start:stop]
+            return CCDData(np.asarray(im.data)[start:stop], unit = im.unit, mask = mask)
+        return CCDData(im.section[start:stop], unit = self.unit)
+
+    def rows(self, bytes_per_pixel = 32):
+        '''
+        rows computes how many rows of every frame fit within the byte budget at once. The combiner
+        holds a masked copy of each strip in 'dtype' and clipping needs temporaries of similar size.
+        '''
+        per_row = len(self._images) * self.shape[1] * bytes_per_pixel
+        return int(max(1, min(self.shape[0], self.mem_limit // per_row)))
+
+    def combine(self, method = 'average', sigma_clip = False, low_thresh = 3, high_thresh = 3, func = 'mean', dev_func = 'std', **kwargs):
+        '''
+        combine combines the frames strip by strip.
+
+        Parameters
+        ----------
+        method: str
+            'average', 'median' or 'sum'. Default is 'average'. Optional.
+
+        sigma_clip: Boolean
+            Whether to sigma clip each pixel along the frame axis before combining, see
+            'ccdproc.Combiner.sigma_clipping'. Default is 'False'. Optional.
+
+        low_thresh, high_thresh, func, dev_func:
+            Sigma clipping options passed to 'ccdproc.Combiner.sigma_clipping'. Optional.
+
+        kwargs:
+            Passed to the combine method of 'ccdproc.Combiner'. Optional.
+
+        Returns
+        -------
+        combined: CCDData
+            The combined image, with the header of the first frame.
+        '''
+        data = np.zeros(self.shape, dtype = self.dtype)
+        mask = np.zeros(self.shape, dtype = bool)
+        uncertainty = np.zeros(self.shape, dtype = self.dtype)
+        step = self.rows()
+        for start in range(0, self.shape[0], step):
+            stop = min(self.shape[0], start + step)
+            c = ccdproc.Combiner([self.strip(i, start, stop) for i in range(len(self._images))], dtype = self.dtype)
+            if sigma_clip:
+                c.sigma_clipping(low_thresh = low_thresh, high_thresh = high_thresh, func = func, dev_func = dev_func)
+            comb = getattr(c, method + '_combine')(**kwargs)
+            data[start:stop] = comb.data
+            if comb.mask is not None:
+                mask[start:stop] = comb.mask
+            if comb.uncertainty is not None:
+                uncertainty[start:stop] = comb.uncertainty.array
+            del c, comb
+        return CCDData(data, unit = self.unit, mask = mask, uncertainty = StdDevUncertainty(uncertainty),
+                       header = self.headers[0].copy())
+
+    def close(self):
+        '''
+        close releases the input files.
+        '''
+        for hdus in self._hdus:
+            hdus.close()
+        self._hdus = []
+
+
+class StreamCombiner:
+    '''
+    The StreamCombiner class average combines frames consumed one at a time from any iterable, 
+    such as 'Filer.diread' entries, so only a single frame is ever resident and memory does not
+    grow with the number of frames. A running sum gives the mean and Welford's running update gives
+    the variance, from which the uncertainty of the mean is derived as in 'ccdproc'. Sigma clipping
+    is iterative, each iteration is another pass over the frames rejecting pixels beyond the bounds
+    of the previous pass, and so requires frames which can be iterated more than once.
+
+    Attributes
+    ----------
+
+    unit: str or 'astropy.units.Unit'
+        Unit of the frames. Default is 'adu'. Optional.
+
+    dtype: 'numpy.dtype'
+        Data type of the combined image. Defaults to the configured working data type, see 
+        'dorado.conf'. The running statistics are always kept in float64. Optional.
+
+    n: array
+        Number of accepted values of each pixel.
+
+    total: array
+        Running sum of each pixel.
+
+    mean: array
+        Running mean of each pixel.
+
+    m2: array
+        Running sum of squared deviations from the mean of each pixel.
+
+    nframes: int
+        Number of frames consumed by the last pass.
+
+    '''
+    def __init__(self, unit = 'adu', dtype = None):
+        if dtype == None:
+            dtype = working_dtype()
+        self.unit = unit
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        '''
+        reset clears the running statistics.
+        '''
+        self.n = None
+        self.total = None
+        self.mean = None
+        self.m2 = None
+        self.header = None
+        self.nframes = 0
+
+    def read(self, frame):
+        '''
+        read returns a frame as a CCDData object, reading it if it is a file path, directory entry or
+        an image HDU opened by 'openframes'.
+        '''
+        if isinstance(frame, CCDData):
+            return frame
+        if isinstance(frame, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)):
+            data = frame.data
+            # drop the HDU's copy, so only the frame being added stays resident
+            del frame.data
+            return CCDData(data, unit = self.unit, header = frame.header)
+        return CCDData.read(os.fspath(frame), hdu = imagehdu(frame), unit = self.unit)
+
+    def add(self, data, keep = None):
+        '''
+        add updates the running statistics with a frame.
+
+        Parameters
+        ----------
+        data: array
+            Pixel data of the frame.
+
+        keep: array[bool]
+            Pixels of the frame to accept, all pixels are accepted by default. Optional.
+        '''
+        data = np.asarray(data, dtype = np.float64)
+        if self.n is None:
+            self.n = np.zeros(data.shape, dtype = np.int64)
+            self.total = np.zeros(data.shape, dtype = np.float64)
+            self.mean = np.zeros(data.shape, dtype = np.float64)
+            self.m2 = np.zeros(data.shape, dtype = np.float64)
+        if keep is None:
+            keep = np.ones(data.shape, dtype = bool)
+        self.n += keep
+        delta = data - self.mean
+        self.mean += np.divide(delta, self.n, out = np.zeros_like(delta), where = keep)
+        self.m2 += np.where(keep, delta * (data - self.mean), 0)
+        self.total += np.where(keep, data, 0)
+
+    def accumulate(self, frames, lower = None, upper = None):
+        '''
+        accumulate makes one pass over the frames, rejecting pixels outside of 'lower' and 'upper' if given.
+        '''
+        self.reset()
+        for frame in frames:
+            im = self.read(frame)
+            if self.header is None:
+                self.header = im.header.copy()
+            keep = None
+            if lower is not None:
+                keep = (im.data >= lower) & (im.data <= upper)
+            self.add(im.data, keep)
+            self.nframes = self.nframes + 1
+            del im
+        if self.nframes == 0:
+            raise Exception('No frames to combine')
+
+    def combine(self, frames, sigma_clip = False, low_thresh = 3, high_thresh = 3, maxiters = 3):
+        '''
+        combine average combines the frames.
+
+        Parameters
+        ----------
+        frames: iterable[CCDData or path-like]
+            Frames to combine, in memory or as FITS files.
+
+        sigma_clip: Boolean
+            Whether to iteratively sigma clip each pixel about its mean before combining. Default is 
+            'False'. Optional.
+
+        low_thresh, high_thresh: float
+            Number of standard deviations below and above the mean beyond which pixels are clipped. 
+            Default is 3. Optional.
+
+        maxiters: int
+            Maximum number of clipping passes, clipping stops early once no further pixels are
+            rejected. Default is 3. Optional.
+
+        Returns
+        -------
+        combined: CCDData
+            The mean image, with the header of the first frame. Pixels rejected in every frame are masked.
+        '''
+        if sigma_clip and (iter(frames) is frames):
+            raise Exception('Sigma clipping needs frames which can be read more than once, such as a list.')
+        self.accumulate(frames)
+        if sigma_clip:
+            accepted = self.n.sum()
+            for _ in range(maxiters):
+                center = self.mean.copy()
+                dev = np.sqrt(self.m2 / np.maximum(self.n, 1))
+                self.accumulate(frames, center - low_thresh * dev, center + high_thresh * dev)
+                if self.n.sum() == accepted:
+                    break
+                accepted = self.n.sum()
+
+        mask = (self.n == 0)
+        n = np.maximum(self.n, 1)
+        # the mean is the exact sum over the count, the running mean only feeds the variance
+        data = self.total / n
+        uncertainty = np.sqrt(self.m2 / n) / np.sqrt(n)
+        return CCDData(data.astype(self.dtype), unit = self.unit, mask = mask, 
+                       uncertainty = StdDevUncertainty(uncertainty.astype(self.dtype)), header = self.header)
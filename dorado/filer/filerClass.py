@@ -3,6 +3,12 @@ warnings.filterwarnings('ignore')
 
 from ..ceres import Ceres
 from ..stack import Stack
+from ..stack.stackClass import imagehdu
+from .archiveClass import Archive, separation, biasstr, flatsstr
+from .cacheClass import Cache
+from .solverClass import AstrometryNetSolver, SolveQueue
+from .combinerClass import TileCombiner, StreamCombiner, openframes
+from ..config import working_dtype
 
 
 from astropy.nddata.ccddata import CCDData
@@ -11,15 +17,20 @@ from astropy import config as _config
 from astropy.utils.misc import isiterable
 import astropy.units as un
 from astropy.time import Time
-import ccdproc
 
 from astroquery.astrometry_net import AstrometryNet
-from astroquery.exceptions  import TimeoutError
 from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
 
 import os
 import datetime
+import hashlib
+import threading
+from functools import partial
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 
 ast = AstrometryNet()
@@ -32,7 +43,7 @@ __all__ = ['Filer']
 
 class Filer:
 
-    def __init__(self):
+    def __init__(self, workers = None, cache_limit = 2 * 1024**3, solver = None, mem_limit = 512 * 1024**2):
         # open and use logger
         # make function to create data class from hardware, processed, or raw data folder
         # needs function to import data into raw
@@ -47,6 +58,24 @@ class Filer:
         self.dordir = Path(self.config_dir).parent
         self.init_dir()
         self.unit = un.adu
+        # header-only catalog of frames in the data directory
+        self.archive = Archive(self.dordir / 'data' / 'index.sqlite')
+        # content-addressed object cache, kept under 'cache_limit' bytes
+        self.cache = Cache(self.dordir / 'cache', cache_limit)
+        # plate solver backend and the number of solves allowed in flight,
+        # a LocalSolver allows solving offline against a catalog in data/catalogs
+        if solver == None:
+            solver = AstrometryNetSolver(ast)
+        self.solver = solver
+        self.solve_concurrency = 4
+        # number of concurrent readers/writers, None lets the pool decide
+        self.workers = workers
+        # (path, error) pairs for files that could not be read during the last ingest
+        self.failed = []
+        # raw file paths of the light frames read during the last ingest
+        self.sources = []
+        # byte budget for combining calibration frames, see TileCombiner
+        self.mem_limit = mem_limit
 
     def init_dir(self):
         self.enter_dordir()
@@ -58,14 +87,100 @@ class Filer:
         os.makedirs('./data/graphical', exist_ok = True)
         os.makedirs('./data/projects', exist_ok = True)
         os.makedirs('./data/targets', exist_ok = True)
+        os.makedirs('./data/catalogs', exist_ok = True)
         os.makedirs('./logs', exist_ok = True)
         os.makedirs('./cache', exist_ok = True)
         os.makedirs('./cache/astrometryNet', exist_ok = True)
         self.exit_dordir()
 
-    def newdat(self):
+    def filehash(self, path):
+        '''
+        filehash returns the sha1 digest of a file's contents.
+        '''
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def newdat(self, stage = 'photometry', sub = 'raw', dates = None):
+        '''
+        newdat finds raw frames which have not been through a processing stage yet. Each frame is 
+        fingerprinted by its path, size and modification time against the processed-state manifest
+        kept in the archive index. Frames whose size or modification time changed are hashed, and
+        only count as new if their contents changed too.
+
+        Parameters
+        ----------
+        stage: str
+            Processing stage, one of 'calibrated', 'aligned', or 'photometry'. Default is 'photometry'. Optional.
+
+        sub: str
+            Data subdirectory holding the nights. Default is 'raw'. Optional.
+
+        dates: list[str]
+            Nights to search. Default is every night in the subdirectory. Optional.
+
+        Returns
+        -------
+        new: dict
+            Paths of the unprocessed light frames keyed by night, only nights with unprocessed frames are included.
+        '''
         # find data that hasn't been processed yet
         print('searching for unprocessed data...')
+        root = self.dordir / 'data' / sub
+        if dates == None:
+            _, directories = self.diread(root)
+            dates = [d.name for d in directories]
+        new = {}
+        for date in dates:
+            self.archive.index(root, root / date, workers = self.workers)
+            pending = []
+            for row in self.archive.select(night = date, imagetyp = 'light'):
+                path = row['path']
+                done = self.archive.find_processed(path, stage)
+                if done == None:
+                    pending.append(path)
+                elif (done['size'] != row['size']) or (done['mtime'] != row['mtime']):
+                    if self.filehash(path) == done['hash']:
+                        # touched but unchanged, refresh the fingerprint
+                        self.archive.add_processed(path, stage, row['size'], row['mtime'], done['hash'])
+                    else:
+                        pending.append(path)
+            if len(pending) != 0:
+                new[date] = pending
+        print(sum(len(p) for p in new.values()), ' unprocessed frames found in ', len(new), ' nights.')
+        return new
+
+    def mark_processed(self, cr, stage, filters = None):
+        '''
+        mark_processed records the raw frames of a Ceres instance as having been through a processing
+        stage in the processed-state manifest, see 'newdat'.
+
+        Parameters
+        ----------
+        cr: Ceres instance
+            Ceres whose stacks were processed.
+
+        stage: str
+            Processing stage, one of 'calibrated', 'aligned', or 'photometry'.
+
+        filters: list[str]
+            Filters whose stacks were processed. Default is every filter. Optional.
+
+        Returns
+        -------
+        None
+        '''
+        if filters == None:
+            filters = cr.filters.keys()
+        for filter in filters:
+            for path in cr.data[cr.filters[filter]].sources:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                self.archive.add_processed(path, stage, stat.st_size, stat.st_mtime, self.filehash(path))
 
     def get_night(self):
         """
@@ -117,17 +232,211 @@ class Filer:
                     files.append(entry)
                 if entry.is_dir():
                     directories.append(entry)
+        # scandir order is filesystem dependent, sort so frame order is reproducible
+        files.sort(key = lambda entry: entry.name)
+        directories.sort(key = lambda entry: entry.name)
         return files, directories
+
+    def readFrame(self, entry):
+        '''
+        readFrame reads a single FITS file into a CCDData object using the Filer unit. Tile
+        compressed frames, as written by 'writeFrame', are read from their first extension.
+
+        Parameters
+        ----------
+        entry: os.DirEntry or path-like
+            File to be read.
+
+        Returns
+        -------
+        hdu: CCDData
+            The image read from file.
+        '''
+        return CCDData.read(os.fspath(entry), hdu = imagehdu(entry), unit = self.unit)
+
+    def read_frames(self, entries, workers = None):
+        '''
+        read_frames reads a list of FITS files concurrently using a pool of worker threads.
+        Reading is bound by I/O and decompression, both of which release the GIL, so threads
+        avoid having to pickle every image back from a process pool. The returned frames keep 
+        the order of 'entries' regardless of which file finishes first. Files that fail to read 
+        are skipped and recorded in 'self.failed' rather than aborting the whole scan.
+
+        Parameters
+        ----------
+        entries: list[os.DirEntry or path-like]
+            Files to be read.
+
+        workers: int
+            Number of reader threads. Defaults to 'self.workers'. Optional.
+
+        Returns
+        -------
+        frames: list[CCDData]
+            Successfully read images in the same order as 'entries'.
+        '''
+        if workers == None:
+            workers = self.workers
+
+        def attempt(entry):
+            try:
+                return self.readFrame(entry), None
+            except Exception as e:
+                return None, e
+
+        frames = []
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            for entry, (hdu, error) in zip(entries, pool.map(attempt, entries)):
+                if error != None:
+                    self.failed.append((os.fspath(entry), error))
+                    print('Failed to read ', os.fspath(entry), ': ', error)
+                else:
+                    frames.append(hdu)
+        return frames
+    
+    def writeFrame(self, image, path, compress = None, force16 = False):
+        '''
+        writeFrame writes a single CCDData object to a FITS file. The file is written to a temporary
+        name in the same directory and renamed into place, so an interrupted write never leaves a 
+        truncated frame behind.
+
+        Parameters
+        ----------
+        image: CCDData
+            Image to be written.
+
+        path: path-like
+            Destination file.
+
+        compress: str
+            FITS tile compression algorithm, 'RICE_1' or 'GZIP_1'. Only integer data is compressed
+            so that compression is lossless, floating point data is written uncompressed. Default 
+            is 'None'. Optional.
+
+        force16: Boolean
+            Whether to store the image as 16 bit integers, see 'force16'. Default is 'False'. Optional.
+        '''
+        path = Path(path)
+        tmp = path.parent / ('.' + path.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+        if force16:
+            hdus = self.force16(image)
+        else:
+            hdus = image.to_hdu()
+        if (compress != None) and (hdus[0].data is not None) and (hdus[0].data.dtype.kind in 'iu'):
+            # compressed images live in the first extension, CCDData.read finds them there
+            comp = fits.CompImageHDU(data = hdus[0].data, header = hdus[0].header, compression_type = compress)
+            hdus = fits.HDUList([fits.PrimaryHDU(), comp] + hdus[1:])
+        try:
+            hdus.writeto(tmp, overwrite = True)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def write_frames(self, items, workers = None, compress = None, force16 = False):
+        '''
+        write_frames writes a list of images concurrently using a pool of worker threads, the 
+        counterpart of 'read_frames'. Each image is only requested from 'items' when a worker is
+        free, so lazy stacks are never held in memory all at once.
+
+        Parameters
+        ----------
+        items: list[tuple]
+            (image, path) pairs, image may also be a callable returning the image.
+
+        workers: int
+            Number of writer threads. Defaults to 'self.workers'. Optional.
+
+        compress: str
+            FITS tile compression algorithm, see 'writeFrame'. Optional.
+
+        force16: Boolean
+            Whether to store images as 16 bit integers, see 'force16'. Default is 'False'. Optional.
+
+        Returns
+        -------
+        paths: list
+            Paths written, in the same order as 'items'.
+        '''
+        if workers == None:
+            workers = self.workers
+
+        def write(item):
+            image, path = item
+            if callable(image):
+                image = image()
+            self.writeFrame(image, path, compress, force16)
+            return path
+
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            return list(pool.map(write, items))
     
-    def dirscan(self, dirarray):
+    def readCalibration(self, entries, workers = None, lazy = False):
+        '''
+        readCalibration reads the bias or flat frames of a night. In lazy mode only their paths are
+        returned, mkBias and mkFlat then combine them from memory-mapped files, see TileCombiner.
+
+        Parameters
+        ----------
+        entries: list[os.DirEntry or path-like]
+            Calibration frame files.
+
+        workers: int
+            Number of reader threads. Optional.
+
+        lazy: Boolean
+            Whether to return the file paths instead of reading the frames. Default is 'False'. Optional.
+
+        Returns
+        -------
+        frames: list[CCDData] or list[str]
+            The calibration frames, or their paths when 'lazy' is set.
+        '''
+        if lazy:
+            return [os.fspath(entry) for entry in entries]
+        return self.read_frames(entries, workers)
+
+    def readLights(self, entries, workers = None, lazy = False, only = None):
+        '''
+        readLights reads the light frames of a night and records their file paths in 'self.sources'.
+
+        Parameters
+        ----------
+        entries: list[os.DirEntry or path-like]
+            Light frame files.
+
+        workers: int
+            Number of reader threads. Optional.
+
+        lazy: Boolean
+            Whether to return the file paths instead of reading the frames. Default is 'False'. Optional.
+
+        only: set[str]
+            Paths of the frames to read, other entries are ignored. Optional.
+
+        Returns
+        -------
+        lights: list[CCDData] or list[str]
+            The light frames, or their paths when 'lazy' is set.
+        '''
+        paths = [os.fspath(entry) for entry in entries]
+        if only != None:
+            paths = [path for path in paths if path in only]
+        if lazy:
+            self.sources = paths
+            return paths
+        lights = self.read_frames(paths, workers)
+        failed = set(path for path, _ in self.failed)
+        self.sources = [path for path in paths if path not in failed]
+        return lights
+
+    def dirscan(self, dirarray, workers = None, lazy = False, only = None):
         path = self.dordir
         for dir in dirarray:
             path = path / dir
         files, directories = self.diread(path)
+        self.failed = []
 
-        biasstr = ['Bias', 'Bias', 'bias', 'BIAS']
-        flatsstr = ['FLAT', 'FlatField', 'flat', 'Flat', 'Flats', 'flats', 'FLATS', 'FlatFields']
-        lightsstr = ['lights', 'Lights', 'LIGHTS']
 
         if len(directories) == 0:
             if len(files) == 0:
@@ -136,46 +445,16 @@ class Filer:
             else:
                 print('Single directory level organization format detected.')
                 # print('Reading files.')
-                # compile these into master frame and pass them to Filer
-                # path = self.dordir / 'data' / 'raw' / date
-                biasl = []
-                for strbias in biasstr:
-                    for s in files:
-                        if (str(strbias)) in str(s.name):
-                            biasl.append(s)
-                bias = []
-                for i in range(len(biasl)):
-                    hdu = CCDData.read(biasl[i].path, unit = self.unit)
-                    bias.append(hdu)
-                # print('Bias searched.')
-                flatsl = []
-                for strflat in flatsstr:
-                    for s in files:
-                        if strflat in s.name:
-                            flatsl.append(s)
-                flats = []
-                for i in flatsl:
-                    hdu = CCDData.read(i.path, unit = self.unit)
-                    flats.append(hdu)
-                # print('flats searched.')
-                # strip into ceres (check if multi-filter)
-                lightsl = []
-                nonlight = []
-                for b in biasl:
-                    nonlight.append(b.name)
-                for f in flatsl:
-                    nonlight.append(f.name)
-
-                for s in files:
-                    if (str(s.name) not in nonlight):
-                        lightsl.append(s)
-
-                # lightsl = [s for s in files if (s.name not in biasl) and (s.name not in flatsl)]
-                lights = []
-                for i in lightsl:
-                    hdu = CCDData.read(i.path, unit = self.unit)
-                    lights.append(hdu)
-                # print('lights searched.')
+                # compile these into master frame and pass to Filer, each file is only listed once 
+                # even if its name matches more than one of the strings
+                biasl = [s for s in files if any(strbias in s.name for strbias in biasstr)]
+                bias = self.readCalibration(biasl, workers, lazy)
+                flatsl = [s for s in files if any(strflat in s.name for strflat in flatsstr) and (s not in biasl)]
+                flats = self.readCalibration(flatsl, workers, lazy)
+                # strip into ceres, lights are split by filter in mkceres
+                nonlight = set(s.name for s in biasl + flatsl)
+                lightsl = [s for s in files if s.name not in nonlight]
+                lights = self.readLights(lightsl, workers, lazy, only)
                 return bias, flats, lights
 
 
@@ -184,60 +463,135 @@ class Filer:
             # print('Reading directories.')
             # read into this and compile into master bias, pass to Filer
             biasdir = [s for s in directories if s.name in biasstr]
-            # check if multifilter, compile, pass to Filer
+            # flats and lights may be further split into subdirectories, such as one per filter
             flatsdir = [s for s in directories if s.name in flatsstr]
-            # check if multifilter (or subdirectories) and pass to ceres
             lightsdir = [s for s in directories if (s.name not in flatsstr) and (s.name not in biasstr)]
-            biasl, _ = self.diread(biasdir[0])
             bias = []
-            for i in biasl:
-                hdu = CCDData.read(i.path, unit = self.unit)
-                bias.append(hdu)
-
+            if len(biasdir) != 0:
+                biasl, _ = self.diread(biasdir[0])
+                bias = self.readCalibration(biasl, workers, lazy)
 
+            lightsl = []
             for ldir in lightsdir:
-                files, directories = self.diread(ldir)
-                if len(directories) == 0:
-                    if len(files) == 0:
-                        raise Exception('No viable light data found')
-                    else:
-                        print('Single directory lights organization format detected.')
-                        # print('Reading files.')
-                        lights = []
-                        for i in files:
-                            hdu = CCDData.read(i.path, unit = self.unit)
-                            lights.append(hdu)
-                        # filter = ImageFileCollection(ldir).values('filter', unique = True)
-                        # lights = [filter, lightsarr]
+                files = self.subread(ldir)
+                if len(files) == 0:
+                    raise Exception('No viable light data found')
+                lightsl = lightsl + files
+            lights = self.readLights(lightsl, workers, lazy, only)
 
-                        
-                elif len(files) == 0:
-                    print('Multi directory lights organization format detected.')
-                    # print('Reading directories.')
-                    lights = []
+            flatsl = []
+            for fdir in flatsdir:
+                files = self.subread(fdir)
+                if len(files) == 0:
+                    raise Exception('No viable flat data found')
+                flatsl = flatsl + files
+            flats = self.readCalibration(flatsl, workers, lazy)
+           
+            return bias, flats, lights
 
+    def subread(self, path):
+        '''
+        subread lists the files of a directory, descending one level into its subdirectories 
+        when it holds no files itself, such as a lights directory split by filter.
 
+        Parameters
+        ----------
+        path: os.DirEntry or path-like
+            Directory to list.
 
-            for fdir in flatsdir:
-                files, directories = self.diread(fdir)
-                if len(directories) == 0:
-                    if len(files) == 0:
-                        raise Exception('No viable light data found')
-                    else:
-                        print('Single directory flats organization format detected.')
-                        # print('Reading files.')
-                        flats = []
-                        for i in files:
-                            hdu = CCDData.read(i.path, unit = self.unit)
-                            flats.append(hdu)
-
-                elif len(files) == 0:
-                    print('Multi directory flats organization format detected.')
-                    # print('Reading directories.')
-                    flats = []
+        Returns
+        -------
+        files: list[os.DirEntry]
+            Files found, sorted by name within each directory.
+        '''
+        files, directories = self.diread(path)
+        if len(files) == 0:
+            if len(directories) != 0:
+                print('Multi directory organization format detected in ', os.fspath(path))
+            for sub in directories:
+                subfiles, _ = self.diread(sub)
+                files = files + subfiles
+        return files
+
+    def splitFilters(self, frames, lazy = False, workers = None):
+        '''
+        splitFilters groups frames by their FILTER header keyword, keeping their order. Read frames
+        already hold their header, for lazy frames each header is read exactly once and the 
+        observation times are kept so that the Stack does not need to read them again.
 
-           
-            return bias, flats, lights
+        Parameters
+        ----------
+        frames: list[CCDData] or list[str]
+            Frames, or their file paths when 'lazy' is set.
+
+        lazy: Boolean
+            Whether 'frames' are file paths. Default is 'False'. Optional.
+
+        workers: int
+            Number of header reader threads. Defaults to 'self.workers'. Optional.
+
+        Returns
+        -------
+        groups: dict
+            For each filter a dictionary of its 'frames', 'headers' and 'indices' into 'frames'.
+        '''
+        if lazy:
+            if workers == None:
+                workers = self.workers
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                headers = list(pool.map(lambda path: fits.getheader(path, imagehdu(path)), frames))
+        else:
+            headers = [frame.header for frame in frames]
+        groups = {}
+        for i, (frame, header) in enumerate(zip(frames, headers)):
+            filt = str(header.get('FILTER', ''))
+            if filt not in groups:
+                groups[filt] = {'frames': [], 'headers': [], 'indices': []}
+            groups[filt]['frames'].append(frame)
+            groups[filt]['headers'].append(header)
+            groups[filt]['indices'].append(i)
+        return groups
+
+    def indexscan(self, date, sub = 'raw', workers = None, lazy = False, only = None):
+        '''
+        indexscan is the index backed counterpart of 'dirscan'. The night is refreshed in the
+        archive index, which only reopens headers of new or modified files, and the bias, flat,
+        and light frames are selected by their IMAGETYP rather than by their file names.
+
+        Parameters
+        ----------
+        date: str
+            Night directory name, such as '2021-01-02+03'.
+
+        sub: str
+            Data subdirectory holding the night. Default is 'raw'. Optional.
+
+        workers: int
+            Number of reader threads. Optional.
+
+        lazy: Boolean
+            Whether to return light frame paths instead of reading them. Default is 'False'. Optional.
+
+        only: set[str]
+            Paths of the light frames to read, other lights are ignored. Optional.
+
+        Returns
+        -------
+        bias, flats, lights: list[CCDData]
+            Frames of each type. Lights are file paths when 'lazy' is set.
+        '''
+        root = self.dordir / 'data' / sub
+        self.failed = []
+        self.archive.index(root, root / date, workers = workers)
+        biasl = [row['path'] for row in self.archive.select(night = date, imagetyp = 'bias')]
+        flatsl = [row['path'] for row in self.archive.select(night = date, imagetyp = 'flat')]
+        lightsl = [row['path'] for row in self.archive.select(night = date, imagetyp = 'light')]
+        if len(biasl) + len(flatsl) + len(lightsl) == 0:
+            raise Exception('No viable data found')
+        bias = self.readCalibration(biasl, workers, lazy)
+        flats = self.readCalibration(flatsl, workers, lazy)
+        lights = self.readLights(lightsl, workers, lazy, only)
+        return bias, flats, lights
 
     def mkFlat(self, flats):
             """
@@ -245,28 +599,42 @@ class Filer:
             
             Parameters
             ----------
-            flats: array[CCDdata]
-                    array of raw flatfields. ------------> this needs to be corrected for the new image storage format
+            flats: array[CCDdata] or array[path-like]
+                    array of raw flatfields, or their file paths.
 
             Returns
             -------
             flat: CCDdata
                     The combined calibrated flatfield image.
             """
-            c = ccdproc.Combiner(flats)
-            c.sigma_clipping()
-            flat = c.median_combine()
+            # combined in strips under self.mem_limit, identical to a ccdproc.Combiner over all flats
+            combiner = TileCombiner(flats, unit = self.unit, mem_limit = self.mem_limit)
+            first = combiner.headers[0]
+            inputs = self.fingerprint(combiner.headers)
+            saved = self.archive.find_master('flat', inputs = inputs)
+            if (saved != None) and os.path.exists(saved['path']):
+                print('Reusing saved Flat combined from the same frames')
+                combiner.close()
+                return CCDData.read(saved['path'], unit = self.unit)
+
+            flat = combiner.combine('median', sigma_clip = True)
+            combiner.close()
+            flat.header = fits.Header()
+            flat.header['NCOMBINE'] = len(flats)
             # , method = 'average',
             #                     sigma_clip = True, sigma_clip_low_thresh = 5, sigma_clip_high_thresh = 5,
             #                     sigma_clip_func = np.ma.median, sigma_clip_dev_func = mad_std, unit = self.unit)
             flat.header['stacked'] = True
             flat.header['numsubs'] = len(flats)
-            flat.header['DATE-OBS'] = flats[0].header['DATE-OBS']
-            flat.header['filter'] = flats[0].header['filter']
+            flat.header['DATE-OBS'] = first['DATE-OBS']
+            flat.header['filter'] = first['filter']
+            flat.header['EXPTIME'] = first.get('EXPTIME')
+            flat.header['XBINNING'] = first.get('XBINNING', 1)
+            flat.header['YBINNING'] = first.get('YBINNING', 1)
             ## TODO :: There is probably more missing keywords in the combined header, where's Waldo...
 
             date = Time(flat.header['DATE-OBS'], format='fits').mjd
-            flat.data = flat.data.astype('uint16') 
+            flat.data = flat.data.astype(working_dtype()) 
 
             filt = flat.header['filter']
             ## TODO :: standardize filter names and include telescope profiles
@@ -280,6 +648,8 @@ class Filer:
             if save:
                 print('Saving Flat for later use')
                 flat.write(flatdir / fname)
+                self.archive.add_master(flatdir / fname, 'flat', date, filt, self.binning(flat.header),
+                                        flat.header['EXPTIME'], len(flats), inputs)
             else:
                 print('Flat for filter and date already saved.')
 
@@ -291,8 +661,8 @@ class Filer:
             a combined bias image. ------------> this needs to be corrected for the new image storage format
             Parameters
             ----------
-            biasIFC: array[CCDdata]
-                    array of raw bias images.
+            biasIFC: array[CCDdata] or array[path-like]
+                    array of raw bias images, or their file paths.
 
             Returns
             -------
@@ -300,12 +670,26 @@ class Filer:
                     The combined bias image.
             """
             # Allow specification of median or mean
-
-            bias = ccdproc.combine(biasIFC, method = 'average', unit = self.unit)
+            # each file is opened once, its header now and its data only if the frames are combined
+            images, headers, hdulists = openframes(biasIFC)
+            inputs = self.fingerprint(headers)
+            saved = self.archive.find_master('bias', inputs = inputs)
+            if (saved != None) and os.path.exists(saved['path']):
+                print('Reusing saved Bias combined from the same frames')
+                for hdus in hdulists:
+                    hdus.close()
+                return CCDData.read(saved['path'], unit = self.unit)
+
+            # an average only needs running sums, one frame is resident at a time, see StreamCombiner
+            try:
+                bias = StreamCombiner(unit = self.unit).combine(images)
+            finally:
+                for hdus in hdulists:
+                    hdus.close()
             bias.meta['stacked'] = True
             bias.header['numsubs'] = len(biasIFC)
             date = Time(bias.header['DATE-OBS'], format='fits').mjd
-            bias.data = bias.data.astype('uint16') 
+            bias.data = bias.data.astype(working_dtype()) 
             fname = str(int(date)) + '_Bias.fits'
             biasdir = self.dordir / 'data' / 'bias' 
             contents = os.scandir(path = biasdir)
@@ -316,18 +700,106 @@ class Filer:
             if save:
                 print('Saving Bias for later use')
                 bias.write(biasdir / fname)
+                self.archive.add_master(biasdir / fname, 'bias', date, None, self.binning(bias.header),
+                                        bias.header.get('EXPTIME'), len(biasIFC), inputs)
             else:
                 print('Bias for date already saved.')
             return bias
 
-    def mkceres(self, date, sub = 'raw', target = None, calibrated = False, aligned = False):
+    def fingerprint(self, frames):
+        '''
+        fingerprint identifies a set of frames by hashing the observation time, exposure time,
+        filter and shape of each frame. The hash does not depend on the order of the frames and
+        is used to recognize calibration frames which have been combined before.
+
+        Parameters
+        ----------
+        frames: array[CCDdata] or array['astropy.io.fits.Header']
+            Frames, or their headers, to fingerprint.
+
+        Returns
+        -------
+        inputs: str
+            Hexadecimal digest identifying the frames.
+        '''
+        keys = []
+        for im in frames:
+            if isinstance(im, fits.Header):
+                header = im
+                shape = tuple(header['NAXIS' + str(n)] for n in range(header['NAXIS'], 0, -1))
+            else:
+                header = im.header
+                shape = im.shape
+            keys.append((str(header.get('DATE-OBS')), str(header.get('EXPTIME')), str(header.get('FILTER')), str(shape)))
+        h = hashlib.sha1()
+        for key in sorted(keys):
+            h.update(repr(key).encode())
+        return h.hexdigest()
+
+    def binning(self, header):
+        '''
+        binning returns the (xbin, ybin) binning factors recorded in a header, defaulting to 1.
+        '''
+        return (header.get('XBINNING', 1), header.get('YBINNING', 1))
+
+    def getCalibration(self, kind, mjd, filter = None, binning = None, exptime = None):
+        '''
+        getCalibration retrieves the saved master calibration frame closest in date to 'mjd' from
+        the calibration library. Masters saved in 'data/bias' and 'data/flats' are registered in
+        the library the first time they are searched.
+
+        Parameters
+        ----------
+        kind: str
+            Type of master frame, either 'bias' or 'flat'.
+
+        mjd: float
+            Modified julian date of the observations to be calibrated.
+
+        filter: str
+            Filter the master must match, used for flats. Optional.
+
+        binning: tuple
+            (xbin, ybin) the master must match. Optional.
+
+        exptime: float
+            Exposure time the master must match. Optional.
+
+        Returns
+        -------
+        master: CCDdata or None
+            The nearest master frame, or None if the library holds no match.
+        '''
+        if kind == 'bias':
+            self.archive.index_masters(self.dordir / 'data' / 'bias', 'bias')
+        elif kind == 'flat':
+            self.archive.index_masters(self.dordir / 'data' / 'flats', 'flat')
+        row = self.archive.find_master(kind, mjd = mjd, filter = filter, binning = binning, exptime = exptime)
+        if row == None:
+            print('Warning: no saved ', kind, ' frame found, continuing without one.')
+            return None
+        print('Using saved ', kind, ' frame from ', round(abs(row['mjd'] - mjd), 1), ' days away.')
+        return CCDData.read(row['path'], unit = self.unit)
+
+    def mkceres(self, date, sub = 'raw', target = None, calibrated = False, aligned = False, workers = None, lazy = False, index = False, new = None):
             if aligned:
                 dirarray = ['data', sub, date, 'aligned']
             elif calibrated:
                 dirarray = ['data', sub, date, 'calibrated']
             else:
                 dirarray = ['data', sub, date]
-            biasIFC, flats, lights = self.dirscan(dirarray)
+            # new = stage restricts the lights to frames which have not been through that stage
+            only = None
+            if new != None:
+                only = set(self.newdat(stage = new, sub = sub, dates = [date]).get(date, []))
+                if len(only) == 0:
+                    raise Exception('No unprocessed data found')
+            if index and not (calibrated or aligned):
+                biasIFC, flats, lights = self.indexscan(date, sub = sub, workers = workers, lazy = lazy, only = only)
+            else:
+                biasIFC, flats, lights = self.dirscan(dirarray, workers = workers, lazy = lazy, only = only)
+            if len(self.failed) != 0:
+                print(len(self.failed), ' files could not be read.')
             print(len(flats), ' flats found.')
             print(len(biasIFC), ' bias frames found.')
             print(len(lights), ' lights found')
@@ -335,55 +807,117 @@ class Filer:
             
 
             # save these frames
-            ## TODO :: get missing calibraation files
 
             ## TODO :: look into UTC wrecking stuff
+            # lazy lights are file paths, their headers are read once while splitting by filter
+            groups = self.splitFilters(lights, lazy, workers)
+            sources = self.sources
+            if len(sources) != len(lights):
+                sources = []
+            if lazy:
+                scratch = self.dordir / 'cache' / 'lazy' / date
+            else:
+                scratch = None
+            first = list(groups.values())[0]['headers'][0]
+            mjd = Time(first['DATE-OBS'], format='fits').mjd
             if len(biasIFC) == 0:
-                cere = Ceres(time = Time(lights[0].header['DATE-OBS'], format='fits'))
+                bias = self.getCalibration('bias', mjd, binning = self.binning(first))
+                cere = Ceres(bias = bias, time = Time(first['DATE-OBS'], format='fits'))
                 self.getDateString(cere)
             else:
                 bias = self.mkBias(biasIFC)
-                cere = Ceres(bias = bias, time = Time(lights[0].header['DATE-OBS'], format='fits'))
+                cere = Ceres(bias = bias, time = Time(first['DATE-OBS'], format='fits'))
                 self.getDateString(cere)
 
-            # for f in filter_data:
-            # cere.flats[flat.header['filter']] = flat
-
-            ## TODO :: multifilter fun
-            if len(flats) == 0:
-                 cere.add_stack(Stack(lights, calibrated = calibrated, aligned = aligned, target = target))
-            else:
-                flat = self.mkFlat(flats)
-                cere.add_stack(Stack(lights, flat = flat, calibrated = calibrated, aligned = aligned, target = target))
-            
+            # one flat and one stack per filter
+            flatgroups = self.splitFilters(flats, lazy, workers)
+            for filt, group in groups.items():
+                header = group['headers'][0]
+                if filt in flatgroups:
+                    flat = self.mkFlat(flatgroups[filt]['frames'])
+                else:
+                    flat = self.getCalibration('flat', mjd, filter = header.get('filter'), binning = self.binning(header))
+                try:
+                    times = [Time(h['DATE-OBS'], format='fits') for h in group['headers']]
+                except:
+                    times = []
+                fsources = [sources[i] for i in group['indices']] if len(sources) != 0 else None
+                print(len(group['frames']), ' lights found in filter ', filt)
+                cere.add_stack(Stack(group['frames'], flat = flat, filter = filt, times = times, calibrated = calibrated, aligned = aligned, 
+                                     target = target, lazy = lazy, scratch = scratch, unit = self.unit, sources = fsources))
 
             return cere
 
-    def force16(self, hdu):
-        print('This function is not implemented yet. See mkBias() for example functionality.')
+    def force16(self, hdu, scale = True):
+        '''
+        force16 prepares a frame for compact 16 bit integer storage. Integer valued data which fits 
+        in 0 to 65535 (or -32768 to 32767) is stored exactly as 16 bit integers. Any other data is 
+        linearly scaled onto 16 bit integers with the FITS BSCALE and BZERO keywords, which maps the 
+        full data range without clipping and rounds each value by at most BSCALE / 2. Data which 
+        cannot be represented, non-finite values or data needing scaling when 'scale' is not set, 
+        raises an exception rather than being silently clipped.
 
-    def mkcacheObj(self, object, subcache = False):
-        if subcache:
-            cachedir = self.dordir / 'cache' / subcache
-            dirarray = ['cache', subcache]
+        Parameters
+        ----------
+        hdu: CCDData
+            Frame to convert.
+
+        scale: Boolean
+            Whether to allow lossy BSCALE/BZERO scaling of data which does not fit 16 bit integers 
+            exactly. Default is 'True'. Optional.
+
+        Returns
+        -------
+        hdus: 'astropy.io.fits.HDUList'
+            The frame ready to be written, see 'writeFrame'.
+        '''
+        hdus = hdu.to_hdu()
+        data = hdus[0].data
+        if not np.all(np.isfinite(data)):
+            raise Exception('Frame holds non-finite values which cannot be stored as 16 bit integers.')
+        lo = float(data.min())
+        hi = float(data.max())
+        integral = (data.dtype.kind in 'iu') or np.array_equal(data, np.round(data))
+        if integral and (lo >= 0) and (hi <= 65535):
+            hdus[0].data = data.astype('uint16')
+        elif integral and (lo >= -32768) and (hi <= 32767):
+            hdus[0].data = data.astype('int16')
+        elif scale:
+            # centre the range on zero and spread it over the int16 range
+            bscale = (hi - lo) / 65534
+            if bscale == 0:
+                bscale = 1.0
+            bzero = (hi + lo) / 2
+            # scale works in place, the frame's own data must not be touched
+            hdus[0].data = np.array(data, dtype = np.float64)
+            hdus[0].scale('int16', bscale = bscale, bzero = bzero)
+            hdus[0].header['HISTORY'] = 'force16: scaled to 16 bit, rounded by up to ' + str(bscale / 2)
         else:
-            cachedir = self.dordir / 'cache' 
-            dirarray = ['cache']
-        # if isiterable(object):
-        #     # print('This function does not currently support iterable objects.')
-        #     return warnings.WarningMessage('This function does not currently support iterable objects.')
-        # else:
-        #     files, _ = self.diread(dirarray)
-        #     fname = 'cache_object_' + str(len(files) + 1) + '.fits'
-        #     object.write(fname)
-        #     return(fname, cachedir)
-
-        # check if iterable
-        files, _ = self.diread(dirarray)
-        fname = 'cache_object_' + str(len(files) + 1) + '.fits'
-        
-        object.write(cachedir / fname, overwrite = True)
-        return(fname, cachedir)
+            raise Exception('Frame range ' + str(lo) + ' to ' + str(hi) + ' does not fit 16 bit integers exactly, set scale = True to allow scaling.')
+        return hdus
+
+    def mkcacheObj(self, object, subcache = False):
+        '''
+        mkcacheObj stores an object in the Dorado cache. Objects are named by the hash of their 
+        content, so storing the same object twice only writes it once. See 'Cache.put'.
+
+        Parameters
+        ----------
+        object: CCDdata
+            Object to cache.
+
+        subcache: str
+            Subdirectory of the cache to store the object in. Optional.
+
+        Returns
+        -------
+        fname: str
+            File name of the cached object.
+
+        cachedir: path-like
+            Directory the object is cached in.
+        '''
+        return self.cache.put(object, subcache)
 
     def delcacheObj(self, fname, subcache = False):
         if subcache:
@@ -393,7 +927,7 @@ class Filer:
 
         os.remove(cachedir / fname)
     
-    def plate_solve(self, dirarray, data = None, writearray = False):
+    def plate_solve(self, dirarray, data = None, writearray = False, **settings):
         path = self.dordir
         for dir in dirarray:
             path = path / dir
@@ -401,26 +935,7 @@ class Filer:
         if data == None:
             data = CCDData.read(path, unit = self.unit)
 
-        trying = True
-        submission_id = None
-        num = 0
-
-        while trying:
-                try:
-                    if not submission_id:
-                        wcs_header = ast.solve_from_image(path, force_image_upload=True, submission_id=submission_id, solve_timeout=300)
-                    else:
-                        print('Monitoring: try #', num)
-                        wcs_header = ast.monitor_submission(submission_id, solve_timeout=300)
-                except TimeoutError as e:
-                    print(TimeoutError)
-                    num = num + 1
-                    print('Timed out: try #', num)
-                    submission_id = e.args[1]
-
-                if wcs_header != None:
-                    # got a result, so terminate while loop
-                    trying = False
+        wcs_header = SolveQueue(self.solver, concurrency = 1).solve_one(path, settings)
         if wcs_header:
             # Code to execute when solve succeeds
             print('Solve succeeded! :)')
@@ -438,6 +953,139 @@ class Filer:
             print('Solve failed! :(')
             return 
 
+    def pointing(self, header):
+        '''
+        pointing reads the approximate field center recorded by the telescope from a header.
+
+        Parameters
+        ----------
+        header: 'astropy.io.fits.Header'
+            Header of the frame.
+
+        Returns
+        -------
+        pointing: tuple or None
+            (ra, dec) in degrees, or None if the header has no pointing information.
+        '''
+        for rakey, deckey in (('RA', 'DEC'), ('OBJCTRA', 'OBJCTDEC')):
+            if (rakey in header) and (deckey in header):
+                ra = header[rakey]
+                dec = header[deckey]
+                try:
+                    if isinstance(ra, str):
+                        c = SkyCoord(ra, dec, unit = (un.hourangle, un.deg))
+                    else:
+                        c = SkyCoord(ra, dec, unit = (un.deg, un.deg))
+                    return (c.ra.deg, c.dec.deg)
+                except:
+                    continue
+        return None
+
+    def solveWCS(self, image, cache = True, radius = 1.0):
+        '''
+        solveWCS plate solves a single image, see 'solveMany'.
+
+        Parameters
+        ----------
+        image: CCDdata
+            Frame to solve.
+
+        cache: Boolean
+            Whether to use the plate solution cache. Default is 'True'. Optional.
+
+        radius: float
+            Maximum distance in degrees between the header pointing and a cached solution. Default is 1. Optional.
+
+        Returns
+        -------
+        solved: CCDdata
+            Copy of the image carrying the WCS header.
+
+        wcs_header: 'astropy.io.fits.Header'
+            WCS header of the solution.
+        '''
+        return self.solveMany([image], cache = cache, radius = radius)[0]
+
+    def solveMany(self, images, cache = True, radius = 1.0):
+        '''
+        solveMany plate solves a batch of images, consulting the plate solution cache first. 
+        Solutions are keyed by the content hash of the frame, so a repeat solve of the same frame
+        returns without contacting the solver. A cached solution is only used if its field center 
+        lies within 'radius' of the pointing in the frame header, so a different field never receives
+        a stale solution. The remaining frames are submitted together through a SolveQueue using
+        'self.solver', with the nearest known solution to each pointing passed as a center and
+        pixel scale hint. The copies of the frames uploaded to the solver are removed from the cache
+        once the batch is solved.
+
+        Parameters
+        ----------
+        images: list[CCDdata]
+            Frames to solve.
+
+        cache: Boolean
+            Whether to use the plate solution cache. Default is 'True'. Optional.
+
+        radius: float
+            Maximum distance in degrees between the header pointing and a cached solution. Default is 1. Optional.
+
+        Returns
+        -------
+        results: list[tuple]
+            (solved, wcs_header) for each image in order, None where the solve failed.
+        '''
+        results = [None] * len(images)
+        pending = []
+        paths = []
+        settings = []
+        for i, image in enumerate(images):
+            key = self.cache.key(image)
+            pointing = self.pointing(image.header)
+            if cache:
+                row = self.archive.find_solution(key)
+                if (row != None) and ((pointing == None) or (separation(pointing[0], pointing[1], row['ra'], row['dec']) <= radius)):
+                    print('Using cached plate solution.')
+                    wcs_header = fits.Header.fromstring(row['header'])
+                    solved = image.copy()
+                    solved.header = wcs_header
+                    results[i] = (solved, wcs_header)
+                    continue
+
+            hint = {}
+            if pointing != None:
+                hint = {'center_ra': pointing[0], 'center_dec': pointing[1], 'radius': radius}
+                near = self.archive.near_solution(pointing[0], pointing[1], radius)
+                if near != None:
+                    hint['scale_units'] = 'arcsecperpix'
+                    hint['scale_type'] = 'ev'
+                    hint['scale_est'] = near['scale']
+                    hint['scale_err'] = 10
+            fname, cachedir = self.mkcacheObj(image, 'astrometryNet')
+            pending.append((i, key))
+            paths.append(cachedir / fname)
+            settings.append(hint)
+
+        if len(pending) != 0:
+            print('Plate solving ', len(pending), ' frames.')
+            queue = SolveQueue(self.solver, concurrency = self.solve_concurrency)
+            try:
+                for (i, key), wcs_header in zip(pending, queue.solve(paths, settings)):
+                    if wcs_header == None:
+                        continue
+                    solved = images[i].copy()
+                    solved.header = wcs_header
+                    w = WCS(wcs_header)
+                    scale = float(np.mean(proj_plane_pixel_scales(w)) * 3600)
+                    self.archive.add_solution(key, float(w.wcs.crval[0]), float(w.wcs.crval[1]), scale, wcs_header)
+                    results[i] = (solved, wcs_header)
+            finally:
+                # solutions are kept in the archive, the uploaded copies are no longer needed
+                for path in set(paths):
+                    try:
+                        self.delcacheObj(path.name, 'astrometryNet')
+                    except FileNotFoundError:
+                        pass
+        return results
+
     def getDateString(self, cr):
         ## TODO :: look into UTC wrecking stuff
         day = str(cr.date.ymdhms['day'])
@@ -467,7 +1115,30 @@ class Filer:
         os.makedirs(wrkdir / datestr / 'WCS', exist_ok = True)
         # figures, targets, log, omitted images, observation metadata
         
-    def savewrk(self, cr, filters = None):
+    def savewrk(self, cr, filters = None, workers = None, compress = None, force16 = False):
+        '''
+        savewrk writes the frames of a Ceres instance to the nights working directory, frames
+        are written concurrently and atomically, see 'write_frames'.
+
+        Parameters
+        ----------
+        cr: Ceres instance
+            Ceres instance to save.
+
+        filters: list
+            Filters to save. Defaults to every filter of 'cr'. Optional.
+
+        workers: int
+            Number of writer threads. Defaults to 'self.workers'. Optional.
+
+        compress: str
+            Lossless FITS tile compression for integer frames, 'RICE_1' or 'GZIP_1'. Default is 
+            'None'. Optional.
+
+        force16: Boolean
+            Whether to store frames as 16 bit integers, halving the size of float32 frames, see 
+            'force16'. Default is 'False'. Optional.
+        '''
         wrkdir = self.dordir / 'data' / 'wrk'
         if cr.datestr == None:
             self.getDateString(cr)
@@ -519,10 +1190,16 @@ class Filer:
                 fsub = ''
 
                 
+            items = []
             for p in range(len(fildat.data)):
-                image = fildat.data[p]
                 fname = fplate + str(p) + fsub + '.fits'
-                image.write(wrdir / fname, overwrite = True)
+                items.append((partial(fildat.frame, p), wrdir / fname))
+            self.write_frames(items, workers, compress, force16)
+
+            if fildat.calibrated == True:
+                self.mark_processed(cr, 'calibrated', [filter])
+            if fildat.aligned == True:
+                self.mark_processed(cr, 'aligned', [filter])
 
     def saveWCS(self, cr, filters = None):
         wrkdir = self.dordir / 'data' / 'wrk'
@@ -533,13 +1210,189 @@ class Filer:
         if filters == None:
             filters = cr.filters.keys()
         
+        # solve every filter still lacking a WCS at once
+        pending = [filter for filter in filters if cr.data[cr.filters[filter]].wcs == None]
+        if len(pending) != 0:
+            cr.getWCS(pending, self)
         for filter in filters:
-            stack = cr.data[cr.filters[filter]]
-            if stack.wcs == None:
-                cr.getWCS(filter, self)
             fname = str(filter) + '-solved.fits'
             solved = cr.data[cr.filters[filter]].solved
             solved.write(wrkdir / datestr / 'WCS' / fname, overwrite = True)
+
+    def savecube(self, cr, filters = None):
+        '''
+        savecube writes each stack of a Ceres instance to a single FITS file in the nights working
+        directory as an alternative to one file per frame. The primary HDU holds every frame as one 
+        contiguous data cube and a 'FRAMES' table holds each frame's time, exposure, source file, 
+        registration transform and full header. Frames are streamed to disk one at a time, so lazy 
+        stacks are never loaded whole. Unsigned integer frames are stored as the next larger signed
+        type, which FITS can hold without BZERO scaling, so the cube can be memory-mapped on load.
+
+        Parameters
+        ----------
+        cr: Ceres instance
+            Ceres instance to save.
+
+        filters: list
+            Filters to save. Defaults to every filter of 'cr'. Optional.
+
+        Returns
+        -------
+        paths: list
+            Path of each cube written, see 'loadcube'.
+        '''
+        wrkdir = self.dordir / 'data' / 'wrk'
+        if cr.datestr == None:
+            self.getDateString(cr)
+        datestr = cr.datestr
+        self.mkwrk(cr)
+        if filters == None:
+            filters = cr.filters.keys()
+
+        paths = []
+        for filter in filters:
+            fildat = cr.data[cr.filters[filter]]
+            if (fildat.target == None):
+                fplate = str(int(cr.date.mjd)) + '-' + filter + '_'
+            else:
+                fplate = str(fildat.target.name) + '-' + filter + '_' 
+            if (fildat.calibrated == True) and (fildat.aligned == True): 
+                path = wrkdir / datestr / 'aligned' / (fplate + 'cube_ca.fits')
+            elif (fildat.calibrated == True):
+                path = wrkdir / datestr / 'calibrated' / (fplate + 'cube_c.fits')
+            else: 
+                path = wrkdir / datestr / 'uncalibrated' / (fplate + 'cube.fits')
+            print('Saving ', filter, ' cube to ', path)
+            self.writeCube(fildat, path)
+            paths.append(path)
+        return paths
+
+    def writeCube(self, stack, path):
+        '''
+        writeCube writes a stack to a single FITS cube through a temporary file, see 'savecube'.
+
+        Parameters
+        ----------
+        stack: Stack
+            Stack to write.
+
+        path: path-like
+            Destination file.
+        '''
+        path = Path(path)
+        tmp = path.parent / ('.' + path.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+        def signed(dtype):
+            if (dtype.kind == 'u') and (dtype.itemsize > 1):
+                return np.dtype('int' + str(16 * dtype.itemsize))
+            return dtype
+
+        nframes = len(stack.data)
+        first = stack.frame(0)
+        dtype = signed(first.data.dtype).newbyteorder('>')
+
+        header = fits.Header()
+        header['SIMPLE'] = True
+        if dtype.kind == 'f':
+            header['BITPIX'] = -8 * dtype.itemsize
+        else:
+            header['BITPIX'] = 8 * dtype.itemsize
+        header['NAXIS'] = 3
+        header['NAXIS1'] = first.data.shape[1]
+        header['NAXIS2'] = first.data.shape[0]
+        header['NAXIS3'] = nframes
+        header['FILTER'] = stack.filter
+        header['BUNIT'] = str(first.unit)
+        header['CALIBRAT'] = (stack.calibrated == True)
+        header['ALIGNED'] = (stack.aligned == True)
+        header['ALIGNTO'] = stack.alignTo
+        if stack.target != None:
+            header['OBJECT'] = str(stack.target.name)
+        if stack.wcs != None:
+            # the reference solution, the cube axis is not part of it
+            header.extend(stack.wcs.to_header(), unique = True)
+        del first
+
+        dateobs = []
+        mjd = []
+        exptime = []
+        headers = []
+        try:
+            hdu = fits.StreamingHDU(tmp, header)
+            for image in stack.frames():
+                hdu.write(np.asarray(image.data, dtype = dtype))
+                dateobs.append(image.header.get('DATE-OBS', ''))
+                exptime.append(image.header.get('EXPTIME', np.nan))
+                headers.append(image.header.tostring())
+            hdu.close()
+
+            for i in range(nframes):
+                try:
+                    mjd.append(stack.times[i].mjd)
+                except Exception:
+                    mjd.append(np.nan)
+            if len(stack.transforms) == nframes:
+                transforms = np.array([np.ravel(matrix) for matrix in stack.transforms])
+            else:
+                transforms = np.full((nframes, 9), np.nan)
+            if len(stack.sources) == nframes:
+                sources = [os.fspath(source) for source in stack.sources]
+            else:
+                sources = [''] * nframes
+            cols = [fits.Column(name = 'DATE-OBS', format = str(max(len(d) for d in dateobs + ['x'])) + 'A', array = dateobs),
+                    fits.Column(name = 'MJD', format = 'D', array = mjd),
+                    fits.Column(name = 'EXPTIME', format = 'D', array = exptime),
+                    fits.Column(name = 'SOURCE', format = str(max(len(p) for p in sources + ['x'])) + 'A', array = sources),
+                    fits.Column(name = 'TRANSFORM', format = '9D', array = transforms),
+                    fits.Column(name = 'HEADER', format = str(max(len(h) for h in headers)) + 'A', array = headers)]
+            with fits.open(tmp, mode = 'append') as hdus:
+                hdus.append(fits.BinTableHDU.from_columns(cols, name = 'FRAMES'))
+                if stack.flat is not None:
+                    flat = np.asarray(stack.flat.data)
+                    hdus.append(fits.ImageHDU(flat.astype(signed(flat.dtype)), name = 'FLAT'))
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def loadcube(self, path):
+        '''
+        loadcube opens a stack cube written by 'savecube'. The data cube is memory-mapped and each
+        frame is a view into it, so opening a night costs a single file open regardless of how many
+        frames it holds and pixels are only read when used.
+
+        Parameters
+        ----------
+        path: path-like
+            Cube file.
+
+        Returns
+        -------
+        stack: Stack
+            Stack of the cube frames, with times, sources, transforms and WCS restored.
+        '''
+        hdus = fits.open(path, memmap = True)
+        header = hdus[0].header
+        cube = hdus[0].data
+        table = hdus['FRAMES'].data
+        unit = header.get('BUNIT', self.unit)
+        data = []
+        for i in range(len(table)):
+            data.append(CCDData(cube[i], unit = unit, header = fits.Header.fromstring(table['HEADER'][i])))
+        times = list(Time(list(table['DATE-OBS']), format = 'fits'))
+        flat = None
+        if 'FLAT' in hdus:
+            flat = CCDData(hdus['FLAT'].data, unit = unit)
+        sources = [source for source in table['SOURCE'] if source != '']
+        stack = Stack(data, flat = flat, filter = header.get('FILTER', ''), times = times, 
+                      calibrated = header.get('CALIBRAT', None), aligned = header.get('ALIGNED', None), 
+                      alignTo = header.get('ALIGNTO', 0), unit = unit, sources = sources)
+        if 'CTYPE1' in header:
+            stack.wcs = WCS(header, naxis = 2)
+        if not np.isnan(table['TRANSFORM']).any():
+            stack.transforms = [np.reshape(matrix, (3, 3)) for matrix in table['TRANSFORM']]
+            if stack.wcs != None:
+                stack.propagate_wcs()
+        return stack
             
 
 
@@ -555,7 +1408,6 @@ class Filer:
 # if there is no calibration files in dorado send a warning and set 
 # calibration files to none
 
-# make a function to force uint16
 
 
 
@@ -0,0 +1,555 @@
+import os
+import time
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from astropy.wcs.utils import fit_wcs_from_points
+from astropy.coordinates import SkyCoord
+from astropy.stats import sigma_clipped_stats
+import astropy.units as un
+from photutils import DAOStarFinder
+from astroquery.astrometry_net import AstrometryNet
+from astroquery.exceptions import TimeoutError
+
+__all__ = ['AstrometryNetSolver', 'LocalSolver', 'SolveQueue']
+
+'''
+'dorado.filer.solver' holds the plate solver backends and the SolveQueue used by Filer to
+solve many frames concurrently. A backend is any object providing the two methods below,
+which lets the queue run against a local stand-in server or an offline solver:
+
+    submit(path, **settings) -> (submission_id, wcs_header or None)
+    poll(submission_id)      -> wcs_header, or None while the solve is pending
+
+A solved header is a non-empty 'astropy.io.fits.Header', an empty header or dictionary
+denotes a failed solve.
+'''
+
+
+class AstrometryNetSolver:
+    '''
+    The AstrometryNetSolver class is the solver backend for the astrometry.net web service,
+    wrapping the astroquery client so that submitting and polling never block for long.
+
+    Attributes
+    ----------
+
+    client: 'astroquery.astrometry_net.AstrometryNetClass'
+        Client used to contact astrometry.net. Optional.
+
+    timeout: float
+        Seconds each submit or poll call may wait on the service. Default is 0, a single status check.
+
+    '''
+    def __init__(self, client = None, timeout = 0):
+        if client == None:
+            client = AstrometryNet()
+        self.client = client
+        self.timeout = timeout
+
+    def submit(self, path, **settings):
+        try:
+            wcs_header = self.client.solve_from_image(os.fspath(path), force_image_upload = True, solve_timeout = self.timeout,
+                                                      verbose = False, return_submission_id = True, **settings)
+        except TimeoutError as e:
+            return e.args[1], None
+        return wcs_header[1], wcs_header[0]
+
+    def poll(self, submission_id):
+        try:
+            return self.client.monitor_submission(submission_id, solve_timeout = self.timeout, verbose = False)
+        except TimeoutError:
+            return None
+
+
+class LocalSolver:
+    '''
+    The LocalSolver class is an offline solver backend which matches the stars detected in a
+    frame against an on-disk reference catalog, so frames can be solved without network access.
+    Triangles are formed between each star and its nearest neighbours, and the ratios of their
+    side lengths, which do not depend on position, rotation or scale, are matched through a KD-tree
+    index of the catalog triangles. Each matched triangle proposes a pixel to sky mapping which is
+    accepted once enough stars agree with it, and the WCS is then fit to every matched star.
+
+    When the solver settings carry a pointing ('center_ra', 'center_dec', 'radius' in degrees, as
+    passed by 'Filer.solveMany') only catalog stars near the pointing are considered, otherwise the
+    whole catalog is indexed once and searched. A pixel scale, from the astrometry.net style scale
+    settings or the solver's own 'scale_lower' and 'scale_upper', thins the catalog stars near the
+    pointing to about twice the detected sources per field and rejects any mapping of another scale.
+    A mapping is only accepted when far more stars agree with it than would by chance, given how many
+    catalog stars it projects into the frame and how densely the sources cover it.
+
+    Attributes
+    ----------
+
+    catalog: str or path-like
+        Table readable by 'astropy.table.Table.read' with 'ra' and 'dec' columns in degrees and
+        optionally a 'mag' column used to prefer bright stars.
+
+    max_stars: int
+        Number of the brightest detected sources, and of the brightest catalog stars near a
+        pointing, used to form triangles. Default is 40. Optional.
+
+    neighbours: int
+        Number of nearest neighbours each star forms triangles with. Default is 6. Optional.
+
+    fwhm: float
+        FWHM in pixels used for source detection. Default is 3. Optional.
+
+    threshold: float
+        Detection threshold in units of the background standard deviation. Default is 5. Optional.
+
+    min_matches: int
+        Number of stars which must agree with a solution. Default is 8. Optional.
+
+    tolerance: float
+        Distance in pixels within which a catalog star matches a source. Default is 3. Optional.
+
+    scale_lower, scale_upper: float
+        Expected range of the pixel scale in arcseconds per pixel, used when the solver settings carry
+        no scale. Optional.
+
+    significance: float
+        Number of standard deviations above the expected number of chance matches which a mapping 
+        must reach to be accepted. Default is 5. Optional.
+
+    '''
+    def __init__(self, catalog, max_stars = 40, neighbours = 6, fwhm = 3, threshold = 5, min_matches = 8, tolerance = 3,
+                 scale_lower = None, scale_upper = None, significance = 5):
+        self.catalog = catalog
+        self.max_stars = max_stars
+        self.neighbours = neighbours
+        self.fwhm = fwhm
+        self.threshold = threshold
+        self.min_matches = min_matches
+        self.tolerance = tolerance
+        self.scale_lower = scale_lower
+        self.scale_upper = scale_upper
+        self.significance = significance
+        self.invariant_tolerance = 0.01
+        self.max_hypotheses = 5000
+        self._stars = None
+        self._index = None
+
+    def load(self):
+        '''
+        load reads the reference catalog and builds the KD-tree of star positions. The catalog
+        is only read once per solver.
+
+        Returns
+        -------
+        ra, dec: array
+            Catalog positions in degrees, brightest first when magnitudes are given.
+
+        vectors: array
+            Catalog positions as unit vectors.
+
+        tree: 'scipy.spatial.cKDTree'
+            KD-tree of the unit vectors.
+        '''
+        if self._stars == None:
+            table = Table.read(self.catalog)
+            names = dict((name.lower(), name) for name in table.colnames)
+            ra = np.asarray(table[names.get('ra', names.get('raj2000'))], dtype = float)
+            dec = np.asarray(table[names.get('dec', names.get('dej2000'))], dtype = float)
+            if 'mag' in names:
+                order = np.argsort(np.asarray(table[names['mag']], dtype = float), kind = 'stable')
+                ra = ra[order]
+                dec = dec[order]
+            vectors = unitvectors(ra, dec)
+            self._stars = (ra, dec, vectors, cKDTree(vectors))
+        return self._stars
+
+    def detect(self, data):
+        '''
+        detect finds the brightest sources in an image.
+
+        Parameters
+        ----------
+        data: array
+            Image data.
+
+        Returns
+        -------
+        xy: array
+            (n, 2) pixel positions of the brightest sources, brightest first.
+        '''
+        mean, median, std = sigma_clipped_stats(data, sigma = 3.0, maxiters = 5)
+        daofind = DAOStarFinder(fwhm = self.fwhm, threshold = self.threshold * std)
+        sources = daofind(data - median)
+        if sources is None:
+            return np.zeros((0, 2))
+        sources.sort('flux')
+        sources.reverse()
+        sources = sources[:self.max_stars]
+        return np.transpose([np.asarray(sources['xcentroid']), np.asarray(sources['ycentroid'])])
+
+    def submit(self, path, **settings):
+        data = fits.getdata(path).astype(float)
+        return None, self.solve(data, **settings)
+
+    def poll(self, submission_id):
+        # solves complete within submit
+        return {}
+
+    def solve(self, data, center_ra = None, center_dec = None, radius = None, **settings):
+        '''
+        solve plate solves image data against the reference catalog.
+
+        Parameters
+        ----------
+        data: array
+            Image data.
+
+        center_ra, center_dec: float
+            Pointing hint in degrees. Optional.
+
+        radius: float
+            Radius of the pointing hint in degrees. Optional.
+
+        settings:
+            Pixel scale hint in the astrometry.net form, 'scale_units' ('arcsecperpix', 'arcminwidth' 
+            or 'degwidth') with either 'scale_type' 'ev', 'scale_est' and 'scale_err' in percent, or 
+            'scale_type' 'ul', 'scale_lower' and 'scale_upper'. Optional.
+
+        Returns
+        -------
+        wcs_header: 'astropy.io.fits.Header'
+            WCS header of the solution in the CD matrix form returned by astrometry.net, or an empty
+            header if the frame could not be solved.
+        '''
+        ra, dec, vectors, tree = self.load()
+        xy = self.detect(data)
+        if len(xy) < 3:
+            return fits.Header()
+        img_inv, img_tri = triangles(xy, self.neighbours)
+        lower, upper = self.scale_range(data.shape, **settings)
+
+        if (center_ra != None) and (center_dec != None) and (radius != None):
+            # catalog order is brightness order
+            near = np.array(sorted(tree.query_ball_point(unitvectors(center_ra, center_dec), chord(radius))), dtype = int)
+            subset = near
+            if upper != None:
+                # keep about twice as many catalog stars per field footprint as sources are detected
+                footprint = (lower * upper / 3600**2) * data.shape[0] * data.shape[1]
+                cone = np.pi * min(radius, 90)**2
+                subset = near[:int(np.ceil(2 * self.max_stars * max(1, cone / footprint)))]
+            if len(subset) < 3:
+                return fits.Header()
+            cat_inv, cat_tri = triangles(vectors[subset], self.neighbours)
+            cat_tri = subset[cat_tri]
+            inv_tree = cKDTree(cat_inv)
+        else:
+            # the whole catalog index is built once and kept on the solver
+            if self._index == None:
+                cat_inv, cat_tri = triangles(vectors, self.neighbours)
+                self._index = (cat_inv, cat_tri, cKDTree(cat_inv))
+            cat_inv, cat_tri, inv_tree = self._index
+        if len(img_inv) == 0 or len(cat_inv) == 0:
+            return fits.Header()
+
+        # rank candidate triangle pairs by how closely their invariants agree
+        dist, idx = inv_tree.query(img_inv, k = 4, distance_upper_bound = self.invariant_tolerance)
+        pairs = [(dist[i, j], i, idx[i, j]) for i in range(len(img_inv)) for j in range(idx.shape[1]) if np.isfinite(dist[i, j])]
+        pairs.sort()
+
+        xy_tree = cKDTree(xy)
+        best = None
+        for _, i, j in pairs[:self.max_hypotheses]:
+            stars = cat_tri[j]
+            ra0, dec0 = ra[stars].mean(), dec[stars].mean()
+            # field radius from the triangle scale, used to gather the catalog stars to verify against
+            sky = np.transpose(gnomonic(ra[stars], dec[stars], ra0, dec0))
+            fit = affine(xy[img_tri[i]], sky)
+            if fit is None:
+                continue
+            scale = np.sqrt(abs(np.linalg.det(fit[:, :2])))
+            if (lower != None) and not (lower <= scale * 3600 <= upper):
+                continue
+            extent = scale * np.hypot(*data.shape)
+            cand = np.array(tree.query_ball_point(unitvectors(ra0, dec0), chord(extent)), dtype = int)
+            src, cat, inside = self.verify(fit, xy_tree, ra[cand], dec[cand], ra0, dec0, data.shape)
+            needed = self.required(inside, len(xy), data.shape)
+            if len(src) < needed:
+                continue
+            if (best == None) or (len(src) > len(best[0][0])):
+                best = ((src, cand[cat]), ra0, dec0)
+            if len(src) >= max(needed, len(xy) // 2):
+                break
+
+        if best == None:
+            return fits.Header()
+        (src, cat), ra0, dec0 = best
+        world = SkyCoord(ra[cat], dec[cat], unit = (un.deg, un.deg))
+        w = fit_wcs_from_points((xy[src, 0], xy[src, 1]), world, projection = 'TAN')
+        return cdheader(w, data.shape)
+
+    def verify(self, fit, xy_tree, ra, dec, ra0, dec0, shape):
+        '''
+        verify counts the detected sources which agree with a proposed pixel to sky mapping.
+
+        Returns
+        -------
+        src, cat: array
+            Indices of the matched sources and of the matching catalog stars.
+
+        inside: int
+            Number of catalog stars the mapping places within the frame.
+        '''
+        if len(ra) == 0:
+            return np.zeros(0, dtype = int), np.zeros(0, dtype = int), 0
+        xi, eta = gnomonic(ra, dec, ra0, dec0)
+        try:
+            inverse = np.linalg.inv(np.vstack([fit, [0, 0, 1]]))
+        except np.linalg.LinAlgError:
+            return np.zeros(0, dtype = int), np.zeros(0, dtype = int), 0
+        pix = (inverse @ np.vstack([xi, eta, np.ones(len(xi))]))[:2].T
+        inside = np.isfinite(pix).all(axis = 1) & (pix[:, 0] > -self.tolerance) & (pix[:, 1] > -self.tolerance) & \
+                 (pix[:, 0] < shape[1] + self.tolerance) & (pix[:, 1] < shape[0] + self.tolerance)
+        dist, src = xy_tree.query(pix[inside], distance_upper_bound = self.tolerance)
+        found = np.isfinite(dist)
+        cat = np.flatnonzero(inside)[found]
+        src = src[found]
+        # keep one catalog star per source
+        src, first = np.unique(src, return_index = True)
+        return src, cat[first], int(np.count_nonzero(inside))
+
+    def required(self, inside, sources, shape):
+        '''
+        required returns the number of matches a mapping needs to be accepted. A catalog star placed
+        in the frame lands within 'tolerance' of one of the sources by chance with a probability set
+        by how much of the frame the sources cover, so a mapping projecting many catalog stars into 
+        the frame, such as one of too large a scale, collects many chance matches. The threshold is
+        'significance' standard deviations above the expected chance matches, and at least 'min_matches'.
+        '''
+        covered = min(1.0, sources * np.pi * self.tolerance**2 / (shape[0] * shape[1]))
+        expected = inside * covered
+        return int(max(self.min_matches, np.ceil(expected + self.significance * np.sqrt(expected))))
+
+    def scale_range(self, shape, scale_units = None, scale_type = None, scale_est = None, scale_err = None,
+                    scale_lower = None, scale_upper = None, **settings):
+        '''
+        scale_range converts astrometry.net style scale settings into a range of pixel scales.
+
+        Returns
+        -------
+        lower, upper: float
+            Pixel scale range in arcseconds per pixel, the solver's own range (or None) without settings.
+        '''
+        if scale_type == 'ev' and scale_est != None:
+            err = 0.2 if scale_err == None else scale_err / 100
+            scale_lower, scale_upper = scale_est * (1 - err), scale_est * (1 + err)
+        elif scale_type != 'ul':
+            scale_lower, scale_upper = None, None
+        if (scale_lower == None) or (scale_upper == None):
+            return self.scale_lower, self.scale_upper
+        factor = {'arcsecperpix': 1.0, 'arcminwidth': 60.0 / shape[1], 'degwidth': 3600.0 / shape[1]}.get(scale_units, 1.0)
+        return scale_lower * factor, scale_upper * factor
+
+
+def unitvectors(ra, dec):
+    '''
+    unitvectors converts positions in degrees into cartesian unit vectors.
+    '''
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.transpose([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def chord(angle):
+    '''
+    chord returns the distance between unit vectors separated by 'angle' degrees.
+    '''
+    return 2 * np.sin(np.radians(min(angle, 180)) / 2)
+
+
+def gnomonic(ra, dec, ra0, dec0):
+    '''
+    gnomonic projects positions onto the plane tangent to the sky at (ra0, dec0), all in degrees.
+    '''
+    ra, dec, ra0, dec0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    cosc = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    cosc = np.where(cosc > 0, cosc, np.nan)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cosc
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cosc
+    return np.degrees(xi), np.degrees(eta)
+
+
+def affine(src, dst):
+    '''
+    affine fits the 2x3 affine matrix mapping 'src' points onto 'dst' points by least squares,
+    returning None for degenerate point sets.
+    '''
+    A = np.hstack([src, np.ones((len(src), 1))])
+    if np.linalg.matrix_rank(A) < 3:
+        return None
+    fit, _, _, _ = np.linalg.lstsq(A, dst, rcond = None)
+    return fit.T
+
+
+def triangles(points, neighbours):
+    '''
+    triangles forms the triangles between each point and its nearest neighbours and computes
+    their invariants, the ratios of the longest to middle and middle to shortest side. Vertices
+    are ordered by the length of their opposite side, longest first, so that matching triangles
+    list corresponding vertices in the same order.
+
+    Parameters
+    ----------
+    points: array
+        (n, d) point positions.
+
+    neighbours: int
+        Number of nearest neighbours of each point to form triangles with.
+
+    Returns
+    -------
+    invariants: array
+        (m, 2) triangle invariants.
+
+    vertices: array
+        (m, 3) indices of the triangle vertices.
+    '''
+    points = np.asarray(points)
+    if len(points) < 3:
+        return np.zeros((0, 2)), np.zeros((0, 3), dtype = int)
+    k = min(neighbours + 1, len(points))
+    _, nearest = cKDTree(points).query(points, k)
+    tris = set()
+    for i, row in enumerate(nearest):
+        for a, b in combinations(row[1:], 2):
+            tris.add(tuple(sorted((i, a, b))))
+    tris = np.array(sorted(tris), dtype = int)
+    p = points[tris]
+    sides = np.transpose([np.linalg.norm(p[:, 1] - p[:, 2], axis = 1),
+                          np.linalg.norm(p[:, 0] - p[:, 2], axis = 1),
+                          np.linalg.norm(p[:, 0] - p[:, 1], axis = 1)])
+    order = np.argsort(-sides, axis = 1)
+    sides = np.take_along_axis(sides, order, axis = 1)
+    good = sides[:, 2] > 0
+    invariants = np.transpose([sides[good, 0] / sides[good, 1], sides[good, 1] / sides[good, 2]])
+    return invariants, np.take_along_axis(tris, order, axis = 1)[good]
+
+
+def cdheader(w, shape):
+    '''
+    cdheader writes a fitted WCS as a header in the CD matrix form used by astrometry.net.
+    '''
+    cd = WCS(naxis = 2)
+    cd.wcs.ctype = w.wcs.ctype
+    cd.wcs.crval = w.wcs.crval
+    cd.wcs.crpix = w.wcs.crpix
+    cd.wcs.pc = w.pixel_scale_matrix
+    header = cd.to_header()
+    # astropy always writes PCi_j with unit CDELT, rename them to the equivalent CDi_j
+    for key in ['CDELT1', 'CDELT2']:
+        if key in header:
+            del header[key]
+    for i in (1, 2):
+        for j in (1, 2):
+            pc = 'PC' + str(i) + '_' + str(j)
+            if pc in header:
+                header.rename_keyword(pc, 'CD' + str(i) + '_' + str(j))
+    header['IMAGEW'] = shape[1]
+    header['IMAGEH'] = shape[0]
+    return header
+
+
+class SolveQueue:
+    '''
+    The SolveQueue class submits a batch of frames to a solver backend at once and polls the
+    pending solves with exponential backoff, with at most 'concurrency' solves in flight.
+
+    Attributes
+    ----------
+
+    solver: solver backend
+        Backend providing 'submit' and 'poll', see 'AstrometryNetSolver'.
+
+    concurrency: int
+        Maximum number of solves in flight. Default is 4.
+
+    delay: float
+        Seconds to wait before the first poll. Default is 2.
+
+    backoff: float
+        Factor the wait grows by after each pending poll. Default is 2.
+
+    max_delay: float
+        Longest wait between polls in seconds. Default is 60.
+
+    timeout: float
+        Seconds after which a solve is abandoned. Default is 600.
+
+    '''
+    def __init__(self, solver, concurrency = 4, delay = 2, backoff = 2, max_delay = 60, timeout = 600):
+        self.solver = solver
+        self.concurrency = concurrency
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def solve_one(self, path, settings = {}):
+        '''
+        solve_one submits a single frame and polls it until it is solved, fails, or times out.
+
+        Parameters
+        ----------
+        path: str or path-like
+            Location of the frame to solve.
+
+        settings: dict
+            Solver settings such as a center or scale hint. Optional.
+
+        Returns
+        -------
+        wcs_header: 'astropy.io.fits.Header' or None
+            The solution, or None if the solve failed, raised an error or timed out.
+        '''
+        start = time.monotonic()
+        delay = self.delay
+        try:
+            submission_id, wcs_header = self.solver.submit(path, **settings)
+            while wcs_header is None:
+                if time.monotonic() - start > self.timeout:
+                    print('Solve timed out: ', os.fspath(path))
+                    return None
+                time.sleep(delay)
+                delay = min(delay * self.backoff, self.max_delay)
+                wcs_header = self.solver.poll(submission_id)
+        except Exception as e:
+            # one frame's upload or network error must not abort the rest of the batch
+            print('Solve failed: ', os.fspath(path), ': ', e)
+            return None
+        if not wcs_header:
+            print('Solve failed: ', os.fspath(path))
+            return None
+        return wcs_header
+
+    def solve(self, paths, settings = None):
+        '''
+        solve plate solves a batch of frames concurrently.
+
+        Parameters
+        ----------
+        paths: list[str or path-like]
+            Locations of the frames to solve.
+
+        settings: list[dict]
+            Solver settings for each frame. Optional.
+
+        Returns
+        -------
+        wcs_headers: list
+            Solution for each frame in the order of 'paths', None where the solve failed.
+        '''
+        if settings == None:
+            settings = [{}] * len(paths)
+        with ThreadPoolExecutor(max_workers = self.concurrency) as pool:
+            return list(pool.map(self.solve_one, paths, settings))
@@ -1,6 +1,11 @@
 import warnings
 warnings.filterwarnings('ignore')
+import os
+from pathlib import Path
+import numpy as np
 from astropy.time import Time
+from astropy.io import fits
+from astropy.nddata.ccddata import CCDData
 
 __all__ = ['Stack']
 
@@ -22,7 +27,7 @@ class Stack:
     ----------
 
     data: CCDdata array
-        Array of CCDdata images.
+        Array of CCDdata images. In lazy mode this is an array of file paths instead.
 
     flat: CCDdata
         Flatfield calibration frame for data stack. Optional
@@ -45,12 +50,42 @@ class Stack:
     alignTo: int
         Index of the image which all other stack images should be aligned to. Default is  0. Optional.
 
+    wcs: 'astropy.wcs.WCS'
+        WCS of the 'alignTo' reference frame, which also describes the pixel grid of resampled aligned frames.
+
+    transforms: list[array]
+        3x3 affine matrix of each frame mapping its native pixel coordinates onto the reference frame, set by
+        'Ceres.align'.
+
+    frame_wcs: list['astropy.wcs.WCS']
+        WCS of each frame's native pixel grid, derived from 'wcs' and 'transforms' by 'propagate_wcs'.
+
+    lazy: Boolean
+        Whether 'data' holds file paths that are memory-mapped on demand rather than loaded 
+        CCDdata images. Default is 'False'. Optional.
+
+    scratch: str or path-like
+        Directory where processed frames of a lazy stack are written. Required for processing 
+        a lazy stack. Optional.
+
+    unit: str or 'astropy.units.Unit'
+        Unit used when reading frames of a lazy stack. Default is 'adu'. Optional.
+
+    sources: list[str]
+        Raw file path of each frame, used to record which frames have been processed. Optional.
+
     '''
 
     ## TODO :: auto identify targets in stack
 
-    def __init__(self, data, flat = None, filter = '', times = [], calibrated = None, aligned = None, target = None, alignTo = 0):
+    def __init__(self, data, flat = None, filter = '', times = [], calibrated = None, aligned = None, target = None, alignTo = 0, lazy = False, scratch = None, unit = 'adu', sources = None):
         self.data = data
+        self.lazy = lazy
+        self.scratch = scratch
+        self.unit = unit
+        if sources == None:
+            sources = []
+        self.sources = sources
         self.flat = flat
         self.filter = filter
         self.length = len(data)
@@ -62,6 +97,8 @@ class Stack:
 
         self.times = times 
         self.wcs = None
+        self.transforms = []
+        self.frame_wcs = []
         self.alignTo = alignTo
         self.solved = None
         # include things like flux uncertainty etc.
@@ -70,7 +107,7 @@ class Stack:
 
         if self.filter == '':
             try:
-                self.filter = data[0].header['filter']
+                self.filter = self.header(0)['filter']
             except:
                 self.filter = ''
         
@@ -98,10 +135,134 @@ class Stack:
 
         '''
         times = []
-        for im in self.data:
-            times.append(Time(im.header['DATE-OBS'], format='fits'))
+        for i in range(len(self.data)):
+            times.append(Time(self.header(i)['DATE-OBS'], format='fits'))
         self.times = times
 
+    def header(self, index):
+        '''
+        header returns the FITS header of a frame in the stack. For a lazy stack only 
+        the header is read from file, the pixel data is left untouched.
+
+        Parameters
+        ----------
+        index: int
+            Index of the frame in the stack.
+
+        Returns
+        -------
+        header: 'astropy.io.fits.Header'
+            Header of the frame.
+        '''
+        if self.lazy:
+            return fits.getheader(self.data[index], imagehdu(self.data[index]))
+        return self.data[index].header
+
+    def frame(self, index):
+        '''
+        frame returns a frame of the stack as a CCDdata object. For a lazy stack the
+        frame is read from its file path with the pixel data memory-mapped, so it is 
+        only paged into memory when accessed and released once the frame is dropped.
+        Scaled integer data (BZERO/BSCALE, as written by most cameras for uint16) cannot
+        be memory-mapped by astropy and is read directly instead.
+
+        Parameters
+        ----------
+        index: int
+            Index of the frame in the stack.
+
+        Returns
+        -------
+        image: CCDdata
+            The requested frame, in the native byte order.
+        '''
+        if self.lazy:
+            hdu = imagehdu(self.data[index])
+            try:
+                image = CCDData.read(self.data[index], hdu = hdu, unit = self.unit, memmap = True)
+            except ValueError:
+                image = CCDData.read(self.data[index], hdu = hdu, unit = self.unit, memmap = False)
+            return native(image)
+        # frames of a loaded cube are big-endian views of the file
+        return native(self.data[index])
+
+    def frames(self):
+        '''
+        frames is a generator over the frames in the stack. For a lazy stack at most 
+        one frame is materialized at a time.
+
+        Parameters
+        ----------
+        None
+
+        Yields
+        ------
+        image: CCDdata
+            Each frame of the stack in order.
+        '''
+        for i in range(len(self.data)):
+            image = self.frame(i)
+            yield image
+            del image
+
+    def stash(self, image, index, suffix):
+        '''
+        stash stores a processed frame and returns the entry which should take its place 
+        in 'self.data'. A regular stack keeps the image itself, a lazy stack writes the image 
+        to the scratch directory and keeps only its path.
+
+        Parameters
+        ----------
+        image: CCDdata
+            Processed frame.
+
+        index: int
+            Index of the unprocessed frame in the stack, used to name the scratch file.
+
+        suffix: str
+            Suffix denoting the processing step, such as 'c' for calibrated.
+
+        Returns
+        -------
+        entry: CCDdata or str
+            The image, or the path it was written to for a lazy stack.
+        '''
+        if not self.lazy:
+            return image
+        if self.scratch == None:
+            raise Exception('Lazy stack has no scratch directory to write processed frames to.')
+        os.makedirs(self.scratch, exist_ok = True)
+        fname = Path(self.data[index]).stem + '_' + suffix + '.fits'
+        path = os.fspath(Path(self.scratch) / fname)
+        image.write(path, overwrite = True)
+        return path
+
+    def propagate_wcs(self):
+        '''
+        propagate_wcs derives the WCS of every frame's native pixel grid by composing the reference 
+        frame solution with each frame's registration transform, so a single plate solve serves
+        every frame in the stack. SIP distortion terms of the reference solution are defined on the 
+        reference grid and are not carried over.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Sets
+        ----
+        self.frame_wcs: list['astropy.wcs.WCS']
+            WCS of each frame in the stack.
+        '''
+        if self.wcs == None:
+            raise Exception('Stack has no WCS to propagate, see Ceres.getWCS().')
+        if len(self.transforms) != len(self.data):
+            raise Exception('Stack frames have no registration transforms, see Ceres.align().')
+        self.frame_wcs = [transform_wcs(self.wcs, matrix) for matrix in self.transforms]
+
     def get_target_info(self, target = None):
         '''
         get_target_info is a convinience function for setting an instance of TOI
@@ -123,4 +284,90 @@ class Stack:
         '''
         if target != None:
             self.target = target
-   
\ No newline at end of file
+   
+
+
+def native(image):
+    '''
+    native returns a frame with its pixel data in the native byte order. FITS stores data 
+    big-endian, which NumPy handles but compiled routines such as the resampling of 'skimage' 
+    reject. Frames already in the native byte order are returned as they are, others are copied
+    into a new frame so memory-mapped frames are left untouched.
+
+    Parameters
+    ----------
+    image: CCDdata
+        Frame to convert.
+
+    Returns
+    -------
+    image: CCDdata
+        The frame in the native byte order.
+    '''
+    if image.data.dtype.isnative:
+        return image
+    return CCDData(image.data.astype(image.data.dtype.newbyteorder('=')), unit = image.unit, meta = image.meta,
+                   mask = image.mask, uncertainty = image.uncertainty, wcs = image.wcs)
+
+
+def imagehdu(path):
+    '''
+    imagehdu finds the HDU holding the image of a FITS file. This is the primary HDU for
+    ordinary frames and the first extension for tile compressed frames, which CCDData.read
+    does not look for on its own.
+
+    Parameters
+    ----------
+    path: path-like
+        FITS file.
+
+    Returns
+    -------
+    hdu: int
+        Index of the first HDU with image data, 0 if there is none.
+    '''
+    with fits.open(path) as hdus:
+        return firstimage(hdus)
+
+def firstimage(hdus):
+    '''
+    firstimage is 'imagehdu' for an open 'astropy.io.fits.HDUList'.
+    '''
+    for i, hdu in enumerate(hdus):
+        if hdu.is_image and hdu.header.get('NAXIS', 0) > 0:
+            return i
+    return 0
+
+def transform_wcs(wcs, matrix):
+    '''
+    transform_wcs composes a WCS with an affine pixel transform. Given a 'matrix' which maps
+    (0-based) pixel coordinates of a frame onto the pixel grid described by 'wcs', the returned
+    WCS maps the frame's own pixel coordinates onto the sky.
+
+    Parameters
+    ----------
+    wcs: 'astropy.wcs.WCS'
+        WCS of the reference pixel grid.
+
+    matrix: array
+        3x3 affine matrix from frame to reference pixel coordinates.
+
+    Returns
+    -------
+    framewcs: 'astropy.wcs.WCS'
+        WCS of the frame.
+    '''
+    matrix = np.asarray(matrix)
+    A = matrix[:2, :2]
+    t = matrix[:2, 2]
+    framewcs = wcs.deepcopy()
+    framewcs.sip = None
+    framewcs.wcs.ctype = [c.replace('-SIP', '') for c in framewcs.wcs.ctype]
+    # reference pixel p_ref = A p + t, so the frame reference pixel is A^-1 (crpix_ref - t)
+    framewcs.wcs.crpix = np.linalg.solve(A, framewcs.wcs.crpix - 1 - t) + 1
+    if framewcs.wcs.has_cd():
+        framewcs.wcs.cd = framewcs.wcs.cd @ A
+    else:
+        framewcs.wcs.pc = framewcs.wcs.get_pc() @ A
+    framewcs.wcs.set()
+    return framewcs
@@ -89,6 +89,7 @@ class Target:
             fname = str(self.name) + '_' + str(fi) + '-' + str(int(cr.date.mjd)) + '.' + saveType
             wrts.toTable(self.name)
             wrts.table.write(wrdir / fname, overwrite = True)
+        filer.mark_processed(cr, 'photometry', [fi for fi in self.filters.keys() if fi in cr.filters])
         
     def export(self, filer, objectClass = None):
         '''
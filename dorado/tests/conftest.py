@@ -0,0 +1,110 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.time import Time, TimeDelta
+from astropy.wcs import WCS
+
+'''
+Shared fixtures for the Dorado tests, an isolated Dorado directory and a small synthetic night
+of bias, flat and light frames of a drifting star field.
+'''
+
+NY, NX = 200, 220
+
+
+def star_field(sx, sy, sf, dx = 0.0, dy = 0.0, sigma = 2.0):
+    '''
+    star_field renders Gaussian stars shifted by (dx, dy) pixels.
+    '''
+    yy, xx = np.mgrid[0:NY, 0:NX]
+    img = np.zeros((NY, NX))
+    for x, y, f in zip(sx, sy, sf):
+        img += f / (2 * np.pi * sigma**2) * np.exp(-((xx - x - dx)**2 + (yy - y - dy)**2) / (2 * sigma**2))
+    return img
+
+
+def field_wcs(scale = 0.0003, angle = 30, crval = (83.82, -5.39)):
+    '''
+    field_wcs is the TAN projection of the synthetic field, 'scale' in degrees per pixel.
+    '''
+    w = WCS(naxis = 2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = list(crval)
+    w.wcs.crpix = [NX / 2, NY / 2]
+    th = np.radians(angle)
+    w.wcs.cd = [[-scale * np.cos(th), scale * np.sin(th)], [scale * np.sin(th), scale * np.cos(th)]]
+    return w
+
+
+@pytest.fixture
+def dordir(tmp_path, monkeypatch):
+    '''
+    dordir points the Dorado directory (~/.dorado) into a temporary home directory.
+    '''
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.delenv('XDG_CONFIG_HOME', raising = False)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path / '.dorado'
+
+
+@pytest.fixture
+def night(dordir):
+    '''
+    night writes a synthetic night with 5 bias frames, 4 flats and 6 lights in each of R and V.
+    Light i is shifted by (0.7 i + 0.3, -0.45 i) pixels.
+    '''
+    datestr = '2021-01-02+03'
+    root = dordir / 'data' / 'raw' / datestr
+    os.makedirs(root)
+    rng = np.random.default_rng(1)
+    nstar = 40
+    sx = rng.uniform(15, NX - 15, nstar)
+    sy = rng.uniform(15, NY - 15, nstar)
+    sf = rng.uniform(2000, 40000, nstar)
+    yy, xx = np.mgrid[0:NY, 0:NX]
+    t0 = Time('2021-01-03T03:00:00')
+
+    def header(typ, i, filt = 'R', exptime = 60.):
+        h = fits.Header()
+        h['IMAGETYP'] = typ
+        h['DATE-OBS'] = (t0 + TimeDelta(i * 70, format = 'sec')).fits
+        h['EXPTIME'] = exptime
+        h['FILTER'] = filt
+        h['XBINNING'] = 1
+        h['YBINNING'] = 1
+        h['RA'] = '05 35 17'
+        h['DEC'] = '-05 23 28'
+        return h
+
+    for i in range(5):
+        data = (300 + rng.normal(0, 5, (NY, NX))).astype('uint16')
+        fits.PrimaryHDU(data, header('Bias Frame', i, exptime = 0.)).writeto(root / ('Bias_%03d.fits' % i))
+    shifts = []
+    for filt in ['R', 'V']:
+        for i in range(4):
+            vignette = 1 - 0.1 * ((xx - NX / 2)**2 + (yy - NY / 2)**2) / (NX * NX / 4)
+            data = (300 + 20000 * vignette + rng.normal(0, 30, (NY, NX))).astype('uint16')
+            fits.PrimaryHDU(data, header('Flat Field', i, filt, 2.)).writeto(root / ('Flat_%s_%03d.fits' % (filt, i)))
+    for filt in ['R', 'V']:
+        for i in range(6):
+            dx, dy = 0.7 * i + 0.3, -0.45 * i
+            shifts.append((dx, dy))
+            data = star_field(sx, sy, sf, dx, dy) + 800 + rng.normal(0, 8, (NY, NX))
+            data = np.clip(data, 0, 65535).astype('uint16')
+            offset = 0 if filt == 'R' else 100
+            fits.PrimaryHDU(data, header('Light Frame', i + offset, filt)).writeto(root / ('target_%s_%03d.fits' % (filt, i)))
+    return SimpleNamespace(datestr = datestr, root = root, sx = sx, sy = sy, sf = sf, shifts = shifts[:6], nlights = 6)
+
+
+class Star:
+    '''
+    Star is a minimal stand in for a Target at fixed coordinates, without a SIMBAD query.
+    '''
+    def __init__(self, name, coords):
+        self.name = name
+        self.coords = coords
+        self.filters = {}
+        self.ts = []
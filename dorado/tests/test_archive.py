@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from ..filer import Archive
+
+
+def write(path, **keys):
+    header = fits.Header()
+    for key, value in keys.items():
+        header[key.replace('_', '-')] = value
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    fits.PrimaryHDU(np.zeros((6, 8), dtype = np.float32), header).writeto(path, overwrite = True)
+
+
+def test_index_and_select(tmp_path):
+    root = tmp_path / 'raw'
+    night = root / '2021-01-02+03'
+    write(night / 'a.fits', IMAGETYP = 'Bias Frame', DATE_OBS = '2021-01-03T01:00:00')
+    write(night / 'b.fits', IMAGETYP = 'Flat Field', FILTER = 'R', EXPTIME = 2.0, DATE_OBS = '2021-01-03T01:10:00')
+    write(night / 'c.fits', IMAGETYP = 'Light Frame', FILTER = 'R', EXPTIME = 60.0, XBINNING = 2, YBINNING = 2,
+          DATE_OBS = '2021-01-03T02:00:00')
+    # frames without IMAGETYP are classified by name
+    write(night / 'darks' / 'd.fits', DATE_OBS = '2021-01-03T03:00:00')
+    write(night / 'Zero_1.fits', DATE_OBS = '2021-01-03T03:00:00')
+    write(root / '2021-01-03+04' / 'e.fits', IMAGETYP = 'Light Frame', FILTER = 'V', DATE_OBS = '2021-01-04T02:00:00')
+
+    archive = Archive(tmp_path / 'archive.db')
+    assert archive.index(root) == 6
+    types = {os.path.basename(row['path']): row['imagetyp'] for row in archive.select(night = '2021-01-02+03')}
+    assert types == {'a.fits': 'bias', 'b.fits': 'flat', 'c.fits': 'light', 'd.fits': 'dark', 'Zero_1.fits': 'bias'}
+    light = archive.select(imagetyp = 'light', filter = 'R')
+    assert [os.path.basename(row['path']) for row in light] == ['c.fits']
+    assert (light[0]['naxis1'], light[0]['naxis2'], light[0]['exptime']) == (8, 6, 60.0)
+    assert len(archive.select(binning = 2)) == 1
+    assert len(archive.select(night = '2021-01-03+04', imagetyp = 'light')) == 1
+
+    # unchanged files are not reopened, changed ones are and deleted ones are dropped
+    assert archive.index(root) == 0
+    write(night / 'c.fits', IMAGETYP = 'Light Frame', FILTER = 'V', DATE_OBS = '2021-01-03T02:00:00')
+    os.utime(night / 'c.fits', (1, 1))
+    os.remove(night / 'a.fits')
+    assert archive.index(root, night) == 1
+    assert [row['filter'] for row in archive.select(imagetyp = 'light', night = '2021-01-02+03')] == ['V']
+    assert len(archive.select(imagetyp = 'bias')) == 1
+    # indexing one night leaves the others alone
+    assert len(archive.select(night = '2021-01-03+04')) == 1
+    archive.close()
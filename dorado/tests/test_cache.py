@@ -0,0 +1,80 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.nddata import CCDData
+
+from ..filer import Cache
+
+
+def frame(value, shape = (20, 20)):
+    return CCDData(np.full(shape, value, dtype = np.float32), unit = 'adu')
+
+
+def test_content_addressed(tmp_path):
+    cache = Cache(tmp_path)
+    fname, cachedir = cache.put(frame(1), 'sub')
+    assert cachedir == tmp_path / 'sub'
+    assert os.path.exists(cachedir / fname)
+    # the same content is stored once under the same name
+    assert cache.put(frame(1), 'sub') == (fname, cachedir)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.put(frame(2), 'sub')[0] != fname
+    assert cache.key(frame(1)) != cache.key(CCDData(np.full((20, 20), 1, dtype = np.float64), unit = 'adu'))
+
+    # concurrent stores of the same object never collide
+    with ThreadPoolExecutor(max_workers = 4) as pool:
+        names = list(pool.map(lambda _: cache.put(frame(3))[0], range(8)))
+    assert len(set(names)) == 1
+    assert sorted(os.listdir(tmp_path)) == sorted([names[0], 'sub'])
+
+
+def test_evicts_least_recently_used(tmp_path):
+    first = Cache(tmp_path).put(frame(0))[0]
+    size = os.path.getsize(tmp_path / first)
+    cache = Cache(tmp_path, limit = 4 * size)
+    names = [cache.put(frame(i))[0] for i in range(1, 4)]
+    for i, name in enumerate([first] + names):
+        os.utime(tmp_path / name, (i, i))
+    # refreshing the oldest object keeps it, the least recently used one goes
+    cache.put(frame(0))
+    cache.put(frame(4))
+    kept = set(os.path.basename(path) for _, _, path in cache.entries())
+    assert len(kept) == 4
+    assert (first in kept) and (names[0] not in kept)
+    assert cache.size() <= cache.limit
+
+    # only files written by the cache are evicted or cleared
+    (tmp_path / 'notes.txt').write_text('keep')
+    cache.clear()
+    assert os.listdir(tmp_path) == ['notes.txt']
+
+
+def test_evicted_before_refresh(tmp_path, monkeypatch):
+    cache = Cache(tmp_path)
+    fname, cachedir = cache.put(frame(1))
+    utime = os.utime
+
+    def evicted(path, *args, **kwargs):
+        # another job evicts the object between the existence check and the touch
+        os.remove(path)
+        return utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'utime', evicted)
+    assert cache.put(frame(1)) == (fname, cachedir)
+    assert os.path.exists(cachedir / fname)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_keeps_staged_objects(tmp_path):
+    first = Cache(tmp_path).put(frame(0))[0]
+    size = os.path.getsize(tmp_path / first)
+    cache = Cache(tmp_path, limit = 2 * size)
+    second = cache.put(frame(1), keep = tmp_path / first)[0]
+    os.utime(tmp_path / first, (0, 0))
+    os.utime(tmp_path / second, (1, 1))
+    # objects staged earlier by the caller survive while the next one is stored
+    third = cache.put(frame(2), keep = {tmp_path / first, tmp_path / second})[0]
+    assert sorted(os.listdir(tmp_path)) == sorted([first, second, third])
+    assert cache.evict() == 1
+    assert sorted(os.listdir(tmp_path)) == sorted([second, third])
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from astropy.nddata import CCDData
+from ccdproc import ccd_process
+
+from ..ceres import Calibrator
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(4)
+    bias = CCDData(300 + rng.normal(0, 5, (60, 70)), unit = 'adu')
+    flat = CCDData(20000 * (1 - 0.1 * rng.random((60, 70))), unit = 'adu')
+    lights = [CCDData(rng.uniform(300, 60000, (60, 70)).round(), unit = 'adu') for _ in range(5)]
+    return bias, flat, lights
+
+
+@pytest.mark.parametrize('dtype, rtol', [('float64', 1e-12), ('float32', 1e-5)])
+def test_calibrate_matches_ccd_process(frames, dtype, rtol):
+    bias, flat, lights = frames
+    calibrator = Calibrator(bias, flat, dtype = dtype)
+    for light in lights:
+        expected = ccd_process(light, master_bias = bias, master_flat = flat)
+        result = calibrator.calibrate(light)
+        assert result.data.dtype == np.dtype(dtype)
+        assert np.allclose(result.data, expected.data, rtol = rtol, atol = 0)
+        assert result.header['subbias'] and result.header['flatcor']
+
+
+def test_cube_matches_frames(frames):
+    bias, flat, lights = frames
+    calibrator = Calibrator(bias, flat, dtype = 'float64', chunk = 2)
+    cube = np.array([light.data for light in lights])
+    single = np.array([calibrator.apply(light.data) for light in lights])
+    assert np.array_equal(calibrator.apply(cube), single)
+    # in place calibration of the cube gives the same result
+    assert np.array_equal(calibrator.apply(cube, out = cube), single)
+
+
+def test_masked_flat_pixels_are_unity(frames):
+    bias, flat, lights = frames
+    mask = np.zeros(flat.shape, dtype = bool)
+    mask[10, 20] = True
+    flat = CCDData(flat.data, unit = 'adu', mask = mask)
+    calibrator = Calibrator(bias, flat, dtype = 'float64')
+    result = calibrator.apply(lights[0].data)
+    assert result[10, 20] == lights[0].data[10, 20] - bias.data[10, 20]
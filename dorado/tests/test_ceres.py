@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.nddata import CCDData
+
+from ..filer import Filer
+from .conftest import Star, field_wcs
+
+
+def stars(night, w, index):
+    '''
+    stars places Stars on synthetic stars of the reference frame, see 'Ceres.apertures' for
+    the pixel convention of the apertures.
+    '''
+    ra, dec = w.wcs_pix2world(night.sx[index] + night.shifts[0][0], night.sy[index] + night.shifts[0][1], 1)
+    return [Star(str(i), SkyCoord(r, d, unit = 'deg')) for i, r, d in zip(index, np.atleast_1d(ra), np.atleast_1d(dec))]
+
+
+def flux(ts):
+    return np.array([q.value for q in ts.flux])
+
+
+def test_lazy_night_end_to_end(night):
+    filer = Filer()
+    cr = filer.mkceres(night.datestr, lazy = True)
+    stack = cr.data[0]
+    cr.calibrate(stack.filter)
+    # calibrated frames are stashed as big-endian FITS and must come back in native order
+    assert stack.frame(1).data.dtype.isnative
+    cr.align(stack.filter, filer, getWCS = False)
+    assert stack.aligned
+    assert len(stack.data) == night.nlights
+    for (dx, dy), matrix in zip(night.shifts, stack.transforms):
+        assert np.allclose(matrix[:2, 2], [night.shifts[0][0] - dx, night.shifts[0][1] - dy], atol = 0.1)
+
+    stack.wcs = field_wcs()
+    series = cr.dorphot(stack.filter, stars(night, stack.wcs, [0, 1, 2]), shape = 5)
+    assert all(len(ts.flux) == night.nlights for ts in series)
+    assert all(np.all(np.isfinite(flux(ts))) and np.all(flux(ts) > 0) for ts in series)
+
+
+def test_cube_round_trip_align_and_dorphot(night):
+    from ..ceres import Ceres
+
+    filer = Filer()
+    cr = filer.mkceres(night.datestr)
+    stack = cr.data[0]
+    cr.calibrate(stack.filter)
+    path = filer.savecube(cr, [stack.filter])[0]
+    assert str(path).endswith('cube_c.fits')
+
+    cube = filer.loadcube(path)
+    assert cube.calibrated and len(cube.data) == night.nlights
+    # the cube is big-endian on disk, frames must come back in native order without copying the cube
+    assert not cube.data[1].data.dtype.isnative
+    assert cube.frame(1).data.dtype.isnative
+    assert np.array_equal(cube.frame(1).data, stack.frame(1).data)
+
+    cr2 = Ceres(bias = cr.bias, time = cr.time, datestr = cr.datestr)
+    cr2.add_stack(cube)
+    cr2.align(cube.filter, filer, getWCS = False)
+    assert cube.aligned and len(cube.data) == night.nlights
+    cube.wcs = field_wcs()
+    ts = cr2.dorphot(cube.filter, stars(night, cube.wcs, [0]), shape = 5)[0]
+    assert len(ts.flux) == night.nlights and np.all(flux(ts) > 0)
+
+
+def test_native_dorphot_leaves_frames_untouched(night):
+    filer = Filer()
+    cr = filer.mkceres(night.datestr)
+    stack = cr.data[0]
+    cr.calibrate(stack.filter)
+    cr.align(stack.filter, filer, getWCS = False, resample = False)
+    assert not stack.aligned
+    assert all(frame.uncertainty is None for frame in stack.data)
+
+    stack.wcs = field_wcs()
+    ts = cr.dorphot(stack.filter, stars(night, stack.wcs, [0]), shape = 5)[0]
+    assert len(ts.flux) == night.nlights and np.all(flux(ts) > 0)
+    # the uncertainty photutils needs is attached to a view, not to the stack's frames
+    assert all(frame.uncertainty is None for frame in stack.data)
+
+
+@pytest.mark.parametrize('resample', [True, False])
+def test_stream_matches_batch(night, resample):
+    filer = Filer()
+    batch = filer.mkceres(night.datestr)
+    stack = batch.data[0]
+    toi = stars(night, field_wcs(), [3])[0]
+    batch.calibrate(stack.filter)
+    batch.align(stack.filter, filer, getWCS = False, resample = resample, translation = True)
+    stack.wcs = field_wcs()
+    stack.propagate_wcs()
+    expected = batch.dorphot(stack.filter, toi, shape = 5)[0]
+
+    streamed = filer.mkceres(night.datestr)
+    stack = streamed.data[0]
+    stack.wcs = field_wcs()
+    rows = list(streamed.stream(stack.filter, filer, toi, shape = 5, getWCS = False, resample = resample, translation = True))
+    assert len(rows) == night.nlights
+    assert np.allclose([row['flux'].value for row in rows], flux(expected), rtol = 1e-6)
+    assert np.allclose([row['x'].value for row in rows], [q.value for q in expected.x], atol = 1e-6)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('translation', [False, True])
+def test_align_pool_matches_serial(night, lazy, translation):
+    from ..ceres import Registrar
+
+    filer = Filer()
+    cr = filer.mkceres(night.datestr, lazy = lazy)
+    stack = cr.data[0]
+    cr.calibrate(stack.filter)
+    if not lazy:
+        # a blank frame is skipped by both
+        stack.data[2] = CCDData(np.full(stack.data[2].shape, 800.0, dtype = np.float32), unit = 'adu',
+                                header = stack.data[2].header)
+    reference = stack.frame(stack.alignTo)
+    serial = list(cr.align_serial(stack, Registrar(reference, max_control_points = 100, detection_sigma = 6,
+                                                   translation = translation)))
+    pooled = list(cr.align_pool(stack, reference, workers = 2, translation = translation))
+    assert [i for i, _, _ in pooled] == [i for i, _, _ in serial] == list(range(night.nlights))
+    for (_, image, matrix), (_, expected, expected_matrix) in zip(pooled, serial):
+        if expected is None:
+            assert (image is None) and (matrix is None)
+            continue
+        assert image.data.dtype == expected.data.dtype
+        if translation:
+            # the correlation is deterministic, both find the same transform and pixels
+            assert np.allclose(matrix, expected_matrix, atol = 1e-9)
+            assert np.allclose(image.data, expected.data, atol = 1e-3)
+        else:
+            assert np.allclose(matrix, expected_matrix, atol = 0.05)
+    if not lazy:
+        assert serial[2][1] is None
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import ccdproc
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from ..filer import StreamCombiner, TileCombiner
+
+
+@pytest.fixture
+def flats(tmp_path):
+    '''
+    flats writes 7 flats as unsigned 16 bit files, stored scaled by BZERO, with a few cosmic rays.
+    '''
+    rng = np.random.default_rng(5)
+    paths = []
+    images = []
+    for i in range(7):
+        data = 20000 + rng.normal(0, 100, (50, 40))
+        data[rng.integers(0, 50), rng.integers(0, 40)] = 60000
+        data = data.astype('uint16')
+        path = tmp_path / ('flat_%d.fits' % i)
+        fits.PrimaryHDU(data).writeto(path)
+        paths.append(path)
+        images.append(CCDData(data.astype(np.float32), unit = 'adu'))
+    return paths, images
+
+
+@pytest.mark.parametrize('method', ['average', 'median'])
+@pytest.mark.parametrize('sigma_clip', [False, True])
+def test_tile_matches_ccdproc_combine(flats, method, sigma_clip):
+    paths, images = flats
+    expected = ccdproc.combine(images, method = method, sigma_clip = sigma_clip, sigma_clip_func = 'median',
+                               sigma_clip_dev_func = 'std', sigma_clip_low_thresh = 2, sigma_clip_high_thresh = 2,
+                               dtype = np.float32)
+    if sigma_clip and method == 'average':
+        # the outliers were rejected
+        assert not np.allclose(expected.data, np.mean([image.data for image in images], axis = 0))
+    # a budget of a few rows forces many strips
+    for inputs in (paths, images):
+        combiner = TileCombiner(inputs, mem_limit = 7 * 40 * 32 * 3, dtype = np.float32)
+        assert combiner.rows() == 3
+        result = combiner.combine(method, sigma_clip = sigma_clip, low_thresh = 2, high_thresh = 2, func = 'median',
+                                  dev_func = 'std')
+        combiner.close()
+        assert np.array_equal(result.data, expected.data)
+        assert np.array_equal(result.mask, expected.mask)
+
+
+@pytest.mark.parametrize('sigma_clip', [False, True])
+def test_stream_matches_ccdproc_combine(flats, sigma_clip):
+    paths, images = flats
+    images = [CCDData(image.data.astype(np.float64), unit = 'adu') for image in images]
+    # a single outlier of 7 frames lies at most 2.45 deviations from the mean
+    expected = ccdproc.combine(images, method = 'average', sigma_clip = sigma_clip, sigma_clip_func = 'mean',
+                               sigma_clip_dev_func = 'std', sigma_clip_low_thresh = 2, sigma_clip_high_thresh = 2,
+                               dtype = np.float64)
+    if sigma_clip:
+        assert not np.allclose(expected.data, np.mean([image.data for image in images], axis = 0))
+    # ccdproc clips once, a single pass of the StreamCombiner is the same rejection
+    for inputs in (paths, images):
+        result = StreamCombiner(dtype = np.float64).combine(inputs, sigma_clip = sigma_clip, low_thresh = 2,
+                                                            high_thresh = 2, maxiters = 1)
+        assert np.allclose(result.data, expected.data, rtol = 1e-12)
+        assert np.allclose(result.uncertainty.array, expected.uncertainty.array, rtol = 1e-9)
+
+
+def test_stream_consumes_iterators(flats):
+    paths, images = flats
+    result = StreamCombiner().combine(iter(paths))
+    assert np.allclose(result.data, np.mean([image.data for image in images], axis = 0), rtol = 1e-6)
+    with pytest.raises(Exception):
+        StreamCombiner().combine(iter(paths), sigma_clip = True)
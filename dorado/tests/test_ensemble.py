@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from ..ceres import Ensemble
+
+
+@pytest.fixture
+def field():
+    '''
+    field simulates 12 comparison stars over 80 frames under a transparency trend. Star 3
+    varies by 20 percent and star 7 has a single outlying frame.
+    '''
+    rng = np.random.default_rng(7)
+    nframes, nstars = 80, 12
+    transparency = 1 - 0.3 * np.linspace(0, 1, nframes) + 0.05 * np.sin(np.arange(nframes) / 5)
+    levels = rng.uniform(5e4, 5e5, nstars)
+    fluxes = transparency[:, None] * levels[None, :] * (1 + rng.normal(0, 0.002, (nframes, nstars)))
+    fluxes[:, 3] *= 1 + 0.2 * np.sin(np.arange(nframes) / 3)
+    fluxes[40, 7] *= 1.5
+    return fluxes, transparency
+
+
+def test_ensemble_rejects_variable_and_outlier(field):
+    fluxes, transparency = field
+    ensemble = Ensemble(fluxes)
+    assert ensemble.weights[3] == pytest.approx(0, abs = 1e-12)
+    # the constant stars carry the ensemble
+    assert np.count_nonzero(ensemble.weights[[i for i in range(12) if i != 3]] > 0) >= 9
+    assert ensemble.weights.sum() == pytest.approx(1)
+    assert ensemble.mask[40, 7]
+    assert np.count_nonzero(ensemble.mask[:, 7]) < 5
+    # the artificial star follows the transparency up to its normalization
+    ratio = ensemble.comparison / transparency
+    assert np.std(ratio) / np.mean(ratio) < 0.002
+
+    target = 2e5 * transparency
+    corrected = ensemble.correct(target)
+    assert np.std(corrected) / np.mean(corrected) < 0.002
+    assert ensemble.correct(np.column_stack([target, target])).shape == (80, 2)
+
+
+def test_ensemble_needs_an_iteration(field):
+    with pytest.raises(Exception):
+        Ensemble(field[0], maxiters = 0)
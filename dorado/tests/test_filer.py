@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from ..filer import Filer
+from .conftest import NX, NY, field_wcs
+
+
+def count_opens(monkeypatch):
+    '''
+    count_opens records the path of every FITS file opened through 'astropy.io.fits.open'.
+    '''
+    opened = []
+    original = fits.open
+
+    def counting(name, *args, **kwargs):
+        opened.append(str(name))
+        return original(name, *args, **kwargs)
+
+    monkeypatch.setattr(fits, 'open', counting)
+    return opened
+
+
+def test_calibration_frames_opened_once(night, monkeypatch):
+    filer = Filer()
+    bias, flats, _ = filer.indexscan(night.datestr, lazy = True)
+    flats = [path for path in flats if fits.getheader(path)['FILTER'] == 'R']
+    opened = count_opens(monkeypatch)
+    master = filer.mkBias(bias)
+    flat = filer.mkFlat(flats)
+    assert sorted(opened) == sorted(bias + flats)
+
+    expected = np.mean([fits.getdata(path).astype(np.float64) for path in bias], axis = 0)
+    assert np.allclose(master.data, expected, rtol = 1e-6)
+    assert flat.header['NCOMBINE'] == len(flats)
+    assert np.allclose(flat.data, np.median([fits.getdata(path) for path in flats], axis = 0), rtol = 1e-3)
+
+
+class FakeSolver:
+    '''
+    FakeSolver answers every submission at once with a fixed WCS header and records the settings.
+    '''
+    def __init__(self, header):
+        self.header = header
+        self.submitted = []
+
+    def submit(self, path, **settings):
+        assert os.path.exists(path)
+        self.submitted.append(settings)
+        return None, self.header
+
+    def poll(self, submission_id):
+        return self.header
+
+
+def test_solve_many_removes_uploads(dordir):
+    w = field_wcs()
+    header = w.to_header()
+    solver = FakeSolver(header)
+    filer = Filer(solver = solver)
+    rng = np.random.default_rng(2)
+    images = []
+    for i in range(3):
+        image = CCDData(rng.normal(100, 5, (NY, NX)), unit = 'adu')
+        image.header['RA'] = w.wcs.crval[0]
+        image.header['DEC'] = w.wcs.crval[1]
+        images.append(image)
+
+    results = filer.solveMany(images)
+    assert len(solver.submitted) == 3
+    assert all(result[1] == header for result in results)
+    assert all(filer.archive.find_solution(filer.cache.key(image)) != None for image in images)
+    assert filer.cache.entries() == []
+
+    # the stored solutions answer a repeat solve without the solver
+    results = filer.solveMany(images)
+    assert len(solver.submitted) == 3
+    assert all(result[1]['CRVAL1'] == header['CRVAL1'] for result in results)
+
+
+def test_zero_frames_are_bias_frames(dordir):
+    root = dordir / 'data' / 'raw' / '2021-01-02+03'
+    os.makedirs(root)
+    for name in ['Zero_000.fits', 'Zero_001.fits', 'Flat_000.fits', 'target_000.fits']:
+        fits.PrimaryHDU(np.zeros((8, 8), dtype = np.float32)).writeto(root / name)
+    filer = Filer()
+    bias, flats, lights = filer.dirscan(['data', 'raw', '2021-01-02+03'], lazy = True)
+    assert [os.path.basename(path) for path in bias] == ['Zero_000.fits', 'Zero_001.fits']
+    assert [os.path.basename(path) for path in lights] == ['target_000.fits']
+    filer.archive.index(dordir / 'data' / 'raw')
+    rows = filer.archive.select(night = '2021-01-02+03', imagetyp = 'bias')
+    assert sorted(os.path.basename(row['path']) for row in rows) == ['Zero_000.fits', 'Zero_001.fits']
+
+
+def test_newdat_finds_only_new_frames(night):
+    filer = Filer()
+    cr = filer.mkceres(night.datestr, lazy = True)
+    filer.mark_processed(cr, 'photometry')
+    assert filer.newdat(stage = 'photometry') == {}
+
+    # touching a processed frame without changing it does not make it new
+    touched = night.root / 'target_R_000.fits'
+    mtime = os.stat(touched).st_mtime + 100
+    os.utime(touched, (mtime, mtime))
+    added = night.root / 'target_R_006.fits'
+    header = fits.getheader(night.root / 'target_R_005.fits')
+    header['DATE-OBS'] = '2021-01-03T04:00:00.000'
+    fits.PrimaryHDU(fits.getdata(night.root / 'target_R_005.fits'), header).writeto(added)
+
+    new = filer.newdat(stage = 'photometry')
+    assert list(new.keys()) == [night.datestr]
+    assert [os.path.basename(path) for path in new[night.datestr]] == [added.name]
+    # other stages keep their own manifest
+    new = filer.newdat(stage = 'aligned')
+    assert len(new[night.datestr]) == 2 * night.nlights + 1
+
+
+def read16(path):
+    '''
+    read16 returns the stored 16 bit integers of a frame with their BSCALE/BZERO applied in double precision.
+    '''
+    with fits.open(path, do_not_scale_image_data = True) as hdul:
+        header = hdul[0].header
+        assert header['BITPIX'] == 16
+        return hdul[0].data * np.float64(header.get('BSCALE', 1)) + header.get('BZERO', 0), header.get('BSCALE', 1)
+
+
+def test_force16_round_trip(dordir):
+    filer = Filer()
+    rng = np.random.default_rng(3)
+    image = CCDData(rng.normal(1000, 50, (NY, NX)).astype(np.float32), unit = 'adu')
+    path = dordir / 'scaled.fits'
+    filer.writeFrame(image, path, force16 = True)
+    data, bscale = read16(path)
+    assert np.max(np.abs(data - image.data)) <= bscale / 2 * (1 + 1e-6)
+
+    # integers past the 16 bit range are scaled rather than wrapped
+    image = CCDData(np.round(np.linspace(-1000, 100000, NY * NX)).reshape(NY, NX), unit = 'adu')
+    filer.writeFrame(image, path, force16 = True)
+    data, bscale = read16(path)
+    assert bscale > 1
+    assert np.max(np.abs(data - image.data)) <= bscale / 2 * (1 + 1e-6)
+    assert np.allclose((data.min(), data.max()), (-1000, 100000))
+
+    # integers which fit are stored exactly
+    image = CCDData(np.round(rng.uniform(0, 65535, (NY, NX))), unit = 'adu')
+    filer.writeFrame(image, path, force16 = True)
+    data, bscale = read16(path)
+    assert bscale == 1
+    assert np.array_equal(data, image.data)
+
+    # without scaling frames past the range are refused instead of clipped
+    image = CCDData(np.round(np.linspace(-1000, 100000, NY * NX)).reshape(NY, NX), unit = 'adu')
+    with pytest.raises(Exception, match = 'does not fit 16 bit'):
+        filer.force16(image, scale = False)
+    image.data[0, 0] = np.nan
+    with pytest.raises(Exception, match = 'non-finite'):
+        filer.force16(image)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from photutils.aperture import CircularAnnulus, CircularAperture, aperture_photometry
+
+from ..ceres import Photometer
+
+
+def test_measure_matches_aperture_photometry():
+    rng = np.random.default_rng(6)
+    shape = (80, 90)
+    # positions include apertures and annuli cut by the frame edge
+    positions = np.array([[40.3, 30.7], [10.5, 60.2], [2.0, 3.0], [88.2, 41.9], [45.0, 78.6]])
+    apers = [CircularAperture(positions, r = 5.5), CircularAnnulus(positions, r_in = 8, r_out = 12)]
+    photometer = Photometer(apers, shape)
+    for _ in range(3):
+        data = rng.normal(100, 10, shape)
+        results = aperture_photometry(data, apers)
+        expected = results['aperture_sum_0'] - results['aperture_sum_1'] / apers[1].area * apers[0].area
+        assert np.allclose(photometer.measure(data), expected, rtol = 1e-12)
+        assert np.allclose(photometer.sums(data), np.concatenate([results['aperture_sum_0'], results['aperture_sum_1']]),
+                           rtol = 1e-12)
+
+
+def test_shape_mismatch():
+    apers = [CircularAperture([[10, 10]], r = 3), CircularAnnulus([[10, 10]], r_in = 5, r_out = 7)]
+    with pytest.raises(Exception):
+        Photometer(apers, (30, 30)).measure(np.zeros((30, 31)))
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import astroalign as aa
+import numpy as np
+import pytest
+
+from ..ceres import Registrar, registrarClass
+from ..ceres.registrarClass import RegistrationError
+from .conftest import NX, NY, star_field
+
+
+def frames(angle = 0.0, dx = 0.0, dy = 0.0, seed = 1):
+    '''
+    frames renders a reference field and the field rotated by 'angle' degrees about the centre
+    and then shifted by (dx, dy) pixels, with the true frame to reference transform.
+    '''
+    rng = np.random.default_rng(seed)
+    sx = rng.uniform(15, NX - 15, 40)
+    sy = rng.uniform(15, NY - 15, 40)
+    sf = rng.uniform(2000, 40000, 40)
+    th = np.radians(angle)
+    cx, cy = NX / 2, NY / 2
+    mx = cx + np.cos(th) * (sx - cx) - np.sin(th) * (sy - cy)
+    my = cy + np.sin(th) * (sx - cx) + np.cos(th) * (sy - cy)
+    reference = star_field(sx, sy, sf) + 800 + rng.normal(0, 8, (NY, NX))
+    image = star_field(mx, my, sf, dx, dy) + 800 + rng.normal(0, 8, (NY, NX))
+    return reference, image, (sx, sy), (mx + dx, my + dy)
+
+
+def test_fallback_without_astroalign_internals(monkeypatch):
+    reference, image, ref_xy, img_xy = frames(angle = 7, dx = 3.2, dy = -1.6)
+    expected, _ = aa.find_transform(image, reference)
+    # the Registrar only sees the public astroalign interface
+    public = SimpleNamespace(**{k: v for k, v in vars(aa).items() if not k.startswith('_')})
+    monkeypatch.setattr(registrarClass, 'aa', public)
+
+    registrar = Registrar(reference)
+    assert not registrar.cached
+    transform, (src, dst) = registrar.find_transform(image)
+    # astroalign's RANSAC is randomized, the solutions agree to well below a pixel
+    points = np.transpose(img_xy)
+    assert np.allclose(transform(points), expected(points), atol = 0.1)
+    assert np.allclose(transform(points), np.transpose(ref_xy), atol = 0.2)
+    with pytest.raises(RegistrationError):
+        registrar.find_transform(np.full_like(image, 800.0))
+
+
+def test_fallback_when_astroalign_internals_change(monkeypatch):
+    reference, image, ref_xy, img_xy = frames(angle = 7, dx = 3.2, dy = -1.6)
+    registrar = Registrar(reference)
+    assert registrar.cached
+
+    def ransac(data, model):
+        # a changed signature of the private RANSAC
+        raise AssertionError('not reached')
+
+    changed = SimpleNamespace(**vars(aa))
+    changed._ransac = ransac
+    monkeypatch.setattr(registrarClass, 'aa', changed)
+    transform, _ = registrar.find_transform(image)
+    assert not registrar.cached
+    assert np.allclose(transform(np.transpose(img_xy)), np.transpose(ref_xy), atol = 0.2)
+    with pytest.raises(RegistrationError):
+        registrar.find_transform(np.full_like(image, 800.0))
+@pytest.mark.parametrize('angle, dx, dy', [(0, 2.4, -3.1), (12, -5.5, 1.25), (-30, 0.0, 0.0)])
+def test_cached_search_matches_astroalign(angle, dx, dy):
+    reference, image, ref_xy, img_xy = frames(angle, dx, dy)
+    registrar = Registrar(reference)
+    assert registrar.cached
+    expected, (exp_src, exp_dst) = aa.find_transform(image, reference)
+    transform, (src, dst) = registrar.find_transform(image)
+    points = np.transpose(img_xy)
+    assert np.allclose(transform(points), expected(points), atol = 0.1)
+    assert np.allclose(transform(points), np.transpose(ref_xy), atol = 0.2)
+    assert np.allclose(transform(src), dst, atol = 3)
+
+    # the registered frame lines up with the reference away from the uncovered borders
+    aligned, _ = registrar.register(image)
+    assert aligned.shape == reference.shape
+    inner = (slice(40, -40), slice(40, -40))
+    assert np.corrcoef(aligned[inner].ravel(), reference[inner].ravel())[0, 1] > 0.95
+
+
+def test_too_few_sources():
+    reference, _, _, _ = frames()
+    with pytest.raises(RegistrationError):
+        Registrar(reference).find_transform(np.full_like(reference, 800.0))
+
+
+@pytest.mark.parametrize('dx, dy', [(0.3, -0.45), (3.7, 2.15), (-6.25, 4.6), (0.0, 0.0)])
+def test_phase_correlation_recovers_shift(dx, dy):
+    reference, image, ref_xy, img_xy = frames(0, dx, dy)
+    registrar = Registrar(reference, translation = True)
+    shift, peak = registrar.phase_correlate(image)
+    assert peak >= registrar.min_peak
+    assert np.allclose(shift, [dx, dy], atol = 0.1)
+    transform, matches = registrar.find_transform(image)
+    assert matches is None
+    assert np.allclose(transform(np.transpose(img_xy)), np.transpose(ref_xy), atol = 0.1)
+
+
+def test_rotated_frame_falls_back_to_asterisms():
+    reference, image, ref_xy, img_xy = frames(angle = 25, dx = 1.5, dy = -2.0)
+    registrar = Registrar(reference, translation = True)
+    _, peak = registrar.phase_correlate(image)
+    assert peak < registrar.min_peak
+    transform, matches = registrar.find_transform(image)
+    assert matches is not None
+    assert np.allclose(transform(np.transpose(img_xy)), np.transpose(ref_xy), atol = 0.2)
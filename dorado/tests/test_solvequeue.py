@@ -0,0 +1,82 @@
+import threading
+import time
+
+from astropy.io import fits
+
+from ..filer import SolveQueue
+
+
+class StubSolver:
+    '''
+    StubSolver is a stand-in server. A path names the number of polls its solve stays pending,
+    'fail' solves fail and 'never' solves never finish.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.polls = {}
+        self.inflight = 0
+        self.most = 0
+
+    def submit(self, path, **settings):
+        with self.lock:
+            self.inflight += 1
+            self.most = max(self.most, self.inflight)
+            self.polls[path] = 0
+        return path, self.poll(path, count = False)
+
+    def poll(self, submission_id, count = True):
+        with self.lock:
+            if count:
+                self.polls[submission_id] += 1
+            if submission_id == 'never':
+                return None
+            if submission_id == 'fail':
+                self.inflight -= 1
+                return fits.Header()
+            if self.polls[submission_id] < int(submission_id.split('_')[0]):
+                return None
+            self.inflight -= 1
+        header = fits.Header()
+        header['OBJECT'] = submission_id
+        return header
+
+
+def test_solves_in_order_with_backoff():
+    solver = StubSolver()
+    queue = SolveQueue(solver, concurrency = 2, delay = 0.01, backoff = 2, max_delay = 0.02, timeout = 5)
+    paths = ['3_a', '0_b', 'fail', '1_c', '2_d']
+    start = time.monotonic()
+    results = queue.solve(paths)
+    assert [None if r is None else r['OBJECT'] for r in results] == ['3_a', '0_b', None, '1_c', '2_d']
+    assert solver.polls['3_a'] == 3 and solver.polls['0_b'] == 0
+    assert solver.most <= 2
+    # waits of 0.01, 0.02, 0.02 for the slowest solve
+    assert time.monotonic() - start >= 0.05
+
+
+def test_timeout():
+    queue = SolveQueue(StubSolver(), delay = 0.01, max_delay = 0.01, timeout = 0.05)
+    assert queue.solve_one('never') is None
+
+
+class FlakySolver(StubSolver):
+    '''
+    FlakySolver fails to upload 'upload' and loses the connection while polling 'network'.
+    '''
+    def submit(self, path, **settings):
+        if path == 'upload':
+            raise RuntimeError('upload failed')
+        return super().submit(path, **settings)
+
+    def poll(self, submission_id, count = True):
+        if submission_id == 'network' and count:
+            raise ConnectionError('connection reset')
+        if submission_id == 'network':
+            return None
+        return super().poll(submission_id, count)
+
+
+def test_errors_only_fail_their_frame():
+    queue = SolveQueue(FlakySolver(), concurrency = 2, delay = 0.01, max_delay = 0.01, timeout = 5)
+    results = queue.solve(['1_a', 'upload', '0_b', 'network', '2_c'])
+    assert [None if r is None else r['OBJECT'] for r in results] == ['1_a', None, '0_b', None, '2_c']
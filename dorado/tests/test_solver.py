@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from ..filer import LocalSolver
+
+
+@pytest.fixture(scope = 'module')
+def sky(tmp_path_factory):
+    '''
+    sky writes a catalog of uniformly scattered stars around a 300 x 300 field at 2 arcseconds
+    per pixel and renders the field's stars.
+    '''
+    rng = np.random.default_rng(3)
+    ny = nx = 300
+    scale = 2 / 3600
+    w = WCS(naxis = 2)
+    w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    w.wcs.crval = [150.1, 20.2]
+    w.wcs.crpix = [nx / 2, ny / 2]
+    th = np.radians(20)
+    w.wcs.cd = [[-scale * np.cos(th), scale * np.sin(th)], [scale * np.sin(th), scale * np.cos(th)]]
+
+    n = 30000
+    ra = rng.uniform(149.1, 151.1, n)
+    dec = rng.uniform(19.2, 21.2, n)
+    mag = 12 + 6 * rng.power(3, n)
+    x, y = w.all_world2pix(ra, dec, 0)
+    inside = (x > 5) & (x < nx - 5) & (y > 5) & (y < ny - 5)
+    yy, xx = np.mgrid[0:ny, 0:nx]
+    img = 100 + rng.normal(0, 5, (ny, nx))
+    for xi, yi, m in zip(x[inside], y[inside], mag[inside]):
+        f = 50 * 10**(-0.4 * (m - 20))
+        img += f / (2 * np.pi * 1.5**2) * np.exp(-((xx - xi)**2 + (yy - yi)**2) / (2 * 1.5**2))
+    path = tmp_path_factory.mktemp('catalog') / 'catalog.fits'
+    Table({'ra': ra, 'dec': dec, 'mag': mag}).write(path)
+    return path, img, ra[inside], dec[inside], x[inside], y[inside]
+
+
+def error(header, sky):
+    '''
+    error returns the pixel scale of a solution in arcseconds per pixel and its largest position error in pixels.
+    '''
+    _, _, ra, dec, x, y = sky
+    w = WCS(header)
+    x2, y2 = w.all_world2pix(ra, dec, 0)
+    return np.sqrt(abs(np.linalg.det(w.pixel_scale_matrix))) * 3600, np.max(np.hypot(x2 - x, y2 - y))
+
+
+@pytest.mark.parametrize('hint', [
+    {},
+    {'center_ra': 150.3, 'center_dec': 20.0, 'radius': 1.0},
+    {'center_ra': 150.3, 'center_dec': 20.0, 'radius': 1.0, 'scale_units': 'arcsecperpix', 'scale_type': 'ev',
+     'scale_est': 2.0, 'scale_err': 10},
+    {'center_ra': 150.3, 'center_dec': 20.0, 'radius': 1.0, 'scale_units': 'arcminwidth', 'scale_type': 'ul',
+     'scale_lower': 9, 'scale_upper': 11},
+])
+def test_local_solve(sky, hint):
+    header = LocalSolver(sky[0]).solve(sky[1], **hint)
+    assert len(header) > 0
+    scale, err = error(header, sky)
+    assert scale == pytest.approx(2.0, rel = 1e-3)
+    assert err < 1
+
+
+def test_local_solve_rejects_other_scales(sky):
+    # the field is 2 arcseconds per pixel, no mapping within 5 to 8 may be accepted
+    hint = {'center_ra': 150.3, 'center_dec': 20.0, 'radius': 1.0, 'scale_units': 'arcsecperpix', 'scale_type': 'ul',
+            'scale_lower': 5, 'scale_upper': 8}
+    assert len(LocalSolver(sky[0]).solve(sky[1], **hint)) == 0